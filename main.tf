@@ -13,4 +13,6 @@ module "iot" {
   region                    = var.region
   zone                      = var.zone
   project_id                = var.project_id
+  iot_events_ingest_mode    = var.iot_events_ingest_mode
+  trainer_solver            = var.trainer_solver
 }
@@ -45,6 +45,10 @@ resource "google_cloudfunctions_function" anomaly_detector_vertex {
     period            = 3600
     table_id          = var.table_id
     destination_table = var.table_id_analyzed
+    payload_format    = "array"
+    # maintained by the batched ingest only, histories are queried from the events table otherwise
+    windows_table     = var.ingest_mode == "batch" ? var.table_id_windows : ""
+    window_size       = 25
   }
   ingress_settings      = "ALLOW_ALL"
 }
@@ -33,3 +33,13 @@ variable "registry_id" {
 variable "table_id" {
   type = string
 }
+
+variable "table_id_windows" {
+  type = string
+}
+
+variable "ingest_mode" {
+  description = "ingest mode of iot_events_to_bq, the device windows table is only maintained in batch mode"
+  type        = string
+  default     = "event"
+}
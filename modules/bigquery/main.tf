@@ -14,6 +14,15 @@ resource "google_bigquery_table" "iot_events_analyzed" {
   schema              = file("${var.path_to_schema}/iot_events_analyzed.json")
 }
 
+resource "google_bigquery_table" "device_windows" {
+  deletion_protection = false
+  project             = var.project_id
+  dataset_id          = google_bigquery_dataset.dataset.dataset_id
+  table_id            = "device_windows"
+  schema              = file("${var.path_to_schema}/device_windows.json")
+  clustering          = ["deviceId"]
+}
+
 resource "google_bigquery_dataset" "dataset" {
   dataset_id = "${var.resource_prefix}_iot"
   location   = var.region
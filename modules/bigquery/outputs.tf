@@ -28,6 +28,11 @@ output "id_table_iot_events_analyzed" {
   description = "BigQuery analyzed iot events table ID"
 }
 
+output "id_table_device_windows" {
+  value = google_bigquery_table.device_windows.table_id
+  description = "BigQuery table ID of the latest readings per device"
+}
+
 output "id_job" {
   value = google_bigquery_job.load_data_from_gcs.id
   description = "Job ID"
@@ -9,7 +9,10 @@ resource "google_project_iam_member" "bigquery_dataeditor" {
   member  = "serviceAccount:${google_service_account.iot_events.email}"
 }
 
+# event: a function invocation per Pub/Sub message inserting its rows,
+# batch: a function pulling the messages every minute and appending them through the Storage Write API
 resource "google_cloudfunctions_function" iot_events_to_bq {
+  count                 = var.ingest_mode == "event" ? 1 : 0
   depends_on            = [google_project_iam_member.bigquery_dataeditor]
   name                  = "${var.resource_prefix}-iot-events-to-bq"
   region                = var.region
@@ -33,3 +36,78 @@ resource "google_cloudfunctions_function" iot_events_to_bq {
   }
   ingress_settings      = "ALLOW_ALL"
 }
+
+resource "google_pubsub_subscription" iot_events_to_bq {
+  count                = var.ingest_mode == "batch" ? 1 : 0
+  name                 = "${var.resource_prefix}-iot-metrics-bq-subscription"
+  topic                = var.topic_metrics
+  # messages are acknowledged once their rows are appended, within seconds of the pull
+  ack_deadline_seconds = 60
+}
+
+resource "google_pubsub_subscription_iam_member" "subscriber" {
+  count        = var.ingest_mode == "batch" ? 1 : 0
+  subscription = google_pubsub_subscription.iot_events_to_bq[0].name
+  role         = "roles/pubsub.subscriber"
+  member       = "serviceAccount:${google_service_account.iot_events.email}"
+}
+
+resource "google_project_iam_member" "function_invoker" {
+  count   = var.ingest_mode == "batch" ? 1 : 0
+  project = var.project_id
+  role    = "roles/cloudfunctions.invoker"
+  member  = "serviceAccount:${google_service_account.iot_events.email}"
+}
+
+resource "google_cloudfunctions_function" iot_events_to_bq_batch {
+  count                 = var.ingest_mode == "batch" ? 1 : 0
+  depends_on            = [google_project_iam_member.bigquery_dataeditor, google_pubsub_subscription_iam_member.subscriber]
+  name                  = "${var.resource_prefix}-iot-events-to-bq-batch"
+  region                = var.region
+  runtime               = "python310"
+  timeout               = 60
+  available_memory_mb   = 256
+  source_archive_bucket = var.bucket
+  source_archive_object = "functions/iotBigQueryEvents.zip"
+  entry_point           = "iot_events_to_bq_batch"
+  service_account_email = google_service_account.iot_events.email
+  trigger_http          = true
+  environment_variables = {
+    table_id      = var.table_id
+    project_id    = var.project_id
+    dataset       = var.dataset_id
+    date_point    = "2011-08-03T23:25:01"
+    interval_sec  = 60
+    ts_format     = "%Y-%m-%dT%H:%M:%S"
+    subscription  = google_pubsub_subscription.iot_events_to_bq[0].id
+    max_rows      = 5000
+    max_bytes     = 5242880
+    max_age       = 5
+    # drains the subscription until the next scheduled call, a pull of up to max_age seconds and a flush
+    # of up to flush_time seconds are only started if they end within max_runtime, under the timeout
+    max_runtime   = 50
+    flush_time    = 10
+    write_stream  = "default"
+    # a MERGE per flush, one more reading than the detector input, the current one may be ingested before it is scored
+    windows_table = var.table_id_windows
+    window_size   = 25
+  }
+  ingress_settings      = "ALLOW_ALL"
+}
+
+resource "google_cloud_scheduler_job" "iot_events_to_bq_batch" {
+  count            = var.ingest_mode == "batch" ? 1 : 0
+  depends_on       = [google_cloudfunctions_function.iot_events_to_bq_batch, google_project_iam_member.function_invoker]
+  name             = google_cloudfunctions_function.iot_events_to_bq_batch[0].name
+  schedule         = "* * * * *"
+  attempt_deadline = "90s"
+
+  http_target {
+    http_method = "POST"
+    uri         = google_cloudfunctions_function.iot_events_to_bq_batch[0].https_trigger_url
+
+    oidc_token {
+      service_account_email = google_service_account.iot_events.email
+    }
+  }
+}
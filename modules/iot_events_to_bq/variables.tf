@@ -25,3 +25,17 @@ variable "region" {
 variable "dataset_id" {
   type = string
 }
+
+variable "table_id_windows" {
+  type = string
+}
+
+variable "ingest_mode" {
+  description = "event to insert the rows of every message by a Pub/Sub triggered function, batch to pull the messages every minute and append them through the BigQuery Storage Write API"
+  type        = string
+  default     = "event"
+  validation {
+    condition     = contains(["event", "batch"], var.ingest_mode)
+    error_message = "Ingest mode must be event or batch."
+  }
+}
@@ -116,7 +116,7 @@ resource "local_file" "prepare_for_mqtt_client" {
     command = "gcloud compute scp ${var.path_module}/template/*.pem ${var.name_client}:~/ --project ${var.project_id} --zone ${var.zone}"
   }
   provisioner "local-exec" {
-    command = "gcloud compute scp ${local_file.prepare_for_mqtt_client.filename} ${var.path_module}/mqtt_client/client.py ${var.name_client}:~/ --project ${var.project_id} --zone ${var.zone}"
+    command = "gcloud compute scp ${local_file.prepare_for_mqtt_client.filename} ${var.path_module}/mqtt_client/client.py ${var.path_module}/../functions/common/reading.py ${var.path_module}/mqtt_client/replay.py ${var.name_client}:~/ --project ${var.project_id} --zone ${var.zone}"
   }
   provisioner "local-exec" {
     command = "gcloud compute ssh ${var.name_client} --project ${var.project_id} --zone ${var.zone} --ssh-flag='-T' -- 'curl https://pki.goog/roots.pem >> ~/root.pem'"
@@ -9,24 +9,12 @@ resource "google_project_iam_member" "storage_admin" {
   member  = "serviceAccount:${google_service_account.detect_anomaly_trainer_vertex.email}"
 }
 
-resource "google_project_iam_member" "artifactregistry_writer" {
-  project = var.project_id
-  role    = "roles/artifactregistry.writer"
-  member  = "serviceAccount:${google_service_account.detect_anomaly_trainer_vertex.email}"
-}
-
 resource "google_project_iam_member" "aiplatform_user" {
   project = var.project_id
   role    = "roles/aiplatform.user"
   member  = "serviceAccount:${google_service_account.detect_anomaly_trainer_vertex.email}"
 }
 
-resource "google_project_iam_member" "cloud_build" {
-  project = var.project_id
-  role    = "roles/cloudbuild.builds.builder"
-  member  = "serviceAccount:${google_service_account.detect_anomaly_trainer_vertex.email}"
-}
-
 resource "google_project_iam_member" "sa_user" {
   project = var.project_id
   role    = "roles/iam.serviceAccountUser"
@@ -62,12 +50,12 @@ resource "google_cloudfunctions2_function" train_detect_anomaly_vertex {
       training_package = "anomaly-detection/dist/ts-anomaly-detection-trainer-0.1.1.tar.gz"
       data_location    = "data/export_bq"
       pipeline_root    = "AnomalyDetectionPipelineRoot"
-      repository       = "${var.docker_registry}/gd-vertexai-anomaly-detector"
       region           = var.region
       resource_prefix  = var.resource_prefix
       endpoint_name    = var.endpoint_name
       table_id         = var.table_id
       dataset          = var.dataset_id
+      trainer_solver   = var.trainer_solver
     }
   }
 }
@@ -37,3 +37,13 @@ variable "table_id" {
 variable "path_module" {
   type = string
 }
+
+variable "trainer_solver" {
+  description = "Solver of the linear detector, sgd epochs, or lstsq and huber in closed form"
+  type        = string
+  default     = "sgd"
+  validation {
+    condition     = contains(["sgd", "lstsq", "huber"], var.trainer_solver)
+    error_message = "Trainer solver must be sgd, lstsq or huber."
+  }
+}
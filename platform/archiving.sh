@@ -2,8 +2,13 @@
 
 cd ${1}/functions
 for dir in * ; do
+    # modules shared by the functions, packed into every function archive
+    if [ "$dir" == "common" ]; then
+        continue
+    fi
     cd $dir
     zip $dir.zip *
+    zip -j $dir.zip ../common/*.py
     gsutil cp $dir.zip ${2}/functions/
     cd ../
 done
@@ -0,0 +1,68 @@
+"""TimeSeriesDataset construction time and peak RSS: strided windows vs. the former per-row slicing.
+
+Every implementation runs in its own process so that peak RSS is not shared between them.
+The per-row implementation is quadratic in Python objects, so it runs on `--legacy-points` by default:
+
+    python3 benchmarks/bench_dataset_windowing.py --points 10000000 --legacy-points 500000
+"""
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'vertex-ai', 'anomaly-detection'))
+
+from trainer.data import TimeSeriesDataset  # noqa: E402
+
+
+class LegacyTimeSeriesDataset(TimeSeriesDataset):
+    """Windowing as it was done before: a pandas slice per row and a scalar lookup per label"""
+
+    def __init__(self, series: pd.Series, points_before: int):
+        self.points_before = points_before
+        self.difference = False
+        self.recurrent = False
+        self.part = None
+        self.ts = series.copy()
+        self.ts.index = pd.to_datetime(self.ts.index)
+        self.preprocess_data()
+        self.rows = np.array([self.ts.iloc[i-points_before:i] for i in range(points_before, len(self.ts))])
+        self.labels = [self.ts.iloc[i] for i in range(points_before, len(self.ts))]
+        self.include_date_features = False
+
+
+def parse_command_line_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--points", type=int, default=10_000_000, help="Series length for strided windows")
+    parser.add_argument("--legacy-points", type=int, default=500_000, help="Series length for per-row slicing")
+    parser.add_argument("--window", type=int, default=24, help="Points before, i.e. the model input size")
+    parser.add_argument("--impl", choices=["strided", "legacy"], help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def run_one(impl: str, points: int, window: int) -> None:
+    series = pd.Series(np.random.default_rng(42).normal(size=points),
+                       index=pd.date_range('2022-01-01', periods=points, freq='min'))
+    baseline_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    dataset = (TimeSeriesDataset if impl == 'strided' else LegacyTimeSeriesDataset)(series, window)
+    train, test = dataset.split(.75)
+    elapsed = time.perf_counter() - start
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f"{impl:<8} {points:>11,} points  {elapsed:8.2f} s  {elapsed / points * 1e6:8.3f} us/point"
+          f"  peak RSS {peak_kb / 1024:9.1f} MiB  (+{(peak_kb - baseline_kb) / 1024:.1f} MiB over input)")
+
+
+if __name__ == '__main__':
+    args = parse_command_line_args()
+    if args.impl is not None:
+        run_one(args.impl, args.points, args.window)
+    else:
+        for impl, points in (('strided', args.points), ('legacy', args.legacy_points)):
+            subprocess.run([sys.executable, __file__, '--impl', impl, '--points', str(points),
+                            '--window', str(args.window)], check=True)
@@ -0,0 +1,81 @@
+"""Per-event client setup overhead of detectAnomalyVertex: clients built on every event vs. the shared registry.
+
+Clients are replaced with local stand-ins that only simulate construction and control-plane latency,
+so the benchmark needs the function requirements installed but neither credentials nor network:
+
+    python3 benchmarks/bench_function_clients.py --events 200
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'functions', 'detectAnomalyVertex'))
+
+from clients import ClientsRegistry  # noqa: E402
+
+
+def parse_command_line_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--events", type=int, default=200, help="Number of simulated events")
+    parser.add_argument("--client-ms", type=float, default=40.,
+                        help="Simulated construction latency of every client, ms")
+    parser.add_argument("--list-ms", type=float, default=250.,
+                        help="Simulated latency of the Endpoint.list control-plane call, ms")
+    return parser.parse_args()
+
+
+def stand_in(latency_ms: float):
+    class StandInClient():
+        def __init__(self, *args, **kwargs) -> None:
+            time.sleep(latency_ms / 1000)
+
+        def setup_logging(self) -> None:
+            pass
+
+    return StandInClient
+
+
+def make_registry(args) -> ClientsRegistry:
+    def resolve(endpoint_name):
+        time.sleep(args.list_ms / 1000)
+        return endpoint_name
+
+    return ClientsRegistry(
+        project_id='benchmark',
+        log_client_factory=stand_in(args.client_ms),
+        bigquery_factory=stand_in(args.client_ms),
+        device_manager_factory=stand_in(args.client_ms),
+        endpoint_resolver=resolve,
+        init_aiplatform=lambda **kwargs: time.sleep(args.client_ms / 1000))
+
+
+def handle_event(clients: ClientsRegistry) -> None:
+    clients.setup_logging()
+    clients.bigquery
+    clients.device_manager
+    clients.get_endpoint('anomaly-kfp')
+
+
+def measure(args, shared: bool):
+    clients = make_registry(args)
+    latencies = []
+    for _ in range(args.events):
+        start = time.perf_counter()
+        handle_event(clients if shared else make_registry(args))
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+def report(name, latencies):
+    latencies = sorted(latencies)
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * .99))]
+    print(f"{name:<22} mean {statistics.mean(latencies):8.2f} ms   p50 {statistics.median(latencies):8.2f} ms"
+          f"   p99 {p99:8.2f} ms")
+
+
+if __name__ == '__main__':
+    args = parse_command_line_args()
+    report('per-event clients', measure(args, shared=False))
+    report('shared registry', measure(args, shared=True))
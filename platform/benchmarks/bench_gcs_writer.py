@@ -0,0 +1,94 @@
+"""Rows/s and bytes written by the Dataflow WriteToGCS: streaming Arrow writer vs. the former
+`pa.Table.from_pylist` + `ds.write_dataset` of the whole batch.
+
+Both write into a local temporary directory, so only conversion and encoding are measured:
+
+    python3 benchmarks/bench_gcs_writer.py --rows 1000000 --devices 100
+"""
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'dataflow', 'pubsubGcs'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'functions', 'common'))
+
+from apache_beam.transforms.window import IntervalWindow  # noqa: E402
+
+from pubsub_to_gcs import WriteToGCS  # noqa: E402
+
+
+class LegacyWriteToGCS(WriteToGCS):
+    """Writing as it was done before: the whole batch converted from a list of dicts with inferred types"""
+
+    def setup(self):
+        pass
+
+    def process(self, key_value, window):
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+        ts_format = "%H:%M:%S"
+        window_start = window.start.to_utc_datetime().strftime(ts_format)
+        window_end = window.end.to_utc_datetime().strftime(ts_format)
+        shard_id, batch = key_value
+        table = pa.Table.from_pylist(batch)
+        ds.write_dataset(
+            data=table, base_dir=self.output_path, format=self.output_format,
+            partitioning=list(self.PARTITIONS),
+            basename_template=f'part_{window_start}-{window_end}_{shard_id}_{{i}}.{self.output_format}',
+            partitioning_flavor='hive',
+            existing_data_behavior='overwrite_or_ignore')
+
+
+def parse_command_line_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1_000_000, help="Rows in the written batch")
+    parser.add_argument("--devices", type=int, default=100, help="Number of distinct devices")
+    parser.add_argument("--format", choices=["parquet", "csv"], default="parquet", help="Output files format")
+    parser.add_argument("--compression", default="snappy", help="Parquet compression of the streaming writer")
+    parser.add_argument("--impl", choices=["streaming", "legacy"], help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def make_batch(rows: int, devices: int):
+    return [dict(deviceId=f'device-{i % devices:05}', year=2022, month=10, day=25,
+                 departament_id=None, product_id=None,
+                 timestamp=f'2022-10-25 {i // 3600 % 24:02}:{i // 60 % 60:02}:{i % 60:02}', value=i * 0.5)
+            for i in range(rows)]
+
+
+def directory_size(path: str) -> int:
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def run_one(args) -> None:
+    batch = make_batch(args.rows, args.devices)
+    window = IntervalWindow(0, 60)
+    with tempfile.TemporaryDirectory() as output_path:
+        if args.impl == 'streaming':
+            writer = WriteToGCS(output_path, args.format, args.compression)
+        else:
+            writer = LegacyWriteToGCS(output_path, args.format)
+        writer.setup()
+        baseline_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.perf_counter()
+        writer.process(('0-0000', batch), window)
+        elapsed = time.perf_counter() - start
+        peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        written = directory_size(output_path)
+    print(f"{args.impl:<9} {args.format:<7} {args.rows:>10,} rows  {args.rows / elapsed:12,.0f} rows/s"
+          f"  {written / 1024 / 1024:8.2f} MiB written  +{(peak_kb - baseline_kb) / 1024:.1f} MiB peak RSS")
+
+
+if __name__ == '__main__':
+    args = parse_command_line_args()
+    if args.impl is not None:
+        run_one(args)
+    else:
+        for impl in ('streaming', 'legacy'):
+            subprocess.run([sys.executable, __file__, '--impl', impl, '--rows', str(args.rows),
+                            '--devices', str(args.devices), '--format', args.format,
+                            '--compression', args.compression], check=True)
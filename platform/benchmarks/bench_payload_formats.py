@@ -0,0 +1,80 @@
+"""Encode + decode + inference latency of a single prediction instance for every payload format.
+
+Encoding is done by detectAnomalyVertex `serialize_pd`, decoding by the predictor's `decode_values`,
+inference by the predictor's LinearModel:
+
+    python3 benchmarks/bench_payload_formats.py --iterations 2000
+"""
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import time
+from base64 import b64decode
+
+import numpy as np
+import pandas as pd
+import torch
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, os.path.join(ROOT, 'docker', 'vai-ad-tma', 'files'))
+
+from models import LinearModel  # noqa: E402
+
+
+def load_module(name: str, path: str):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+client_payload = load_module('client_payload', os.path.join('functions', 'detectAnomalyVertex', 'payload.py'))
+server_payload = load_module('server_payload', os.path.join('docker', 'vai-ad-tma', 'files', 'payload.py'))
+
+
+def parse_command_line_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=2000, help="Number of instances per format")
+    parser.add_argument("--input-size", type=int, default=24, help="Model input size")
+    parser.add_argument("--period", type=int, default=3600, help="Readings period, seconds")
+    return parser.parse_args()
+
+
+def measure(payload_format: str, series: pd.Series, model: LinearModel, args):
+    encode, decode, infer = [], [], []
+    with torch.no_grad():
+        for _ in range(args.iterations):
+            start = time.perf_counter()
+            instance = client_payload.serialize_pd(series, payload_format, args.period)[0]
+            encoded = time.perf_counter()
+            values = server_payload.decode_values(json.loads(b64decode(instance['data']['b64'])))
+            decoded = time.perf_counter()
+            model(torch.from_numpy(values[:args.input_size].reshape((1, args.input_size))).float())
+            inferred = time.perf_counter()
+            encode.append(encoded - start)
+            decode.append(decoded - encoded)
+            infer.append(inferred - decoded)
+    size = len(instance['data']['b64'])
+    return size, encode, decode, infer
+
+
+def percentiles(latencies):
+    return np.percentile(np.array(latencies) * 1e6, [50, 99])
+
+
+if __name__ == '__main__':
+    args = parse_command_line_args()
+    series = pd.Series(np.random.default_rng(42).normal(size=args.input_size + 1),
+                       index=pd.date_range('2022-10-25', periods=args.input_size + 1,
+                                           freq=f'{args.period}s', tz='UTC'))
+    model = LinearModel(args.input_size)
+    model.eval()
+    print(f"{'format':<8} {'bytes':>6}   {'encode p50/p99 us':>18}   {'decode p50/p99 us':>18}"
+          f"   {'infer p50/p99 us':>17}   {'total p50 us':>12}")
+    for payload_format in client_payload.PAYLOAD_FORMATS:
+        size, encode, decode, infer = measure(payload_format, series, model, args)
+        total = percentiles(np.array(encode) + np.array(decode) + np.array(infer))[0]
+        stages = '   '.join(f"{p50:8.1f}/{p99:8.1f}" for p50, p99 in map(percentiles, (encode, decode, infer)))
+        print(f"{payload_format:<8} {size:>6}   {stages}   {total:12.1f}")
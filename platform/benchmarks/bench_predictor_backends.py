@@ -0,0 +1,93 @@
+"""Startup time, peak RSS and per-request latency of the torch Predictor vs. NumpyPredictor.
+
+Artifacts are produced by the trainer's own export on a small random series, every backend then runs
+in its own process, so that startup includes imports and RSS is not shared:
+
+    python3 benchmarks/bench_predictor_backends.py --requests 5000
+"""
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+PREDICTOR_DIR = os.path.join(ROOT, 'docker', 'vai-ad-tma', 'files')
+
+
+def parse_command_line_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=5000, help="Number of single-instance predictions")
+    parser.add_argument("--backend", choices=["torch", "numpy"], help=argparse.SUPPRESS)
+    parser.add_argument("--model-dir", help=argparse.SUPPRESS)
+    parser.add_argument("--export", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def export_artifacts(model_dir: str) -> None:
+    import pandas as pd
+    import torch
+    from torch import nn
+    from torch.utils.data import DataLoader
+    sys.path.insert(0, os.path.join(ROOT, 'vertex-ai', 'anomaly-detection'))
+    from trainer.data import TimeSeriesDataset
+    from trainer.models import LinearModel
+    from trainer.trainer import Trainer
+
+    series = pd.Series(np.random.default_rng(42).normal(size=1000),
+                       index=pd.date_range('2022-10-25', periods=1000, freq='h', tz='UTC'))
+    train, test = TimeSeriesDataset(series, 24).split(.75)
+    model = LinearModel(24)
+    trainer = Trainer(experiment_name=model_dir, model=model, optimizer=torch.optim.SGD(model.parameters(), lr=1e-3),
+                      loss=nn.HuberLoss(), parameters=dict(), train_loader=DataLoader(train, batch_size=8),
+                      val_loader=DataLoader(test, batch_size=8))
+    trainer.train(1)
+    os.replace(os.path.join(model_dir, 'checkpoint0000.pt'), os.path.join(model_dir, 'pytorch_model.bin'))
+
+
+def run_one(backend: str, model_dir: str, requests: int) -> None:
+    start = time.perf_counter()
+    sys.path.insert(0, PREDICTOR_DIR)
+    if backend == 'numpy':
+        from numpy_predictor import NumpyPredictor
+        predictor = NumpyPredictor(model_dir)
+        assert 'torch' not in sys.modules, "NumPy backend must not import torch"
+    else:
+        from predictor import Predictor
+        predictor = Predictor(model_dir)
+        predictor.eval()
+    startup = time.perf_counter() - start
+    inputs = np.random.default_rng(0).normal(size=(requests, predictor.config['input_size']))
+    latencies = np.empty(requests)
+    outputs = np.empty(requests)
+    for i in range(requests):
+        request_start = time.perf_counter()
+        outputs[i] = predictor.predict(inputs[i:i + 1])[0]
+        latencies[i] = time.perf_counter() - request_start
+    p50, p99 = np.percentile(latencies * 1e6, [50, 99])
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{backend:<6} startup {startup * 1000:8.1f} ms   peak RSS {peak_mb:7.1f} MiB"
+          f"   p50 {p50:7.1f} us   p99 {p99:7.1f} us")
+    np.save(os.path.join(model_dir, f'outputs_{backend}.npy'), outputs)
+
+
+if __name__ == '__main__':
+    args = parse_command_line_args()
+    if args.export is not None:
+        export_artifacts(args.export)
+    elif args.backend is not None:
+        run_one(args.backend, args.model_dir, args.requests)
+    else:
+        with tempfile.TemporaryDirectory() as model_dir:
+            # Exporting in a separate process too, so that torch is not loaded by the parent
+            subprocess.run([sys.executable, __file__, '--export', model_dir], check=True, stdout=subprocess.DEVNULL)
+            for backend in ('torch', 'numpy'):
+                subprocess.run([sys.executable, __file__, '--backend', backend, '--model-dir', model_dir,
+                                '--requests', str(args.requests)], check=True)
+            difference = np.abs(np.load(os.path.join(model_dir, 'outputs_torch.npy'))
+                                - np.load(os.path.join(model_dir, 'outputs_numpy.npy'))).max()
+            print(f"max abs difference of outputs: {difference:.3g}")
@@ -0,0 +1,81 @@
+"""Wall time and validation loss of the SGD training loop vs. the closed form solvers of the linear detector.
+
+All solvers fit the same LinearModel on the same hourly-like series with outliers and are scored with the same
+`Trainer.validate`, i.e. the Huber loss on the validation windows. `--loader dataloader` runs SGD
+with the former torch DataLoader instead of the TensorLoader:
+
+    python3 benchmarks/bench_trainer_solvers.py --points 100000 --epochs 100
+    python3 benchmarks/bench_trainer_solvers.py --solvers sgd --batch-size 256 --learning-rate 1e-3 --loader dataloader
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+from torch import nn
+from torch.utils.data import DataLoader
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'vertex-ai', 'anomaly-detection'))
+
+from trainer.data import TensorLoader, TimeSeriesDataset  # noqa: E402
+from trainer.models import LinearModel  # noqa: E402
+from trainer.trainer import Trainer  # noqa: E402
+
+
+def parse_command_line_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--points", type=int, default=100_000, help="Series length")
+    parser.add_argument("--window", type=int, default=24, help="Points before, i.e. the model input size")
+    parser.add_argument("--epochs", type=int, default=100, help="Maximum number of SGD epochs")
+    parser.add_argument("--batch-size", type=int, default=8, help="SGD batch size, as in the trainer task")
+    parser.add_argument("--learning-rate", type=float, default=1e-4, help="SGD learning rate, as in the pipeline")
+    parser.add_argument("--loader", choices=['tensor', 'dataloader'], default='tensor',
+                        help="TensorLoader as in the trainer task or the former torch DataLoader")
+    parser.add_argument("--solvers", nargs='+', default=['sgd', 'lstsq', 'huber'],
+                        choices=['sgd', 'lstsq', 'huber'])
+    return parser.parse_args()
+
+
+def make_series(points: int) -> pd.Series:
+    rng = np.random.default_rng(42)
+    t = np.arange(points)
+    values = 10 + 3 * np.sin(2 * np.pi * t / 24) + np.sin(2 * np.pi * t / (24 * 7)) + rng.normal(0, .3, points)
+    # sparse spikes, which the Huber loss is meant to be robust to
+    spikes = rng.random(points) < .005
+    values[spikes] += rng.normal(0, 8, spikes.sum())
+    return pd.Series(values, index=pd.date_range('2022-01-01', periods=points, freq='h'))
+
+
+def run_one(solver: str, train, test, args, folder: str):
+    torch.manual_seed(42)
+    loader = TensorLoader if args.loader == 'tensor' else DataLoader
+    train_loader = loader(train, batch_size=args.batch_size, shuffle=True, drop_last=True)
+    val_loader = loader(test, batch_size=args.batch_size, shuffle=False, drop_last=True)
+    model = LinearModel(args.window)
+    optim = torch.optim.SGD(model.parameters(), lr=args.learning_rate, momentum=0.9)
+    trainer = Trainer(experiment_name=os.path.join(folder, solver), model=model, optimizer=optim,
+                      loss=nn.HuberLoss(), parameters=dict(), train_loader=train_loader, val_loader=val_loader)
+    start = time.perf_counter()
+    if solver == 'sgd':
+        trainer.train(args.epochs)
+    else:
+        trainer.fit_linear(solver)
+    elapsed = time.perf_counter() - start
+    return elapsed, trainer.epoch + 1, trainer.history['val_loss'][trainer.best_epoch]
+
+
+if __name__ == '__main__':
+    args = parse_command_line_args()
+    dataset = TimeSeriesDataset(make_series(args.points), args.window)
+    train, test = dataset.split(.75)
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        for solver in args.solvers:
+            results.append((solver, *run_one(solver, train, test, args, folder)))
+    print(f"\n{'solver':<8} {'wall time':>11} {'epochs':>7} {'best val loss':>14}")
+    for solver, elapsed, epochs, val_loss in results:
+        print(f"{solver:<8} {elapsed:9.2f} s {epochs:>7} {val_loss:14.6f}")
@@ -0,0 +1,142 @@
+"""Checks that detectAnomalyVertex scores a micro-batch of readings as it scores them one event at a time.
+
+Readings of two devices are interleaved with readings already ingested into the events table, which is
+replaced with a local stand-in, as is the endpoint. The function requirements are needed, credentials are not:
+
+    python3 benchmarks/check_detect_anomalies_batch.py
+"""
+import json
+import os
+import re
+import sys
+from base64 import b64decode
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'functions', 'detectAnomalyVertex'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'functions', 'common'))
+
+from pandas import DataFrame, Timedelta, Timestamp, to_datetime  # noqa: E402
+
+from main import PubSubDataProcessor  # noqa: E402
+from readings_cache import ReadingsCache  # noqa: E402
+
+INPUT_SIZE = 3
+PERIOD = 60
+START = Timestamp('2022-10-25T10:00:00', tz='UTC')
+
+
+class StandInQueryJob():
+    def __init__(self, rows: DataFrame) -> None:
+        self.rows = rows
+
+    def result(self):
+        return self
+
+    def to_dataframe(self) -> DataFrame:
+        return self.rows.reset_index(drop=True)
+
+
+class StandInBigQuery():
+    """Events table answering the history queries of the function"""
+
+    def __init__(self, events: DataFrame) -> None:
+        self.events = events
+
+    def query(self, query: str, job_config=None) -> StandInQueryJob:
+        params = {param.name: param for param in job_config.query_parameters}
+        interval = Timedelta(seconds=int(re.search(r'INTERVAL (\d+) SECOND', query).group(1)))
+        events = self.events
+        if 'ids' in params:
+            start = to_datetime(params['min_timestamp'].value, utc=True) - interval
+            end = to_datetime(params['max_timestamp'].value, utc=True)
+            rows = events[events['deviceId'].isin(params['ids'].values)]
+            columns = ['deviceId', 'timestamp', 'value']
+        else:
+            end = to_datetime(re.search(r'timestamp\("([^"]+)"\)', query).group(1), utc=True)
+            start = end - interval
+            rows = events[events['deviceId'] == params['device_id'].value]
+            columns = ['timestamp', 'value']
+        rows = rows[(rows['timestamp'] >= start) & (rows['timestamp'] < end)]
+        return StandInQueryJob(rows.sort_values(['deviceId', 'timestamp'])[columns])
+
+
+class StandInEndpoint():
+    """Predicts the mean of the window, a reading further than 1 from it is an anomaly"""
+
+    def predict(self, instances):
+        predictions = []
+        for instance in instances:
+            values = json.loads(b64decode(instance['data']['b64']))['values']
+            possible = sum(values[:-1]) / len(values[:-1])
+            predictions.append([int(abs(values[-1] - possible) > 1), possible, values[-1], possible - 1, possible + 1])
+        return type('Prediction', (), {'predictions': predictions})
+
+
+class StandInClients():
+    def __init__(self, events: DataFrame) -> None:
+        self.bigquery = StandInBigQuery(events)
+        self.endpoint = StandInEndpoint()
+
+    def get_endpoint(self, endpoint_name: str) -> StandInEndpoint:
+        return self.endpoint
+
+    def invalidate_endpoint(self, endpoint_name: str) -> None:
+        pass
+
+
+def make_processor(events: DataFrame, device_id=None, cache=None) -> PubSubDataProcessor:
+    return PubSubDataProcessor(
+        project_id='check', cloud_region='local', registry_id='registry', device_id=device_id, period=PERIOD,
+        dataset='dataset', endpoint_name='anomaly-kfp', input_size=INPUT_SIZE, table_id='events',
+        destination_table='analyzed', clients=StandInClients(events), cache=cache, payload_format='array')
+
+
+def events_and_batch():
+    """Events table with the readings of `device-a` and `device-b` every minute, and a batch with some of them.
+    The readings of minutes 4 and 6 of `device-a` were delivered in other messages, between the batch ones"""
+    rows = []
+    for device_id, values in [('device-a', [1, 1, 1, 1, 1, 4, 1, 1]), ('device-b', [0, 0, 0, 0, 3, 0, 0, 0])]:
+        rows.extend((device_id, START + Timedelta(minutes=i), float(value)) for i, value in enumerate(values))
+    events = DataFrame(rows, columns=['deviceId', 'timestamp', 'value'])
+    batch = [(device_id, str(timestamp), value) for device_id, timestamp, value in rows
+             if timestamp >= START + Timedelta(minutes=3)
+             and not (device_id == 'device-a' and timestamp in (START + Timedelta(minutes=4),
+                                                                START + Timedelta(minutes=6)))]
+    # interleaved as published by several devices
+    batch.sort(key=lambda reading: (reading[1], reading[0]))
+    return events, batch
+
+
+def single_results(events: DataFrame, batch, with_cache: bool):
+    """Results of the readings processed one event at a time, in their order"""
+    caches = {}
+    results = []
+    for device_id, timestamp, value in batch:
+        cache = caches.setdefault(device_id, ReadingsCache(INPUT_SIZE, PERIOD)) if with_cache else None
+        try:
+            results.append(make_processor(events, device_id, cache).detect_anomaly(timestamp, value))
+        except ValueError:
+            results.append(None)
+    return results
+
+
+def check(with_cache: bool) -> None:
+    events, batch = events_and_batch()
+    cache = ReadingsCache(INPUT_SIZE, PERIOD) if with_cache else None
+    batch_results = make_processor(events, cache=cache).detect_anomalies(batch)
+    expected = single_results(events, batch, with_cache)
+    assert len(batch_results) == len(expected)
+    for reading, result, single in zip(batch, batch_results, expected):
+        if single is None or result is None:
+            assert single is None and result is None, f"{reading}: {result} != {single}"
+            continue
+        assert result[1] == single[1] and result[0].equals(single[0]), f"{reading}: {result} != {single}"
+    scored = sum(result is not None for result in batch_results)
+    anomalies = sum(result is not None and result[1] for result in batch_results)
+    assert scored == len(batch), f"{len(batch) - scored} readings not scored"
+    print(f"detect_anomalies {'with' if with_cache else 'without'} cache: {scored} readings scored, "
+          f"{anomalies} anomalies, as one event at a time")
+
+
+if __name__ == '__main__':
+    check(with_cache=False)
+    check(with_cache=True)
@@ -0,0 +1,123 @@
+"""DirectRunner checks of the Dataflow pipeline: Pub/Sub messages as published by the mqtt client
+run through the windowing and WriteToGCS, the files written are read back and compared, and a TestStream
+of two devices runs through DetectAnomalies with a small model.npz:
+
+    python3 benchmarks/check_pubsub_to_gcs.py
+"""
+import glob
+import json
+import os
+import struct
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'dataflow', 'pubsubGcs'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'functions', 'common'))
+
+import numpy as np  # noqa: E402
+import pyarrow.csv as pcsv  # noqa: E402
+import pyarrow.parquet as pq  # noqa: E402
+from apache_beam import Create, Map, ParDo, Pipeline  # noqa: E402
+from apache_beam.io.gcp.pubsub import PubsubMessage  # noqa: E402
+from apache_beam.options.pipeline_options import PipelineOptions, StandardOptions  # noqa: E402
+from apache_beam.testing.test_stream import TestStream  # noqa: E402
+from apache_beam.testing.util import assert_that  # noqa: E402
+from apache_beam.transforms.window import TimestampedValue  # noqa: E402
+
+from pubsub_to_gcs import DetectAnomalies, GroupMessagesByFixedWindows, WriteToGCS  # noqa: E402
+
+# 2022-10-25T10:00:00Z, publish time of the first message
+START = 1666692000
+
+
+def json_message(device_id, timestamp, value):
+    """A single reading published in JSON, the value is a string as `Client.get_reading` returns it"""
+    data = json.dumps({'timestamp': timestamp, 'value': value}).encode('utf-8')
+    return PubsubMessage(data, {'deviceId': device_id})
+
+
+def json_batch_message(device_id, readings):
+    data = json.dumps({'readings': readings}).encode('utf-8')
+    return PubsubMessage(data, {'deviceId': device_id})
+
+
+def binary_message(device_id, epoch, value):
+    return PubsubMessage(struct.pack('<Bqd', 1, epoch, value), {'deviceId': device_id, 'subFolder': 'binary'})
+
+
+def pipeline_options(output_dir):
+    # JobOptions of the pipeline module are registered and their required arguments parsed as well
+    return PipelineOptions(['--runner', 'DirectRunner', '--input_subscription', 'unused', '--output_path', output_dir])
+
+
+def messages():
+    return [
+        json_message('device-1', '2022-10-25T10:00:00', '2.09'),
+        json_message('device-2', '2022-10-25T10:00:01', '-1.5'),
+        json_batch_message('device-1', [['2022-10-25T10:00:02', '2.5'], ['2022-10-25T10:00:03', 3]]),
+        binary_message('device-2', START + 4, 4.25),
+    ]
+
+
+def read_values(output_dir, output_format):
+    rows = []
+    for file in glob.glob(os.path.join(output_dir, '**', f'*.{output_format}'), recursive=True):
+        table = pq.read_table(file) if output_format == 'parquet' else pcsv.read_csv(file)
+        rows.extend(zip(table.column('deviceId').to_pylist(), table.column('value').to_pylist()))
+    return sorted(rows)
+
+
+def check_write(output_format):
+    with tempfile.TemporaryDirectory() as output_dir:
+        with Pipeline(options=pipeline_options(output_dir)) as pipeline:
+            (
+                pipeline
+                | Create([(i, message) for i, message in enumerate(messages())])
+                | Map(lambda item: TimestampedValue(item[1], START + item[0]))
+                | GroupMessagesByFixedWindows(1.0)
+                | ParDo(WriteToGCS(output_dir, output_format))
+            )
+        values = read_values(output_dir, output_format)
+    expected = [('device-1', 2.09), ('device-1', 2.5), ('device-1', 3.0), ('device-2', -1.5), ('device-2', 4.25)]
+    assert values == expected, f"{output_format}: {values} != {expected}"
+    print(f"WriteToGCS {output_format}: {len(values)} JSON and binary readings written as float values")
+
+
+def check_detect_anomalies():
+    """Device `device-a` has a spike scored as an anomaly, as well as the reading after it, `device-b` is flat.
+    Readings of the devices are interleaved, so the history of each one must be kept per device. `device-c`
+    is offline for 3 minutes, longer than the period, so its last reading is not scored on the stale ones"""
+    with tempfile.TemporaryDirectory() as folder:
+        # the detector predicts the mean of the last 3 normalized values, with bounds of +-1
+        model_path = os.path.join(folder, 'model.npz')
+        np.savez(model_path, weight=np.full((1, 3), 1 / 3, dtype=np.float32), bias=np.zeros(1, dtype=np.float32),
+                 mean=0., std=1., bounds=np.array([-1., 1.]), input_size=3, period=60)
+        stream = TestStream().advance_watermark_to(START)
+        for i, value in enumerate([1, 1, 1, 1, 5, 1]):
+            timestamp = f'2022-10-25T10:{i:02}:00'
+            stream = stream.add_elements([
+                TimestampedValue(json_message('device-a', timestamp, str(value)), START + 60 * i),
+                TimestampedValue(json_message('device-b', timestamp, '0'), START + 60 * i)])
+            if i in (0, 1, 2, 5):
+                stream = stream.add_elements([
+                    TimestampedValue(json_message('device-c', timestamp, str(value)), START + 60 * i)])
+        stream = stream.advance_watermark_to_infinity()
+        options = pipeline_options(folder)
+        options.view_as(StandardOptions).streaming = True
+
+        def check(rows):
+            flags = {}
+            for row in sorted(rows, key=lambda row: row['timestamp']):
+                flags.setdefault(row['deviceId'], []).append(row['is_anomaly'])
+            expected = {'device-a': [False, True, True], 'device-b': [False, False, False]}
+            assert flags == expected, f"{flags} != {expected}"
+
+        with Pipeline(options=options) as pipeline:
+            assert_that(pipeline | stream | DetectAnomalies(model_path), check)
+    print("DetectAnomalies: readings of interleaved devices scored on their own histories without gaps")
+
+
+if __name__ == '__main__':
+    check_write('csv')
+    check_write('parquet')
+    check_detect_anomalies()
@@ -1,80 +1,265 @@
 import json
 
-from apache_beam import (DoFn, GroupByKey, ParDo, Pipeline, PTransform,
+from apache_beam import (DoFn, Map, ParDo, Pipeline, PTransform,
                          WindowInto, WithKeys, io)
+from apache_beam.coders import PickleCoder, VarIntCoder
 from apache_beam.options.pipeline_options import PipelineOptions
+from apache_beam.transforms.timeutil import TimeDomain
+from apache_beam.transforms.userstate import BagStateSpec, ReadModifyWriteStateSpec, TimerSpec, on_timer
 from apache_beam.transforms.window import FixedWindows
 
+# functions/common/reading.py, copied next to the pipeline and staged with setup.py
+from reading import decode_readings, reading_epoch
+
 
 class GroupMessagesByFixedWindows(PTransform):
 
-    def __init__(self, window_size, num_shards=5):
+    def __init__(self, window_size, num_shards=5, max_file_rows=100000, max_file_size_mb=64):
         self.window_size = int(window_size * 60)
         self.num_shards = num_shards
+        self.max_file_rows = max_file_rows
+        self.max_file_size = int(max_file_size_mb * 1024 * 1024)
 
     def expand(self, pcoll):
-        import random
         return (
             pcoll
             | "Window into fixed intervals"
             >> WindowInto(FixedWindows(self.window_size))
             | "Add timestamp to windowed elements" >> ParDo(TransformMessage())
-            # Assign a random key to each windowed element based on the number of shards.
-            | "Add key" >> WithKeys(lambda _: random.randint(0, self.num_shards - 1))
-            | "Group by key" >> GroupByKey()
+            # Key readings of the same device to the same shard
+            | "Add key" >> ParDo(ShardByDevice(self.num_shards))
+            | "Roll files" >> ParDo(RollFiles(self.max_file_rows, self.max_file_size))
         )
 
 
+class ShardByDevice(DoFn):
+    """Keys readings by a stable hash of deviceId modulo `num_shards`.
+
+    The number of shards is fixed for the job, so every worker maps a device to the same shard, the files
+    of a busy shard are split by RollFiles instead.
+    """
+
+    def __init__(self, num_shards):
+        self.num_shards = num_shards
+
+    def process(self, element):
+        import zlib
+        yield zlib.crc32(str(element['deviceId']).encode('utf-8')) % self.num_shards, element
+
+
+class RollFiles(DoFn):
+    """Buffers the readings of a shard in state and emits a file batch when it reaches `max_rows` rows or
+    about `max_size` bytes, the rest is emitted when the window closes.
+
+    Emitted keys are `<shard>-<file number>`, so every batch of a window gets its own file name.
+    """
+    ROWS_STATE = BagStateSpec('rows', PickleCoder())
+    COUNT_STATE = ReadModifyWriteStateSpec('count', VarIntCoder())
+    SIZE_STATE = ReadModifyWriteStateSpec('size', VarIntCoder())
+    FILES_STATE = ReadModifyWriteStateSpec('files', VarIntCoder())
+    WINDOW_END_TIMER = TimerSpec('window_end', TimeDomain.WATERMARK)
+
+    def __init__(self, max_rows, max_size):
+        self.max_rows = max_rows
+        self.max_size = max_size
+
+    def process(self, element,
+                window=DoFn.WindowParam,
+                rows_state=DoFn.StateParam(ROWS_STATE),
+                count_state=DoFn.StateParam(COUNT_STATE),
+                size_state=DoFn.StateParam(SIZE_STATE),
+                files_state=DoFn.StateParam(FILES_STATE),
+                window_end_timer=DoFn.TimerParam(WINDOW_END_TIMER)):
+        shard, row = element
+        window_end_timer.set(window.max_timestamp())
+        rows_state.add(row)
+        count = (count_state.read() or 0) + 1
+        # serialized size is close enough to the size of the row in an output file
+        size = (size_state.read() or 0) + len(json.dumps(row, default=str))
+        count_state.write(count)
+        size_state.write(size)
+        if count >= self.max_rows or size >= self.max_size:
+            yield from self.flush(shard, rows_state, count_state, size_state, files_state)
+
+    @on_timer(WINDOW_END_TIMER)
+    def on_window_end(self,
+                      key=DoFn.KeyParam,
+                      rows_state=DoFn.StateParam(ROWS_STATE),
+                      count_state=DoFn.StateParam(COUNT_STATE),
+                      size_state=DoFn.StateParam(SIZE_STATE),
+                      files_state=DoFn.StateParam(FILES_STATE)):
+        yield from self.flush(key, rows_state, count_state, size_state, files_state)
+        files_state.clear()
+
+    @staticmethod
+    def flush(shard, rows_state, count_state, size_state, files_state):
+        rows = list(rows_state.read())
+        if rows:
+            files = files_state.read() or 0
+            yield f'{shard}-{files:04}', rows
+            files_state.write(files + 1)
+        rows_state.clear()
+        count_state.clear()
+        size_state.clear()
+
+
 class TransformMessage(DoFn):
     def process(self, element, publish_time=DoFn.TimestampParam):
-        from datetime import datetime
-        ts = datetime.fromtimestamp(publish_time.seconds())
-        data = dict(
-            deviceId=element.attributes['deviceId'],
-            year=ts.year,
-            month=ts.month,
-            day=ts.day,
-            departament_id=None,
-            product_id=None,
-        )
-        data.update(json.loads(element.data.decode('utf-8')))
-        yield data
+        # partitions of the publish date in UTC
+        ts = publish_time.to_utc_datetime()
+        for reading in decode_readings(element.data, element.attributes):
+            data = dict(
+                deviceId=element.attributes['deviceId'],
+                year=ts.year,
+                month=ts.month,
+                day=ts.day,
+                departament_id=None,
+                product_id=None,
+            )
+            data.update(reading)
+            # JSON messages of the mqtt client carry the value as a string, the output schema has a float column
+            data['value'] = float(data['value'])
+            yield data
 
 
 class WriteToGCS(DoFn):
-    def __init__(self, output_path, output_format):
+    """Writes file batches under hive partitions (departament_id/product_id/year/month/day) of `output_path`.
+
+    Rows are converted to Arrow column by column in chunks of `row_group_size` rows and streamed into the file,
+    so a batch is never converted as a whole. `output_path` may be a GCS or a local path.
+    """
+    PARTITIONS = ('departament_id', 'product_id', 'year', 'month', 'day')
+    # partition directory name of missing values, the same as pyarrow datasets use
+    NULL_PARTITION = '__HIVE_DEFAULT_PARTITION__'
+
+    def __init__(self, output_path, output_format, compression='snappy', row_group_size=64 * 1024):
         self.output_path = output_path
         self.output_format = output_format
+        self.compression = compression
+        self.row_group_size = row_group_size
+
+    def setup(self):
+        import pyarrow as pa
+        from fsspec.core import url_to_fs
+        # GCSFileSystem for gs:// paths, reused by all bundles of the worker
+        self.filesystem, self.base_dir = url_to_fs(self.output_path)
+        self.schema = pa.schema([
+            ('deviceId', pa.string()),
+            ('timestamp', pa.string()),
+            ('value', pa.float64()),
+        ])
 
     def process(self, key_value, window=DoFn.WindowParam):
         """Write messages in a batch to Google Cloud Storage."""
-        import pyarrow as pa
-        import pyarrow.dataset as ds
-        from gcsfs.core import GCSFileSystem
         ts_format = "%H:%M:%S"
         window_start = window.start.to_utc_datetime().strftime(ts_format)
         window_end = window.end.to_utc_datetime().strftime(ts_format)
+        from operator import itemgetter
         shard_id, batch = key_value
-        table = pa.Table.from_pylist(batch)
-        gcs = GCSFileSystem()
-        if self.output_format == 'parquet':
-            ds.write_dataset(
-                data=table, base_dir=self.output_path,
-                filesystem=gcs, format='parquet',
-                partitioning=['departament_id',
-                              'product_id', 'year', 'month', 'day'],
-                basename_template=f'part_{window_start}-{window_end}_{shard_id}_{{i}}.parquet',
-                partitioning_flavor='hive',
-                existing_data_behavior='overwrite_or_ignore')
-        if self.output_format == 'csv':
-            ds.write_dataset(
-                data=table, base_dir=self.output_path,
-                filesystem=gcs, format='csv',
-                partitioning=['departament_id',
-                                       'product_id', 'year', 'month', 'day'],
-                basename_template=f'part_{window_start}-{window_end}-{shard_id}_{{i}}.csv',
-                partitioning_flavor='hive',
-                existing_data_behavior='overwrite_or_ignore')
+        partition_of = itemgetter(*self.PARTITIONS)
+        partitions = {}
+        for row in batch:
+            partitions.setdefault(partition_of(row), []).append(row)
+        for partition, rows in partitions.items():
+            directory = '/'.join([self.base_dir] + [
+                f'{name}={self.NULL_PARTITION if value is None else value}'
+                for name, value in zip(self.PARTITIONS, partition)])
+            self.filesystem.makedirs(directory, exist_ok=True)
+            if self.output_format == 'parquet':
+                self.write_parquet(f'{directory}/part_{window_start}-{window_end}_{shard_id}_0.parquet', rows)
+            if self.output_format == 'csv':
+                self.write_csv(f'{directory}/part_{window_start}-{window_end}-{shard_id}_0.csv', rows)
+
+    def record_batches(self, rows):
+        import pyarrow as pa
+        for start in range(0, len(rows), self.row_group_size):
+            # only the schema columns are taken, other keys of the rows are ignored
+            yield pa.RecordBatch.from_pylist(rows[start:start + self.row_group_size], schema=self.schema)
+
+    def write_parquet(self, path, rows):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        compression = None if self.compression == 'none' else self.compression
+        with self.filesystem.open(path, 'wb') as f:
+            with pq.ParquetWriter(f, self.schema, compression=compression, use_dictionary=['deviceId']) as writer:
+                for record_batch in self.record_batches(rows):
+                    writer.write_table(pa.Table.from_batches([record_batch]), row_group_size=self.row_group_size)
+
+    def write_csv(self, path, rows):
+        from pyarrow import csv
+        with self.filesystem.open(path, 'wb') as f:
+            with csv.CSVWriter(f, self.schema) as writer:
+                for record_batch in self.record_batches(rows):
+                    writer.write_batch(record_batch)
+
+
+class DetectAnomalies(PTransform):
+    """Scores every reading in the pipeline with the linear detector exported by the trainer (model.npz)"""
+
+    def __init__(self, model_path):
+        self.model_path = model_path
+
+    def expand(self, pcoll):
+        return (
+            pcoll
+            | "Add timestamp to messages" >> ParDo(TransformMessage())
+            | "Key by device" >> WithKeys(lambda reading: reading['deviceId'])
+            | "Score readings" >> ParDo(ScoreReading(self.model_path))
+        )
+
+
+class ScoreReading(DoFn):
+    """Keeps the last `input_size` readings of every device in per-key state and scores each new reading
+    once the device has enough history. A gap longer than the `period` of the model starts the history over,
+    as the function does not score such windows either"""
+    HISTORY_STATE = ReadModifyWriteStateSpec('history', PickleCoder())
+
+    def __init__(self, model_path):
+        self.model_path = model_path
+
+    def setup(self):
+        import io as _io
+        import numpy as np
+        from apache_beam.io.filesystems import FileSystems
+        with FileSystems.open(self.model_path) as f:
+            artifact = np.load(_io.BytesIO(f.read()))
+            # float32 as in the trained torch model
+            self.weight = artifact['weight'].astype(np.float32).T
+            self.bias = artifact['bias'].astype(np.float32)
+            self.bounds = artifact['bounds'].tolist()
+            self.mean = float(artifact['mean'])
+            self.std = float(artifact['std'])
+            self.input_size = int(artifact['input_size'])
+            self.period = int(artifact['period'])
+
+    def process(self, element, history_state=DoFn.StateParam(HISTORY_STATE)):
+        import numpy as np
+        device_id, reading = element
+        epoch = reading_epoch(reading)
+        # list of (epoch seconds, value) ordered by time
+        history = history_state.read() or []
+        if history and epoch <= history[-1][0]:
+            # Ignoring duplicated and late readings
+            return
+        value = float(reading['value'])
+        if history and epoch - history[-1][0] > self.period:
+            # the device was offline, its stale readings are not used for the prediction
+            history = []
+        if len(history) == self.input_size:
+            inputs = (np.array([v for _, v in history]) - self.mean) / self.std
+            prediction = (inputs.astype(np.float32) @ self.weight + self.bias).item()
+            possible = prediction * self.std + self.mean
+            lower_bound = possible + self.bounds[0] * self.std
+            upper_bound = possible + self.bounds[1] * self.std
+            yield dict(
+                deviceId=device_id,
+                timestamp=reading['timestamp'],
+                value=value,
+                is_anomaly=bool(value < lower_bound or value > upper_bound),
+                lower_bound=lower_bound,
+                upper_bound=upper_bound,
+            )
+        history_state.write((history + [(epoch, value)])[-self.input_size:])
 
 
 class JobOptions(PipelineOptions):
@@ -101,7 +286,20 @@ class JobOptions(PipelineOptions):
             "--num_shards",
             type=int,
             default=1,
-            help="Number of shards to use when writing windowed elements to GCS.",
+            help="Number of shards to use when writing windowed elements to GCS, "
+            "the readings of a device always go to the same shard.",
+        )
+        parser.add_argument(
+            "--max_file_rows",
+            type=int,
+            default=100000,
+            help="Maximum number of rows in an output file, more files are written per window and shard above it.",
+        )
+        parser.add_argument(
+            "--max_file_size_mb",
+            type=float,
+            default=64,
+            help="Approximate maximum size of an output file in megabytes.",
         )
         parser.add_argument(
             "--output_format",
@@ -109,20 +307,67 @@ class JobOptions(PipelineOptions):
             choices=["csv", "parquet"],
             help="Output files format.",
         )
+        parser.add_argument(
+            "--output_compression",
+            default="snappy",
+            choices=["none", "snappy", "gzip", "zstd"],
+            help="Compression of parquet output files.",
+        )
+        parser.add_argument(
+            "--row_group_size",
+            type=int,
+            default=65536,
+            help="Number of rows in a parquet row group, rows are converted to Arrow in chunks of this size.",
+        )
+        parser.add_argument(
+            "--model_path",
+            default=None,
+            help="Path of the model.npz exported by the trainer. Readings are scored in the pipeline if set.",
+        )
+        parser.add_argument(
+            "--results_table",
+            default=None,
+            help="BigQuery table for detection results "
+            '"<PROJECT_ID>:<DATASET>.<TABLE>", e.g. the iot_events_analyzed table.',
+        )
+        parser.add_argument(
+            "--results_batch_size",
+            type=int,
+            default=500,
+            help="Number of detection results per BigQuery insert request.",
+        )
 
 
 def run():
     pipeline_options = PipelineOptions()
     job_options = pipeline_options.view_as(JobOptions)
     with Pipeline(options=pipeline_options) as pipeline:
-        (
+        messages = (
             pipeline
             | "Read from Pub/Sub" >> io.ReadFromPubSub(
                 subscription=job_options.input_subscription, with_attributes=True)
+        )
+        (
+            messages
             | "Window into" >> GroupMessagesByFixedWindows(job_options.window_size,
-                                                           job_options.num_shards)
-            | "Write to GCS" >> ParDo(WriteToGCS(job_options.output_path, job_options.output_format))
+                                                           job_options.num_shards,
+                                                           job_options.max_file_rows,
+                                                           job_options.max_file_size_mb)
+            | "Write to GCS" >> ParDo(WriteToGCS(job_options.output_path, job_options.output_format,
+                                               job_options.output_compression, job_options.row_group_size))
         )
+        if job_options.model_path is not None:
+            results = messages | "Detect anomalies" >> DetectAnomalies(job_options.model_path)
+            if job_options.results_table is not None:
+                (
+                    results
+                    | "Drop device id" >> Map(lambda row: {k: v for k, v in row.items() if k != 'deviceId'})
+                    | "Write results to BigQuery" >> io.WriteToBigQuery(
+                        job_options.results_table,
+                        batch_size=job_options.results_batch_size,
+                        create_disposition=io.BigQueryDisposition.CREATE_NEVER,
+                        write_disposition=io.BigQueryDisposition.WRITE_APPEND)
+                )
 
 
 if __name__ == "__main__":
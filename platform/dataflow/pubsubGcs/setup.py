@@ -0,0 +1,9 @@
+import setuptools
+
+# Stages the modules shared with the functions on the Dataflow workers,
+# dataflow_classic_template.sh copies them from functions/common next to the pipeline
+setuptools.setup(
+    name='iot-pubsub-gcs',
+    version='0.1.0',
+    py_modules=['reading'],
+)
@@ -0,0 +1,69 @@
+import hashlib
+import logging
+import os
+from typing import Optional
+
+# Files written by the trainer into the model directory, the handler serves the first one found of
+# fleet.npz, model.npz and pytorch_model.bin with config.json
+MODEL_FILES = ('config.json', 'pytorch_model.bin', 'model.npz', 'fleet.npz')
+COMPLETE_MARKER = '.complete'
+
+logger = logging.getLogger(__name__)
+
+
+def cache_path(source: str, cache_dir: str) -> str:
+    """Directory of the cached copy of the artifacts under `source`, one per source URI"""
+    return os.path.join(cache_dir, hashlib.sha1(source.rstrip('/').encode()).hexdigest()[:16])
+
+
+def download_artifacts(source: str, folder: str, client=None) -> int:
+    """Downloads the model files directly under the `gs://` prefix into `folder`, returns their number"""
+    if client is None:
+        from google.cloud import storage
+        client = storage.Client()
+    bucket_name, _, prefix = source[len('gs://'):].partition('/')
+    prefix = prefix.rstrip('/') + '/' if prefix.strip('/') else ''
+    downloaded = 0
+    for blob in client.list_blobs(bucket_name, prefix=prefix, delimiter='/'):
+        name = blob.name[len(prefix):]
+        if name not in MODEL_FILES:
+            continue
+        # renamed once complete, so a partial file is never taken for an artifact
+        part_file = os.path.join(folder, name + '.part')
+        blob.download_to_filename(part_file)
+        os.replace(part_file, os.path.join(folder, name))
+        downloaded += 1
+    return downloaded
+
+
+def fetch_model_artifacts(source: str, cache_dir: str, client=None) -> str:
+    """Local directory with the model artifacts of `source`.
+
+    A local directory is used in place, so a container can be tested against the artifacts of a training
+    with `AIP_STORAGE_URI=/path/to/model`. The files under a `gs://` prefix are downloaded once into
+    `cache_dir` and reused by the workers restarted later on, until the source changes.
+    """
+    if not source.startswith('gs://'):
+        if not os.path.isdir(source):
+            raise RuntimeError(f"Missing the model directory {source}")
+        return source
+    folder = cache_path(source, cache_dir)
+    if os.path.isfile(os.path.join(folder, COMPLETE_MARKER)):
+        logger.info(f"Using the artifacts of {source} cached in {folder}")
+        return folder
+    os.makedirs(folder, exist_ok=True)
+    downloaded = download_artifacts(source, folder, client)
+    if downloaded == 0:
+        raise RuntimeError(f"No model files {MODEL_FILES} under {source}")
+    with open(os.path.join(folder, COMPLETE_MARKER), 'w') as f:
+        f.write(source)
+    logger.info(f"Downloaded {downloaded} artifacts of {source} into {folder}")
+    return folder
+
+
+def resolve_model_dir(model_dir: str, source: Optional[str], cache_dir: str) -> str:
+    """The directory to load the model from, the artifacts of `source` when given, else the
+    ones packed into the model archive"""
+    if not source:
+        return model_dir
+    return fetch_model_artifacts(source, cache_dir)
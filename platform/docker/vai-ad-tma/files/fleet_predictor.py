@@ -0,0 +1,93 @@
+import logging
+import os
+import time
+from typing import Optional, Sequence, Tuple
+
+import numpy as np
+
+FLEET_MODEL_FILE = 'fleet.npz'
+
+logger = logging.getLogger(__name__)
+
+
+class FleetTable:
+    """Detectors of a fleet exported by the trainer into `fleet.npz`, row `i` of every array belongs
+    to the device `device_ids[i]`, which are sorted"""
+
+    def __init__(self, path: str) -> None:
+        with np.load(path) as artifact:
+            self.device_ids = artifact['device_ids']
+            # float32 as in the torch model to produce the same outputs
+            self.weight = np.ascontiguousarray(artifact['weight'], dtype=np.float32)
+            self.bias = artifact['bias'].astype(np.float32)
+            self.mean = artifact['mean'].astype(np.float64)
+            self.std = artifact['std'].astype(np.float64)
+            self.bounds = artifact['bounds'].astype(np.float64)
+            self.period = artifact['period'].astype(np.int64)
+            self.input_size = int(artifact['input_size'])
+        self.config = {
+            'input_size': self.input_size,
+            'devices': len(self.device_ids),
+        }
+
+    def rows(self, device_ids: Sequence[Optional[str]]) -> Tuple[np.ndarray, np.ndarray]:
+        """Rows of the devices found with a binary search and the mask of known devices,
+        unknown devices get row 0"""
+        ids = np.array(['' if device_id is None else device_id for device_id in device_ids], dtype=np.str_)
+        rows = np.minimum(np.searchsorted(self.device_ids, ids), len(self.device_ids) - 1)
+        known = self.device_ids[rows] == ids
+        return np.where(known, rows, 0), known
+
+    def predict(self, x: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        """Scores a batch of mixed devices with a single matmul over the gathered weight rows"""
+        return np.einsum('kd,kd->k', x.astype(np.float32), self.weight[rows]) + self.bias[rows]
+
+
+class FleetPredictor:
+    """Serves the detectors of many devices from one FleetTable.
+
+    With `watch_dir` the predictor checks every `reload_interval` seconds whether `fleet.npz` in it has changed
+    and swaps to the new table without a restart. The file should be replaced atomically (written aside
+    and renamed), a table which fails to load is retried on the next check and the current one is kept.
+    """
+
+    def __init__(self, model_dir: str, watch_dir: Optional[str] = None, reload_interval: float = 30.) -> None:
+        self.watch_file = os.path.join(watch_dir, FLEET_MODEL_FILE) if watch_dir else None
+        self.reload_interval = reload_interval
+        self.signature = None
+        self.checked = time.monotonic()
+        if self.watch_file is not None and self.reload():
+            return
+        mdl_file = os.path.join(model_dir, FLEET_MODEL_FILE)
+        if not os.path.isfile(mdl_file):
+            raise RuntimeError(f"Missing the {FLEET_MODEL_FILE} file")
+        self.table = FleetTable(mdl_file)
+
+    @property
+    def config(self):
+        return self.table.config
+
+    def current(self) -> FleetTable:
+        """The table to score a request with, checking the watched directory first when it is time to"""
+        if self.watch_file is not None and time.monotonic() - self.checked >= self.reload_interval:
+            self.checked = time.monotonic()
+            self.reload()
+        return self.table
+
+    def reload(self) -> bool:
+        try:
+            stat = os.stat(self.watch_file)
+        except FileNotFoundError:
+            return False
+        signature = (stat.st_mtime_ns, stat.st_size)
+        if signature == self.signature:
+            return False
+        try:
+            table = FleetTable(self.watch_file)
+        except Exception as e:
+            logger.warning(f"Failed to load {self.watch_file}, keeping the current detectors: {e}")
+            return False
+        # a single reference swap, requests in flight keep the table they started with
+        self.table, self.signature = table, signature
+        logger.info(f"Loaded {table.config['devices']} detectors from {self.watch_file}")
+        return True
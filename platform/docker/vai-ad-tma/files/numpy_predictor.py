@@ -0,0 +1,31 @@
+import os
+import numpy as np
+
+NUMPY_MODEL_FILE = 'model.npz'
+
+
+class NumpyPredictor:
+    """Serves a linear detector exported by `Trainer.export_linear` with NumPy only, torch is never imported"""
+
+    def __init__(self, model_dir: str) -> None:
+        mdl_file = os.path.join(model_dir, NUMPY_MODEL_FILE)
+        if not os.path.isfile(mdl_file):
+            raise RuntimeError(f"Missing the {NUMPY_MODEL_FILE} file")
+
+        with np.load(mdl_file) as artifact:
+            # float32 as in the torch model to produce the same outputs
+            self.weight = artifact['weight'].astype(np.float32).T
+            self.bias = artifact['bias'].astype(np.float32)
+            self.bounds = artifact['bounds'].tolist()
+            self._mean = float(artifact['mean'])
+            self._std = float(artifact['std'])
+            self.config = {
+                'input_size': int(artifact['input_size']),
+                'period': int(artifact['period']),
+                'mean': self._mean,
+                'std': self._std,
+                'bounds': self.bounds,
+            }
+
+    def predict(self, x: np.ndarray) -> np.ndarray:
+        return (x.astype(np.float32) @ self.weight + self.bias).reshape(-1)
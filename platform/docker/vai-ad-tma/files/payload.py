@@ -0,0 +1,26 @@
+from base64 import b64decode
+from io import StringIO
+from typing import Dict
+
+import numpy as np
+import pandas as pd
+
+PAYLOAD_VERSION = 2
+
+
+def decode_values(instance: Dict) -> np.ndarray:
+    """Returns the values of a prediction instance ordered by time.
+
+    Version 2 instances carry either a flat JSON array or base64 of little-endian float32 values,
+    instances without version are pandas JSON of the series.
+    """
+    version = instance.get('version', 1)
+    if version == 1:
+        inputs = pd.read_json(StringIO(instance['values']), lines=True).T
+        inputs.sort_index(inplace=True)
+        return inputs.iloc[:, 0].values.astype(np.float64)
+    if version == PAYLOAD_VERSION:
+        if instance.get('encoding') == 'float32':
+            return np.frombuffer(b64decode(instance['values']), dtype='<f4').astype(np.float64)
+        return np.asarray(instance['values'], dtype=np.float64)
+    raise ValueError(f"Unsupported payload version {version}")
@@ -1,5 +1,6 @@
 import os
 import json
+import numpy as np
 import torch
 from typing import Sequence, Tuple
 from torch import nn
@@ -28,3 +29,7 @@ class Predictor(nn.Module):
     def forward(self, x: Sequence) -> Tuple:
         output = self.model(x.float())
         return output
+
+    def predict(self, x: np.ndarray) -> np.ndarray:
+        with torch.no_grad():
+            return self.forward(torch.from_numpy(x)).cpu().numpy().reshape(-1)
@@ -3,13 +3,23 @@ import json
 import logging
 import torch
 import numpy as np
-import pandas as pd
 from google.cloud.logging import Client as LClient
 from ts.torch_handler.base_handler import BaseHandler
+from artifacts import resolve_model_dir
+from fleet_predictor import FLEET_MODEL_FILE, FleetPredictor
+from numpy_predictor import NUMPY_MODEL_FILE, NumpyPredictor
+from payload import decode_values
 from predictor import Predictor
 
 
 PROJECT = os.environ.get('PROJECT')
+# Model artifacts loaded at startup, a gs:// prefix (set by Vertex AI to the uploaded model's artifacts)
+# or a local directory, the image then serves any training without a rebuild
+MODEL_SOURCE = os.environ.get('AIP_STORAGE_URI')
+MODEL_CACHE_DIR = os.environ.get('MODEL_CACHE_DIR', '/home/model-server/model-cache')
+# Directory watched for a newer fleet.npz, it is swapped in without a restart
+MODEL_WATCH_DIR = os.environ.get('MODEL_WATCH_DIR')
+MODEL_RELOAD_INTERVAL = float(os.environ.get('MODEL_RELOAD_INTERVAL', 30))
 
 log_client = LClient(project=PROJECT)
 logger = logging.getLogger(__name__)
@@ -26,59 +36,88 @@ class TimeSeriesHandler(BaseHandler):
         self.gcs = None
 
     def initialize(self, ctx):
-        """Loads the model.pt file and initialized the model object.
+        """Loads the model artifacts of AIP_STORAGE_URI, or the ones packed into the archive,
+        and initialized the model object.
         """
         self.manifest = ctx.manifest
 
         properties = ctx.system_properties
-        model_dir = properties.get("model_dir")
+        model_dir = resolve_model_dir(properties.get("model_dir"), MODEL_SOURCE, MODEL_CACHE_DIR)
 
         self.device = torch.device('cpu') # torch.device("cuda:" + str(properties.get("gpu_id")) if torch.cuda.is_available() else "cpu")
-        # Load model
-        self.model = Predictor(model_dir)
-        self.model.to(self.device)
-        self.model.eval()
+        # Load model, the detectors of a fleet or the exported linear model are served with NumPy when available
+        if (os.path.isfile(os.path.join(model_dir, FLEET_MODEL_FILE))
+                or MODEL_WATCH_DIR and os.path.isfile(os.path.join(MODEL_WATCH_DIR, FLEET_MODEL_FILE))):
+            self.model = FleetPredictor(model_dir, MODEL_WATCH_DIR, MODEL_RELOAD_INTERVAL)
+        elif os.path.isfile(os.path.join(model_dir, NUMPY_MODEL_FILE)):
+            self.model = NumpyPredictor(model_dir)
+        else:
+            self.model = Predictor(model_dir)
+            self.model.to(self.device)
+            self.model.eval()
         logger.debug('Model from path {0} loaded successfully'.format(model_dir))
         self.initialized = True
 
     def preprocess(self, data):
-        """Preprocessing request data, normalizing input signal"""
+        """Preprocessing request data, stacking the K series of the batch into a (K, input_size + 1) array
+        and normalizing it, by the detector of the `deviceId` of every instance for a fleet.
+        Returns the normalized array and the normalization of every series"""
         assert (
             data is not None
             and len(data) > 0 
-            and (data[0].get("data") is not None 
-                 or data[0].get("body") is not None)
+            and all(row.get("data") is not None or row.get("body") is not None for row in data)
         ), "There is no data to process!"
-        dt = data[0].get("data")
-        if dt is None:
-            dt = data[0].get("body")
         logger.info("Received data: {}".format(data))
-
-        data = json.loads(dt)
-        inputs = pd.read_json(data['values'], lines=True).T
-        inputs.columns = ['value']
-        inputs['value'] = (inputs['value'] - self.model._mean) / self.model._std
-        inputs.sort_index(inplace=True)
-        inputs = inputs['value']
-        return inputs.values
+        batch = []
+        device_ids = []
+        for row in data:
+            dt = row.get("data")
+            if dt is None:
+                dt = row.get("body")
+            instance = json.loads(dt)
+            batch.append(decode_values(instance))
+            device_ids.append(instance.get('deviceId'))
+        batch = np.stack(batch)
+        if isinstance(self.model, FleetPredictor):
+            table = self.model.current()
+            rows, known = table.rows(device_ids)
+            if not known.all():
+                unknown = sorted({str(device_id) for device_id, k in zip(device_ids, known) if not k})
+                logger.warning(f"No detectors of devices {unknown}")
+            scale = {'table': table, 'rows': rows, 'known': known,
+                     'mean': table.mean[rows], 'std': table.std[rows], 'bounds': table.bounds[rows]}
+        else:
+            scale = {'mean': self.model._mean, 'std': self.model._std, 'bounds': np.asarray(self.model.bounds)}
+        mean, std = np.reshape(scale['mean'], (-1, 1)), np.reshape(scale['std'], (-1, 1))
+        return (batch - mean) / std, scale
 
     def inference(self, inputs):
-        """Predict the possible value for the current timestamp. Returns possible and real values
+        """Predict the possible values for the current timestamps with a single forward pass.
+        Returns possible and real values with the normalization
         """
-        with torch.no_grad():
-            prediction = self.model(torch.from_numpy(inputs[:self.model.config['input_size']].reshape((1,self.model.config['input_size'])))).cpu().squeeze().item()
-        return [prediction, inputs[self.model.config['input_size']]]
+        inputs, scale = inputs
+        if 'table' in scale:
+            input_size = scale['table'].input_size
+            predictions = scale['table'].predict(inputs[:, :input_size], scale['rows'])
+        else:
+            input_size = self.model.config['input_size']
+            predictions = self.model.predict(inputs[:, :input_size])
+        return predictions, inputs[:, input_size], scale
 
     def postprocess(self, inference_output):
-        """Adding upper and lower expected values to the inference output, denormalizing"""
-        possible = inference_output[0] * self.model._std + self.model._mean
-        real = inference_output[1] * self.model._std + self.model._mean
-        lower_bound = possible + self.model.bounds[0] * self.model._std
-        upper_bound = possible + self.model.bounds[1] * self.model._std
-        if lower_bound > real:
-            post_out = -1, possible, real, lower_bound, upper_bound
-        elif upper_bound < real:
-            post_out = 1, possible, real, lower_bound, upper_bound
-        else:
-            post_out = 0, possible, real, lower_bound, upper_bound
-        return [post_out]
+        """Adding upper and lower expected values to the inference output, denormalizing.
+        Returns a result per series in the order of the request"""
+        predictions, observed, scale = inference_output
+        mean, std, bounds = scale['mean'], scale['std'], scale['bounds']
+        possible = predictions * std + mean
+        real = observed * std + mean
+        lower_bound = possible + bounds[..., 0] * std
+        upper_bound = possible + bounds[..., 1] * std
+        is_anomaly = np.where(lower_bound > real, -1, np.where(upper_bound < real, 1, 0))
+        results = list(zip(is_anomaly.tolist(), possible.tolist(), real.tolist(),
+                           lower_bound.tolist(), upper_bound.tolist()))
+        if 'known' in scale:
+            # series of devices without a detector are returned without a prediction
+            results = [result if known else (0, None, value, None, None)
+                       for result, known, value in zip(results, scale['known'].tolist(), real.tolist())]
+        return results
@@ -1,7 +1,7 @@
 import logging
 
 from base64 import b64decode
-from json import loads, dumps
+from json import dumps
 from os import environ
 
 from google.api_core.exceptions import FailedPrecondition
@@ -10,6 +10,8 @@ from google.cloud.iot_v1 import DeviceManagerClient
 from google.cloud.logging import Client as GCPLogClient
 from pandas._libs.missing import NAType
 
+from reading import decode_readings
+
 MODEL_FMT = "{}.{}.{}latest"
 DESTINATION_TABLE_FMT = "{}.{}.{}"
 THRESHOLD = environ.get('THRESHOLD', 0.95)
@@ -58,10 +60,39 @@ class DeviceCommunicator():
             logging.error(e)
 
 
+class SharedClients():
+    """Lazily created clients reused by the invocations of a warm function instance"""
+
+    def __init__(self) -> None:
+        self._log_client = None
+        self._bigquery = None
+        self._device_manager = None
+
+    def setup_logging(self) -> None:
+        if self._log_client is None:
+            self._log_client = GCPLogClient()
+            self._log_client.setup_logging()
+
+    @property
+    def bigquery(self) -> bigquery.Client:
+        if self._bigquery is None:
+            self._bigquery = bigquery.Client()
+        return self._bigquery
+
+    @property
+    def device_manager(self) -> DeviceManagerClient:
+        if self._device_manager is None:
+            self._device_manager = DeviceManagerClient()
+        return self._device_manager
+
+
+CLIENTS = SharedClients()
+
+
 class PubSubDataProcessor:
 
     def __init__(self, project_id: str, cloud_region: str, registry_id: str, device_id: str,
-                       dataset: str, model_prefix: str, destination_table: str):
+                       dataset: str, model_prefix: str, destination_table: str, clients: SharedClients = CLIENTS):
         self.project_id = project_id
         self.cloud_region = cloud_region
         self.registry_id = registry_id
@@ -70,9 +101,11 @@ class PubSubDataProcessor:
         self.model_prefix = model_prefix
         self.destination_table = destination_table
         self.device_com = None
-        self.dm_client = None
+        self.clients = clients
 
-        self.bqclient = bigquery.Client()
+    @property
+    def bqclient(self) -> bigquery.Client:
+        return self.clients.bigquery
 
     def detect_anomaly(self, timestamp, value):
         full_model_name = MODEL_FMT.format(self.project_id, self.dataset, self.model_prefix)
@@ -108,9 +141,8 @@ class PubSubDataProcessor:
 
     def set_device_communicator(self):
         if self.device_com is None:
-            self.client = DeviceManagerClient()
             self.device_com = DeviceCommunicator(
-                client=self.client,
+                client=self.clients.device_manager,
                 project_id=self.project_id,
                 cloud_region=self.cloud_region,
                 registry_id=self.registry_id,
@@ -145,8 +177,7 @@ def main(event, context):
     destination_table = environ.get('destination_table')
     device_id = event['attributes']['deviceId']
     #Setting up Cloud logging and initializing the processor
-    client = GCPLogClient()
-    client.setup_logging()
+    CLIENTS.setup_logging()
 
     processor = PubSubDataProcessor(
         project_id=project_id,
@@ -157,15 +188,15 @@ def main(event, context):
         model_prefix=model_prefix,
         destination_table=destination_table
     )
-    # Extracting IoT data
-    data = loads(b64decode(event['data']).decode('utf-8'))
-    timestamp = data['timestamp']
-    value = data['value']
-
-    # Detect anomalies
-    anomaly_row, is_anomaly = processor.detect_anomaly(timestamp, value)
-    # Populating visualization table
-    processor.populate_vis_table(anomaly_row)
-    # If anomaly is detected, send the feedback
-    if is_anomaly is not None and is_anomaly:
-        processor.feedback_to_device(anomaly_row)
+    # Extracting IoT data, the message may carry a batch of readings
+    for data in decode_readings(b64decode(event['data']), event['attributes']):
+        timestamp = data['timestamp']
+        value = data['value']
+
+        # Detect anomalies
+        anomaly_row, is_anomaly = processor.detect_anomaly(timestamp, value)
+        # Populating visualization table
+        processor.populate_vis_table(anomaly_row)
+        # If anomaly is detected, send the feedback
+        if is_anomaly is not None and is_anomaly:
+            processor.feedback_to_device(anomaly_row)
@@ -0,0 +1,104 @@
+from datetime import datetime, timezone
+from typing import Dict, List, Sequence, Tuple
+
+from google.cloud import bigquery
+
+# (timestamps, values) of a device ordered by time
+Window = Tuple[List[datetime], List[float]]
+
+WINDOWS_QUERY_FMT = """
+SELECT deviceId, readings
+  FROM `{table}`
+ WHERE deviceId IN UNNEST(@ids)
+"""
+# Appends new readings to the device windows keeping the latest `size` ones,
+# duplicated timestamps are taken once
+WINDOWS_MERGE_FMT = """
+MERGE `{table}` w
+USING (
+  SELECT @ids[OFFSET(i)] deviceId,
+         ARRAY_AGG(STRUCT(@timestamps[OFFSET(i)] AS timestamp, @values[OFFSET(i)] AS value)) readings
+    FROM UNNEST(GENERATE_ARRAY(0, ARRAY_LENGTH(@ids) - 1)) i
+   GROUP BY deviceId
+) n
+ON w.deviceId = n.deviceId
+WHEN MATCHED THEN UPDATE SET
+  readings = ARRAY(
+    SELECT AS STRUCT * FROM (
+      SELECT timestamp, ANY_VALUE(value) value
+        FROM (SELECT * FROM UNNEST(w.readings) UNION ALL SELECT * FROM UNNEST(n.readings))
+       GROUP BY timestamp
+       ORDER BY timestamp DESC
+       LIMIT {size}
+    ) ORDER BY timestamp),
+  updated = CURRENT_TIMESTAMP()
+WHEN NOT MATCHED THEN INSERT (deviceId, readings, updated) VALUES (
+  n.deviceId,
+  ARRAY(
+    SELECT AS STRUCT * FROM (
+      SELECT timestamp, ANY_VALUE(value) value FROM UNNEST(n.readings)
+       GROUP BY timestamp
+       ORDER BY timestamp DESC
+       LIMIT {size}
+    ) ORDER BY timestamp),
+  CURRENT_TIMESTAMP())
+"""
+
+
+class DeviceWindowsTable():
+    """Latest `size` readings of every device kept as one row per device in a BigQuery table.
+
+    The table is clustered by deviceId, so reading the windows of a few devices scans a few rows
+    instead of a range of the events table. The ingest function appends readings with `update`.
+    """
+
+    def __init__(self, client: bigquery.Client, table: str, size: int) -> None:
+        self.client = client
+        self.table = table
+        self.size = size
+
+    def get(self, device_ids: Sequence[str]) -> Dict[str, Window]:
+        """Windows of the devices, devices without a window are missing in the result"""
+        job_config = bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ArrayQueryParameter('ids', 'STRING', sorted(set(device_ids)))])
+        windows = {}
+        for row in self.client.query(WINDOWS_QUERY_FMT.format(table=self.table), job_config=job_config).result():
+            windows[row['deviceId']] = ([r['timestamp'] for r in row['readings']],
+                                        [r['value'] for r in row['readings']])
+        return windows
+
+    def update(self, rows: Sequence[Tuple[int, float, str]]) -> None:
+        """Appends (epoch seconds, value, device id) rows to the device windows with a single MERGE"""
+        if len(rows) == 0:
+            return
+        job_config = bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ArrayQueryParameter('ids', 'STRING', [device_id for _, _, device_id in rows]),
+            bigquery.ArrayQueryParameter('timestamps', 'TIMESTAMP',
+                                         [datetime.fromtimestamp(epoch, tz=timezone.utc) for epoch, _, _ in rows]),
+            bigquery.ArrayQueryParameter('values', 'FLOAT64', [value for _, value, _ in rows]),
+        ])
+        query = WINDOWS_MERGE_FMT.format(table=self.table, size=self.size)
+        self.client.query(query, job_config=job_config).result()
+
+
+class InMemoryDeviceWindows():
+    """Stand-in of DeviceWindowsTable keeping the windows in a dict, e.g. for local runs"""
+
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self.windows: Dict[str, Dict[datetime, float]] = {}
+
+    def get(self, device_ids: Sequence[str]) -> Dict[str, Window]:
+        windows = {}
+        for device_id in set(device_ids):
+            if device_id in self.windows:
+                readings = sorted(self.windows[device_id].items())
+                windows[device_id] = ([t for t, _ in readings], [v for _, v in readings])
+        return windows
+
+    def update(self, rows: Sequence[Tuple[int, float, str]]) -> None:
+        for epoch, value, device_id in rows:
+            readings = self.windows.setdefault(device_id, {})
+            readings.setdefault(datetime.fromtimestamp(epoch, tz=timezone.utc), value)
+            for timestamp in sorted(readings)[:-self.size]:
+                del readings[timestamp]
@@ -0,0 +1,51 @@
+import struct
+from datetime import datetime, timezone
+from json import loads
+from typing import Dict, List
+
+# Binary readings are published to the `binary` subfolder of the events topic,
+# IoT Core passes the subfolder to Pub/Sub as the `subFolder` attribute
+BINARY_SUBFOLDER = 'binary'
+READING_VERSION = 1
+# version, epoch seconds (UTC), value
+READING_STRUCT = struct.Struct('<Bqd')
+
+
+def encode_reading(epoch: int, value: float) -> bytes:
+    """17 bytes of a reading instead of a JSON with a formatted timestamp, a batch is concatenated readings"""
+    return READING_STRUCT.pack(READING_VERSION, epoch, value)
+
+
+def decode_readings(data: bytes, attributes: Dict) -> List[Dict]:
+    """Decodes the readings of a message published either as JSON or as binary structs.
+
+    A message holds one reading or a batch ordered by time: concatenated structs,
+    or JSON with `readings` as [timestamp, value] pairs. Every reading is a dict with `timestamp` and `value`
+    as in the single reading JSON messages, binary readings also have the `epoch` seconds,
+    so consumers may skip parsing the timestamp.
+    """
+    if attributes.get('subFolder') == BINARY_SUBFOLDER:
+        readings = []
+        for version, epoch, value in READING_STRUCT.iter_unpack(data):
+            if version != READING_VERSION:
+                raise ValueError(f"Unsupported reading version {version}")
+            timestamp = datetime.fromtimestamp(epoch, tz=timezone.utc).replace(tzinfo=None).isoformat()
+            readings.append({'timestamp': timestamp, 'value': value, 'epoch': epoch})
+        return readings
+    message = loads(data.decode('utf-8'))
+    if 'readings' in message:
+        return [{'timestamp': timestamp, 'value': value} for timestamp, value in message['readings']]
+    return [message]
+
+
+def parse_epoch(timestamp: str) -> int:
+    """Epoch seconds of an ISO-8601 timestamp, naive timestamps are taken as UTC, the same as in bucketing.py"""
+    dt = datetime.fromisoformat(timestamp)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp())
+
+
+def reading_epoch(reading: Dict) -> int:
+    """Epoch seconds of a decoded reading, binary readings already carry them"""
+    return reading['epoch'] if 'epoch' in reading else parse_epoch(reading['timestamp'])
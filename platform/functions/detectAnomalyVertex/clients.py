@@ -0,0 +1,88 @@
+import logging
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+from google.cloud import aiplatform
+from google.cloud import bigquery
+from google.cloud.iot_v1 import DeviceManagerClient
+from google.cloud.logging import Client as GCPLogClient
+
+
+def find_endpoint(endpoint_name: str) -> aiplatform.Endpoint:
+    filter = f'display_name="{endpoint_name}"'
+    endpoint_info = None
+    for endpoint_info in aiplatform.Endpoint.list(filter=filter):
+        logging.info(f"Endpoint display name = {endpoint_info.display_name} resource id = {endpoint_info.resource_name}")
+
+    if endpoint_info is None:
+        raise ValueError(f"There is no endpoint `{endpoint_name}`")
+    return aiplatform.Endpoint(endpoint_info.resource_name)
+
+
+class ClientsRegistry():
+    """Lazily created clients and resolved endpoints shared by the invocations of a warm function instance.
+
+    Endpoints are resolved by display name and cached for `endpoint_ttl` seconds or until invalidated,
+    e.g. after a failed prediction. Client factories can be replaced with local stand-ins.
+    """
+
+    def __init__(self, project_id: str, endpoint_ttl: int = 600,
+                 log_client_factory: Callable = GCPLogClient,
+                 bigquery_factory: Callable = bigquery.Client,
+                 device_manager_factory: Callable = DeviceManagerClient,
+                 endpoint_resolver: Callable[[str], aiplatform.Endpoint] = find_endpoint,
+                 init_aiplatform: Callable = aiplatform.init) -> None:
+        self.project_id = project_id
+        self.endpoint_ttl = endpoint_ttl
+        self.log_client_factory = log_client_factory
+        self.bigquery_factory = bigquery_factory
+        self.device_manager_factory = device_manager_factory
+        self.endpoint_resolver = endpoint_resolver
+        self.init_aiplatform = init_aiplatform
+        self._log_client = None
+        self._bigquery = None
+        self._device_manager = None
+        self._aiplatform_ready = False
+        self._endpoints: Dict[str, Tuple[float, aiplatform.Endpoint]] = {}
+
+    def setup_logging(self) -> None:
+        if self._log_client is None:
+            self._log_client = self.log_client_factory()
+            self._log_client.setup_logging()
+
+    @property
+    def bigquery(self) -> bigquery.Client:
+        if self._bigquery is None:
+            self._bigquery = self.bigquery_factory()
+        return self._bigquery
+
+    @property
+    def device_manager(self) -> DeviceManagerClient:
+        if self._device_manager is None:
+            self._device_manager = self.device_manager_factory()
+        return self._device_manager
+
+    def get_endpoint(self, endpoint_name: str) -> aiplatform.Endpoint:
+        resolved = self._endpoints.get(endpoint_name)
+        if resolved is not None and time.monotonic() - resolved[0] < self.endpoint_ttl:
+            return resolved[1]
+        if not self._aiplatform_ready:
+            self.init_aiplatform(project=self.project_id)
+            self._aiplatform_ready = True
+        endpoint = self.endpoint_resolver(endpoint_name)
+        self._endpoints[endpoint_name] = (time.monotonic(), endpoint)
+        return endpoint
+
+    def invalidate_endpoint(self, endpoint_name: str) -> None:
+        self._endpoints.pop(endpoint_name, None)
+
+
+# Shared by the invocations of a warm instance
+CLIENTS: Optional[ClientsRegistry] = None
+
+
+def get_clients(project_id: str, endpoint_ttl: int = 600) -> ClientsRegistry:
+    global CLIENTS
+    if CLIENTS is None:
+        CLIENTS = ClientsRegistry(project_id=project_id, endpoint_ttl=endpoint_ttl)
+    return CLIENTS
@@ -1,15 +1,20 @@
 import logging
 
-from base64 import b64decode, b64encode
-from json import loads, dumps
+from base64 import b64decode
+from bisect import bisect_left
+from json import dumps
 from os import environ
+from typing import Dict, List, Optional, Sequence, Tuple, Union
 
-from google.cloud import aiplatform
 from google.cloud import bigquery
-from google.cloud.iot_v1 import DeviceManagerClient
-from google.cloud.logging import Client as GCPLogClient
-from pandas import DataFrame, Series, concat, to_datetime
+from google.cloud import pubsub_v1
+from pandas import DataFrame, Series, Timedelta, concat, to_datetime
+from clients import ClientsRegistry, get_clients
+from device_windows import DeviceWindowsTable, InMemoryDeviceWindows
 from device_communicator import DeviceCommunicator
+from payload import serialize_pd
+from reading import decode_readings
+from readings_cache import ReadingsCache
 
 
 DESTINATION_TABLE_FMT = "{project}.{dataset}.{destination_table}"
@@ -17,25 +22,51 @@ COMMAND_FMT = "Found high anomaly at {timestamp}: {value}"
 PREVIOUS_ROWS_QUERY_FMT = """
 SELECT a.timestamp, a.value
     FROM `{project}.{dataset}.{table_id}` a
-   WHERE a.timestamp >= datetime_sub(timestamp("{timestamp}"), INTERVAL {interval} SECOND)
+   WHERE a.deviceId = @device_id
+     AND a.timestamp >= datetime_sub(timestamp("{timestamp}"), INTERVAL {interval} SECOND)
      AND a.timestamp < timestamp("{timestamp}")
 ORDER BY a.timestamp
 """
+PREVIOUS_ROWS_BATCH_QUERY_FMT = """
+SELECT a.deviceId, a.timestamp, a.value
+    FROM `{project}.{dataset}.{table_id}` a
+   WHERE a.deviceId IN UNNEST(@ids)
+     AND a.timestamp >= timestamp_sub(@min_timestamp, INTERVAL {interval} SECOND)
+     AND a.timestamp < @max_timestamp
+ORDER BY a.deviceId, a.timestamp
+"""
+
+# Rolling windows of the latest readings shared by the invocations of a warm instance
+READINGS_CACHE: Optional[ReadingsCache] = None
+
+
+def get_readings_cache(input_size: int, period: int) -> ReadingsCache:
+    global READINGS_CACHE
+    if READINGS_CACHE is None:
+        READINGS_CACHE = ReadingsCache(
+            size=input_size,
+            period=period,
+            max_devices=int(environ.get('cache_max_devices', 10000)),
+            ttl=int(environ.get('cache_ttl', 3600)))
+    return READINGS_CACHE
 
 
-def serialize_pd(series: Series):
-    obj = {
-        'timestamp': str(series.index[-1]),
-        'values': series.to_json()
-    }
-    b64_encoded = b64encode(dumps(obj).encode('utf-8'))
-    return [{"data": {"b64": b64_encoded.decode('utf-8')}}]
+def get_device_windows(clients: ClientsRegistry, input_size: int) -> Optional[DeviceWindowsTable]:
+    """Device windows table if `windows_table` is set, histories are queried from the events table otherwise"""
+    table = environ.get('windows_table')
+    if not table:
+        return None
+    return DeviceWindowsTable(clients.bigquery, f"{environ.get('project_id')}.{environ.get('dataset')}.{table}",
+                              size=int(environ.get('window_size', input_size + 1)))
 
 
 class PubSubDataProcessor:
 
     def __init__(self, project_id: str, cloud_region: str, registry_id: str, device_id: str, period: int,
-                       dataset: str, endpoint_name: str, input_size: int, table_id: str, destination_table: str):
+                       dataset: str, endpoint_name: str, input_size: int, table_id: str, destination_table: str,
+                       clients: ClientsRegistry, cache: Optional[ReadingsCache] = None,
+                       payload_format: str = 'legacy',
+                       windows: Optional[Union[DeviceWindowsTable, InMemoryDeviceWindows]] = None):
         self.project_id = project_id
         self.cloud_region = cloud_region
         self.registry_id = registry_id
@@ -45,21 +76,159 @@ class PubSubDataProcessor:
         self.table_id = table_id
         self.period = period
         self.destination_table = destination_table
-        self.device_com = None
-        self.dm_client = None
-        
-        self._set_endpoint(endpoint_name)
-        self.bqclient = bigquery.Client()
+        self.endpoint_name = endpoint_name
+        self.clients = clients
+        self.cache = cache
+        self.payload_format = payload_format
+        self.windows = windows
+        self.device_coms = {}
+
+    @property
+    def bqclient(self) -> bigquery.Client:
+        return self.clients.bigquery
+
+    @property
+    def endpoint(self):
+        return self.clients.get_endpoint(self.endpoint_name)
 
     def detect_anomaly(self, timestamp, value):
-        query = PREVIOUS_ROWS_QUERY_FMT.format(
+        inputs = self.get_cached_history(self.device_id, timestamp)
+        if inputs is None:
+            inputs = self.get_window_histories([(self.device_id, timestamp, value)])[0]
+            if inputs is None:
+                query = PREVIOUS_ROWS_QUERY_FMT.format(
+                    dataset=self.dataset,
+                    interval=self.input_size * self.period,
+                    timestamp=timestamp,
+                    table_id=self.table_id,
+                    project=self.project_id
+                )
+                job_config = bigquery.QueryJobConfig(query_parameters=[
+                    bigquery.ScalarQueryParameter('device_id', 'STRING', self.device_id)])
+                inputs = self.bqclient.query(query, job_config=job_config).result().to_dataframe()
+            self.cache_history(self.device_id, inputs)
+        self.cache_reading(self.device_id, timestamp, value)
+        inputs = self.prepare_inputs(inputs, timestamp, value)
+        return self.is_anomaly(inputs)
+
+    def detect_anomalies(self, readings: Sequence[Tuple[str, str, float]]) -> List[Optional[Tuple[Series, bool]]]:
+        """Detects anomalies for a batch of (device_id, timestamp, value) readings with a single history query
+        and a single multi-instance prediction request. Readings without enough history are returned as None.
+
+        The readings of a device are taken in timestamp order and each one gets the window `detect_anomaly`
+        builds for it: from the cache while it holds the device's window, else from the device windows or
+        the events table up to the device's last reading, merged with the device's readings of the batch
+        which may not be ingested yet."""
+        times = [to_datetime(timestamp, utc=True) for _, timestamp, _ in readings]
+        device_readings = {}
+        for i in sorted(range(len(readings)), key=times.__getitem__):
+            device_readings.setdefault(readings[i][0], []).append(i)
+        windows = [None] * len(readings)
+        # readings of the devices missed by the cache, from the first miss on
+        missed = {}
+        for device_id, indices in device_readings.items():
+            for k, i in enumerate(indices):
+                _, timestamp, value = readings[i]
+                window = self.get_cached_history(device_id, timestamp)
+                if window is None:
+                    missed[device_id] = indices[k:]
+                    break
+                windows[i] = window
+                self.cache_reading(device_id, timestamp, value)
+        histories = self.get_windows(list(missed)) if len(missed) > 0 else {}
+        queried = [device_id for device_id in missed if device_id not in histories]
+        if len(queried) > 0:
+            # the first missed and the last reading of every device bound the range of the query
+            history = self.get_batch_history([readings[i] for device_id in queried
+                                              for i in (missed[device_id][0], missed[device_id][-1])])
+            for device_id in queried:
+                histories[device_id] = history[history['deviceId'] == device_id][['timestamp', 'value']]
+        interval = Timedelta(seconds=self.input_size * self.period)
+        for device_id, indices in missed.items():
+            batch = DataFrame({'timestamp': [times[i] for i in device_readings[device_id]],
+                               'value': [readings[i][2] for i in device_readings[device_id]]})
+            history = concat([histories[device_id], batch], ignore_index=True) \
+                .drop_duplicates('timestamp', keep='last').sort_values('timestamp')
+            timestamps, values = list(history['timestamp']), list(history['value'])
+            for k, i in enumerate(indices):
+                _, timestamp, value = readings[i]
+                start, end = bisect_left(timestamps, times[i] - interval), bisect_left(timestamps, times[i])
+                windows[i] = DataFrame({'timestamp': timestamps[start:end], 'value': values[start:end]})
+                if k == 0:
+                    self.cache_history(device_id, windows[i])
+                self.cache_reading(device_id, timestamp, value)
+        inputs = []
+        for (_, timestamp, value), window in zip(readings, windows):
+            try:
+                inputs.append(self.prepare_inputs(window, timestamp, value))
+            except ValueError:
+                inputs.append(None)
+        results = iter(self.are_anomalies([series for series in inputs if series is not None],
+                                          [device_id for (device_id, _, _), series in zip(readings, inputs)
+                                           if series is not None]))
+        return [None if series is None else next(results) for series in inputs]
+
+    def get_batch_history(self, readings: Sequence[Tuple[str, str, float]]) -> DataFrame:
+        timestamps = [to_datetime(timestamp, utc=True) for _, timestamp, _ in readings]
+        query = PREVIOUS_ROWS_BATCH_QUERY_FMT.format(
             dataset=self.dataset,
             interval=self.input_size * self.period,
-            timestamp=timestamp,
             table_id=self.table_id,
             project=self.project_id
         )
-        inputs = self.bqclient.query(query).result().to_dataframe()
+        job_config = bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ArrayQueryParameter('ids', 'STRING', sorted({device_id for device_id, _, _ in readings})),
+            bigquery.ScalarQueryParameter('min_timestamp', 'TIMESTAMP', min(timestamps).to_pydatetime()),
+            bigquery.ScalarQueryParameter('max_timestamp', 'TIMESTAMP', max(timestamps).to_pydatetime()),
+        ])
+        history = self.bqclient.query(query, job_config=job_config).result().to_dataframe()
+        history['timestamp'] = to_datetime(history['timestamp'], utc=True)
+        return history
+
+    def get_windows(self, device_ids: Sequence[str]) -> Dict[str, DataFrame]:
+        """Readings of the device windows with a single lookup, devices without a window are missing"""
+        if self.windows is None:
+            return {}
+        return {device_id: DataFrame({'timestamp': to_datetime(window[0], utc=True), 'value': window[1]})
+                for device_id, window in self.windows.get(device_ids).items()}
+
+    def get_window_histories(self, readings: Sequence[Tuple[str, str, float]]) -> List[Optional[DataFrame]]:
+        """Histories of (device_id, timestamp, value) readings from the device windows with a single lookup,
+        None for the readings of devices without a window"""
+        if self.windows is None:
+            return [None] * len(readings)
+        device_windows = self.get_windows([device_id for device_id, _, _ in readings])
+        interval = Timedelta(seconds=self.input_size * self.period)
+        histories = []
+        for device_id, timestamp, _ in readings:
+            history = device_windows.get(device_id)
+            if history is None:
+                histories.append(None)
+                continue
+            current = to_datetime(timestamp, utc=True)
+            # the window may already hold the current reading if it was ingested first
+            histories.append(history[(history['timestamp'] >= current - interval)
+                                     & (history['timestamp'] < current)].reset_index(drop=True))
+        return histories
+
+    def get_cached_history(self, device_id: str, timestamp) -> Optional[DataFrame]:
+        if self.cache is None or device_id is None:
+            return None
+        cached = self.cache.get(device_id, timestamp)
+        if cached is None:
+            return None
+        timestamps, values = cached
+        return DataFrame({'timestamp': to_datetime(timestamps, unit='s', utc=True), 'value': values})
+
+    def cache_history(self, device_id: str, history: DataFrame):
+        if self.cache is not None and device_id is not None:
+            self.cache.fill(device_id, history['timestamp'], history['value'])
+
+    def cache_reading(self, device_id: str, timestamp, value):
+        if self.cache is not None and device_id is not None:
+            self.cache.put(device_id, timestamp, value)
+
+    def prepare_inputs(self, inputs: DataFrame, timestamp, value) -> Series:
         if len(inputs) != self.input_size:
             error_message = 'Not correct number of points before to detect an outlier: ' \
                             f'{len(inputs)} provided while {self.input_size} needed'
@@ -72,24 +241,30 @@ class PubSubDataProcessor:
         inputs['timestamp'] = to_datetime(inputs['timestamp'], utc=True)
         inputs.set_index('timestamp', inplace=True)
         inputs = inputs.sort_index()
-        inputs = inputs['value']
-        return self.is_anomaly(inputs)
-
-    def _set_endpoint(self, endpoint_name):
-        filter = f'display_name="{endpoint_name}"'
-        endpoint_info = None
-        for endpoint_info in aiplatform.Endpoint.list(filter=filter):
-            print(f"Endpoint display name = {endpoint_info.display_name} resource id = {endpoint_info.resource_name}")
-        
-        if endpoint_info is None:
-            raise ValueError(f"There is no endpoint `{endpoint_name}`")
-        else:
-            self.endpoint = aiplatform.Endpoint(endpoint_info.resource_name)
+        return inputs['value']
 
     def is_anomaly(self, inputs: Series):
-        serialized = serialize_pd(inputs)
-        prediction = self.endpoint.predict(instances=serialized)
-        prediction = prediction.predictions[0]
+        return self.are_anomalies([inputs], [self.device_id])[0]
+
+    def are_anomalies(self, inputs: Sequence[Series],
+                      device_ids: Optional[Sequence[str]] = None) -> List[Tuple[Series, bool]]:
+        if len(inputs) == 0:
+            return []
+        if device_ids is None:
+            device_ids = [None] * len(inputs)
+        serialized = [instance for series, device_id in zip(inputs, device_ids)
+                      for instance in serialize_pd(series, self.payload_format, self.period, device_id)]
+        try:
+            predictions = self.endpoint.predict(instances=serialized).predictions
+        except Exception as e:
+            # The endpoint may have been redeployed or recreated, resolving it again
+            logging.warning(f"Prediction failed, refreshing the endpoint `{self.endpoint_name}`: {e}")
+            self.clients.invalidate_endpoint(self.endpoint_name)
+            predictions = self.endpoint.predict(instances=serialized).predictions
+        return [self.prediction_row(series, prediction) for series, prediction in zip(inputs, predictions)]
+
+    @staticmethod
+    def prediction_row(inputs: Series, prediction: Sequence) -> Tuple[Series, bool]:
         is_anomaly, _, real, lower_bound, upper_bound = prediction
         is_anomaly = is_anomaly != 0
         row = DataFrame({
@@ -102,79 +277,107 @@ class PubSubDataProcessor:
         return row, is_anomaly
 
     def populate_vis_table(self, row):
+        self.populate_vis_table_batch([row])
+
+    def populate_vis_table_batch(self, rows: Sequence[Series]):
         destination_table_full_name = DESTINATION_TABLE_FMT.format(
             project=self.project_id, 
             dataset=self.dataset, 
             destination_table=self.destination_table)
-        errors = self.bqclient.insert_rows_json(destination_table_full_name, [row.dropna().to_dict()])
+        errors = self.bqclient.insert_rows_json(destination_table_full_name, [row.dropna().to_dict() for row in rows])
         if errors == []:
             logging.info("New rows have been added.")
         else:
             logging.error(
                 "Encountered errors while inserting rows: {}".format(errors))
 
-    def set_device_communicator(self):
-        if self.device_com is None:
-            self.client = DeviceManagerClient()
-            self.device_com = DeviceCommunicator(
-                client=self.client,
+    def set_device_communicator(self, device_id: Optional[str] = None) -> DeviceCommunicator:
+        device_id = device_id or self.device_id
+        if device_id not in self.device_coms:
+            self.device_coms[device_id] = DeviceCommunicator(
+                client=self.clients.device_manager,
                 project_id=self.project_id,
                 cloud_region=self.cloud_region,
                 registry_id=self.registry_id,
-                device_id=self.device_id
+                device_id=device_id
             )
+        return self.device_coms[device_id]
 
-    def feedback_to_device(self, anomaly_detection_result):
-        if self.device_com is None:
-            self.set_device_communicator()
+    def feedback_to_device(self, anomaly_detection_result, device_id: Optional[str] = None):
+        device_com = self.set_device_communicator(device_id)
 
         if anomaly_detection_result['value'] > anomaly_detection_result["upper_bound"]:
             command = COMMAND_FMT.format(
                 timestamp=anomaly_detection_result['timestamp'],
                 value=anomaly_detection_result['value']
             )
-            self.device_com.send_command(command=command)
+            device_com.send_command(command=command)
             logging.info(f"Command sent: {command}")
         elif anomaly_detection_result['value'] < anomaly_detection_result["lower_bound"]:
             turn_off_config = dumps({'enabled': False})
-            self.device_com.set_config(config=turn_off_config)
+            device_com.set_config(config=turn_off_config)
             logging.info(f"Config was changed: {turn_off_config}")
 
 
+def parse_readings(data: bytes, attributes: Dict) -> List[Tuple[str, str, float]]:
+    """Extracts (device_id, timestamp, value) of every reading from the IoT message payload and attributes"""
+    return [(attributes['deviceId'], reading['timestamp'], reading['value'])
+            for reading in decode_readings(data, attributes)]
 
-def main(event, context):
+
+def get_processor(device_id: Optional[str] = None) -> PubSubDataProcessor:
     # Get Environment variables
     project_id = environ.get('project_id')
-    cloud_region = environ.get('cloud_region')
-    device_id = event['attributes']['deviceId']
-    registry_id = environ.get('registry_id')
-    dataset = environ.get('dataset')
-    endpoint_name = environ.get('endpoint_name')
     input_size = int(environ.get('input_size'))
     period = int(environ.get('period'))
-    table_id = environ.get('table_id')
-    destination_table = environ.get('destination_table')
     #Setting up Cloud and initializing the processor
-    client = GCPLogClient()
-    client.setup_logging()
-    aiplatform.init(project=project_id)
+    clients = get_clients(project_id, endpoint_ttl=int(environ.get('endpoint_ttl', 600)))
+    clients.setup_logging()
 
-    processor = PubSubDataProcessor(
+    return PubSubDataProcessor(
         project_id=project_id,
-        cloud_region=cloud_region,
-        registry_id=registry_id,
+        cloud_region=environ.get('cloud_region'),
+        registry_id=environ.get('registry_id'),
         device_id=device_id,
-        dataset=dataset,
+        dataset=environ.get('dataset'),
         input_size=input_size,
         period=period,
-        endpoint_name=endpoint_name,
-        destination_table=destination_table,
-        table_id=table_id,
+        endpoint_name=environ.get('endpoint_name'),
+        destination_table=environ.get('destination_table'),
+        table_id=environ.get('table_id'),
+        clients=clients,
+        cache=get_readings_cache(input_size, period),
+        payload_format=environ.get('payload_format', 'legacy'),
+        windows=get_device_windows(clients, input_size),
     )
+
+
+def process_readings(processor: PubSubDataProcessor, readings: List[Tuple[str, str, float]]) -> int:
+    """Processes readings as one micro-batch: one history query, one prediction request and one insert"""
+    # Detect anomalies
+    results = processor.detect_anomalies(readings)
+    detected = [(reading, result) for reading, result in zip(readings, results) if result is not None]
+    logging.info(f"{len(detected)} of {len(readings)} readings processed")
+    # Populating visualization table
+    if len(detected) > 0:
+        processor.populate_vis_table_batch([anomaly_row for _, (anomaly_row, _) in detected])
+    # If anomaly is detected, send the feedback
+    for (device_id, _, _), (anomaly_row, is_anomaly) in detected:
+        if is_anomaly:
+            processor.feedback_to_device(anomaly_row, device_id=device_id)
+    return len(detected)
+
+
+def main(event, context):
+    processor = get_processor(device_id=event['attributes']['deviceId'])
     # Extracting IoT data
-    data = loads(b64decode(event['data']).decode('utf-8'))
-    timestamp = data['timestamp']
-    value = data['value']
+    readings = parse_readings(b64decode(event['data']), event['attributes'])
+    if len(readings) > 1:
+        # A batch published by the device
+        process_readings(processor, readings)
+        processor.cache.log_stats()
+        return
+    _, timestamp, value = readings[0]
 
     # Detect anomalies
     anomaly_row, is_anomaly = processor.detect_anomaly(timestamp, value)
@@ -184,3 +387,21 @@ def main(event, context):
     # If anomaly is detected, send the feedback
     if is_anomaly is not None and is_anomaly:
         processor.feedback_to_device(anomaly_row)
+    processor.cache.log_stats()
+
+
+def main_batch(request):
+    """Pulls up to `batch_size` messages from the `subscription` and processes their readings as one micro-batch"""
+    subscription = environ.get('subscription')
+    batch_size = int(environ.get('batch_size', 500))
+    processor = get_processor()
+    with pubsub_v1.SubscriberClient() as subscriber:
+        response = subscriber.pull(request={'subscription': subscription, 'max_messages': batch_size})
+        messages = response.received_messages
+        if len(messages) == 0:
+            return "No messages", 200
+        readings = [reading for m in messages for reading in parse_readings(m.message.data, m.message.attributes)]
+        processed = process_readings(processor, readings)
+        subscriber.acknowledge(request={'subscription': subscription, 'ack_ids': [m.ack_id for m in messages]})
+    processor.cache.log_stats()
+    return f"Processed {processed} readings", 200
@@ -0,0 +1,41 @@
+from base64 import b64encode
+from json import dumps
+from typing import Optional
+
+from pandas import Series
+
+PAYLOAD_VERSION = 2
+# legacy - pandas JSON of the series, array - flat JSON array of values,
+# float32 - base64 of little-endian float32 values with the start timestamp and period
+PAYLOAD_FORMATS = ('legacy', 'array', 'float32')
+
+
+def serialize_pd(series: Series, payload_format: str = 'legacy', period: int = 0, device_id: Optional[str] = None):
+    """Serializes the sorted input series into a prediction instance,
+    `device_id` routes it to the device's detector of a fleet model"""
+    if payload_format == 'legacy':
+        obj = {
+            'timestamp': str(series.index[-1]),
+            'values': series.to_json()
+        }
+    elif payload_format == 'array':
+        obj = {
+            'version': PAYLOAD_VERSION,
+            'timestamp': str(series.index[-1]),
+            'values': series.values.tolist()
+        }
+    elif payload_format == 'float32':
+        obj = {
+            'version': PAYLOAD_VERSION,
+            'encoding': 'float32',
+            'timestamp': str(series.index[-1]),
+            'start': int(series.index[0].timestamp()),
+            'period': period,
+            'values': b64encode(series.values.astype('<f4').tobytes()).decode('ascii')
+        }
+    else:
+        raise ValueError(f"Unknown payload format `{payload_format}`, expected one of {PAYLOAD_FORMATS}")
+    if device_id is not None:
+        obj['deviceId'] = device_id
+    b64_encoded = b64encode(dumps(obj).encode('utf-8'))
+    return [{"data": {"b64": b64_encoded.decode('utf-8')}}]
@@ -0,0 +1,109 @@
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Sequence, Tuple
+
+import numpy as np
+from pandas import to_datetime
+
+
+class DeviceWindow():
+    """Fixed-size ring buffer with the latest readings of a single device"""
+
+    def __init__(self, size: int) -> None:
+        self.timestamps = np.zeros(size, dtype=np.int64)
+        self.values = np.zeros(size, dtype=np.float64)
+        self.size = size
+        self.head = 0  # position of the next write
+        self.count = 0
+        self.updated = time.monotonic()
+
+    def append(self, timestamp: int, value: float) -> None:
+        if self.count > 0 and timestamp <= self.timestamps[self.head - 1]:
+            # Ignoring duplicated and out of order readings
+            return
+        self.timestamps[self.head] = timestamp
+        self.values[self.head] = value
+        self.head = (self.head + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+        self.updated = time.monotonic()
+
+    def ordered(self) -> Tuple[np.ndarray, np.ndarray]:
+        if self.count < self.size:
+            return self.timestamps[:self.count], self.values[:self.count]
+        order = np.r_[self.head:self.size, 0:self.head]
+        return self.timestamps[order], self.values[order]
+
+
+class ReadingsCache():
+    """Per-device rolling windows of recent readings kept in a warm function instance.
+
+    A window is served only when it holds exactly `size` readings within `size * period` seconds before
+    the requested timestamp and has no gaps longer than `period`, so it matches what the history query returns.
+    Least recently used devices are evicted above `max_devices`, windows not updated for `ttl` seconds expire.
+    """
+
+    def __init__(self, size: int, period: int, max_devices: int = 10000, ttl: int = 3600) -> None:
+        self.size = size
+        self.period = period
+        self.max_devices = max_devices
+        self.ttl = ttl
+        self.windows: Dict[str, DeviceWindow] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.gaps = 0
+
+    @staticmethod
+    def to_epoch(timestamp) -> int:
+        return int(to_datetime(timestamp, utc=True).timestamp())
+
+    def _window(self, device_id: str) -> Optional[DeviceWindow]:
+        window = self.windows.get(device_id)
+        if window is not None and time.monotonic() - window.updated > self.ttl:
+            del self.windows[device_id]
+            window = None
+        if window is not None:
+            self.windows.move_to_end(device_id)
+        return window
+
+    def get(self, device_id: str, timestamp) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """Returns (epoch seconds, values) of the readings before `timestamp` or None on a miss or a gap"""
+        window = self._window(device_id)
+        if window is None or window.count < self.size:
+            self.misses += 1
+            return None
+        current = self.to_epoch(timestamp)
+        timestamps, values = window.ordered()
+        if (timestamps[0] < current - self.size * self.period or timestamps[-1] >= current
+                or np.any(np.diff(np.r_[timestamps, current]) > self.period)):
+            self.gaps += 1
+            self.misses += 1
+            return None
+        self.hits += 1
+        return timestamps, values
+
+    def put(self, device_id: str, timestamp, value: float) -> None:
+        window = self._window(device_id)
+        if window is None:
+            window = self.windows[device_id] = DeviceWindow(self.size)
+            while len(self.windows) > self.max_devices:
+                self.windows.popitem(last=False)
+        window.append(self.to_epoch(timestamp), value)
+
+    def fill(self, device_id: str, timestamps: Sequence, values: Sequence[float]) -> None:
+        """Fills the device window with the history fetched from BigQuery"""
+        for timestamp, value in zip(timestamps, values):
+            self.put(device_id, timestamp, value)
+
+    def stats(self) -> Dict:
+        total = self.hits + self.misses
+        return {
+            'devices': len(self.windows),
+            'hits': self.hits,
+            'misses': self.misses,
+            'gaps': self.gaps,
+            'hit_rate': self.hits / total if total else 0.,
+        }
+
+    def log_stats(self) -> None:
+        logging.info(f"Readings cache: {self.stats()}")
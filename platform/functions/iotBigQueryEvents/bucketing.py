@@ -0,0 +1,76 @@
+from datetime import datetime, timedelta, timezone
+from typing import Iterable
+
+ISO_FORMAT = '%Y-%m-%dT%H:%M:%S'
+EPOCH = datetime(1970, 1, 1)
+ONE_SECOND = timedelta(seconds=1)
+
+
+def parse_epoch(timestamp: str, ts_format: str = ISO_FORMAT) -> int:
+    """Epoch seconds of a timestamp, naive timestamps are taken as UTC.
+
+    ISO-8601 timestamps are parsed with `datetime.fromisoformat`, several times faster than `strptime`,
+    which is used only for other formats.
+    """
+    if ts_format == ISO_FORMAT:
+        dt = datetime.fromisoformat(timestamp)
+    else:
+        dt = datetime.strptime(timestamp, ts_format)
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return (dt - EPOCH) // ONE_SECOND
+
+
+def format_epoch(epoch: int, ts_format: str = ISO_FORMAT) -> str:
+    """UTC timestamp of epoch seconds in `ts_format`"""
+    dt = EPOCH + timedelta(seconds=epoch)
+    if ts_format == ISO_FORMAT:
+        return dt.isoformat()
+    return dt.strftime(ts_format)
+
+
+class TimeBuckets():
+    """Floors epoch seconds to `date_point + N * interval_sec` buckets in integer UTC arithmetic.
+
+    `date_point` is parsed once, single values and NumPy arrays of epoch seconds or timestamps are bucketed
+    with the same arithmetic.
+    """
+
+    def __init__(self, date_point: str, interval_sec: int, ts_format: str = ISO_FORMAT) -> None:
+        self.ts_format = ts_format
+        self.interval_sec = int(interval_sec)
+        self.point = parse_epoch(date_point, ts_format)
+
+    def parse(self, timestamp: str) -> int:
+        return parse_epoch(timestamp, self.ts_format)
+
+    def format(self, epoch: int) -> str:
+        return format_epoch(epoch, self.ts_format)
+
+    def bucket(self, epoch: int) -> int:
+        # Python's modulo is non-negative for epochs before the date point too
+        return epoch - (epoch - self.point) % self.interval_sec
+
+    def bucket_timestamp(self, timestamp: str) -> int:
+        return self.bucket(self.parse(timestamp))
+
+    def bucket_array(self, epochs):
+        """Buckets an array of epoch seconds in one vectorized call"""
+        import numpy as np
+        epochs = np.asarray(epochs, dtype=np.int64)
+        return epochs - (epochs - self.point) % self.interval_sec
+
+    def parse_array(self, timestamps: Iterable[str]):
+        """Epoch seconds of timestamps as an int64 array, ISO-8601 timestamps are parsed by NumPy as a whole"""
+        import warnings
+        import numpy as np
+        timestamps = list(timestamps)
+        if self.ts_format == ISO_FORMAT:
+            try:
+                with warnings.catch_warnings():
+                    # NumPy only warns on time zone offsets, they are left to `parse_epoch`
+                    warnings.simplefilter('error')
+                    return np.array(timestamps, dtype='datetime64[s]').astype(np.int64)
+            except (ValueError, UserWarning):
+                pass
+        return np.array([parse_epoch(t, self.ts_format) for t in timestamps], dtype=np.int64)
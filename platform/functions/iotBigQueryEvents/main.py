@@ -1,35 +1,221 @@
 import base64
-import json
 import logging
 import os
-from datetime import datetime
+import time
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 
 import google.cloud.logging
-from google.cloud import bigquery
+from google.api_core.exceptions import DeadlineExceeded
+from google.cloud import bigquery, bigquery_storage_v1, pubsub_v1
+
+from bucketing import ISO_FORMAT, TimeBuckets
+from device_windows import DeviceWindowsTable
+from reading import decode_readings
+from storage_write import RowsWriter
+
+
+class SharedClients():
+    """Lazily created clients reused by the invocations of a warm function instance"""
+
+    def __init__(self) -> None:
+        self._log_client = None
+        self._bigquery = None
+        self._bigquery_write = None
+
+    def setup_logging(self) -> None:
+        if self._log_client is None:
+            self._log_client = google.cloud.logging.Client()
+            self._log_client.setup_logging()
+
+    @property
+    def bigquery(self) -> bigquery.Client:
+        if self._bigquery is None:
+            self._bigquery = bigquery.Client()
+        return self._bigquery
+
+    @property
+    def bigquery_write(self) -> bigquery_storage_v1.BigQueryWriteClient:
+        if self._bigquery_write is None:
+            self._bigquery_write = bigquery_storage_v1.BigQueryWriteClient()
+        return self._bigquery_write
+
+
+CLIENTS = SharedClients()
+# Bucketing of the environment's date point and interval, created once per instance
+BUCKETS: Optional[TimeBuckets] = None
+
+
+def get_buckets() -> TimeBuckets:
+    global BUCKETS
+    if BUCKETS is None:
+        BUCKETS = TimeBuckets(os.environ.get('date_point', '2011-08-03T23:25:01'),
+                              int(os.environ.get('interval_sec', 60)),
+                              os.environ.get('ts_format', ISO_FORMAT))
+    return BUCKETS
+
+
+def get_device_windows() -> Optional[DeviceWindowsTable]:
+    """Latest readings of every device kept for the anomaly detection if `windows_table` is set"""
+    table = os.environ.get('windows_table')
+    if not table:
+        return None
+    return DeviceWindowsTable(CLIENTS.bigquery, f"{os.environ.get('project_id')}.{os.environ.get('dataset')}.{table}",
+                              size=int(os.environ.get('window_size', 25)))
+
+
+def update_device_windows(windows: DeviceWindowsTable, rows: List[Tuple[int, float, str]]) -> None:
+    """Appends the rows to the device windows, failures are logged as the rows are already written
+    and the detector falls back to the events table for stale windows"""
+    try:
+        windows.update(rows)
+    except Exception as e:
+        logging.warning(f'Failed to update the device windows of {len(rows)} rows: {e}')
+
+
+def event_rows(data: bytes, attributes: Dict) -> List[Tuple[int, float, str]]:
+    """(epoch seconds rounded to the interval, value, device id) rows of the readings in a message"""
+    buckets = get_buckets()
+    rows = []
+    for reading in decode_readings(data, attributes):
+        # binary readings carry epoch seconds, no need to parse the timestamp
+        epoch = reading['epoch'] if 'epoch' in reading else buckets.parse(reading['timestamp'])
+        # round timestamp to (date_point+N*interval_sec) value
+        rows.append((buckets.bucket(epoch), float(reading['value']), attributes['deviceId']))
+    return rows
+
+
+def messages_rows(messages: Iterable[Tuple[bytes, Dict]]) -> Tuple[List[Tuple[int, float, str]], List[int]]:
+    """The same rows as `event_rows` for many messages, timestamps are parsed and bucketed as arrays.
+    Returns the rows and the index of the message of every row"""
+    import numpy as np
+    buckets = get_buckets()
+    epochs, values, device_ids, timestamps, timestamp_rows, row_messages = [], [], [], [], [], []
+    for i, (data, attributes) in enumerate(messages):
+        for reading in decode_readings(data, attributes):
+            if 'epoch' in reading:
+                epochs.append(reading['epoch'])
+            else:
+                timestamp_rows.append(len(epochs))
+                timestamps.append(reading['timestamp'])
+                epochs.append(0)
+            values.append(float(reading['value']))
+            device_ids.append(attributes['deviceId'])
+            row_messages.append(i)
+    epochs = np.array(epochs, dtype=np.int64)
+    if timestamps:
+        epochs[timestamp_rows] = buckets.parse_array(timestamps)
+    return list(zip(buckets.bucket_array(epochs).tolist(), values, device_ids)), row_messages
+
+
+def append_messages_rows(rows_writer: RowsWriter, rows: List[Tuple[int, float, str]],
+                         row_messages: List[int]) -> Tuple[List[Tuple[int, float, str]], Set[int]]:
+    """Appends the rows of buffered messages, returns the rows written and the indexes of the messages
+    with rejected rows. None of the rows of such a message are written, so it can be redelivered"""
+    rejected = rows_writer.append(rows)
+    if not rejected:
+        return rows, set()
+    failed = {row_messages[i] for i in rejected}
+    rows = [row for row, message in zip(rows, row_messages) if message not in failed]
+    if rows_writer.append(rows):
+        # rows rejected along with the others of the request, none of them were appended
+        return [], set(row_messages)
+    return rows, failed
+
+
+def pull_messages(subscriber: pubsub_v1.SubscriberClient, subscription: str, max_messages: int, timeout: float) -> List:
+    """Received messages of a pull, none once the pull times out on an idle subscription"""
+    try:
+        response = subscriber.pull(request={'subscription': subscription, 'max_messages': max_messages},
+                                   timeout=timeout)
+    except DeadlineExceeded:
+        return []
+    return list(response.received_messages)
 
 
 def iot_events_to_bq(event, context):
-    log_client = google.cloud.logging.Client()
-    log_client.setup_logging()
-    data = json.loads(base64.b64decode(event['data']).decode('utf-8'))
-    DATE_POINT = os.environ.get('date_point', '2011-08-03T23:25:01')
-    INTERVAL_SEC = int(os.environ.get('interval_sec', 60))
-    TS_FORMAT = os.environ.get('ts_format', '%Y-%m-%dT%H:%M:%S')
-    ts_point = datetime.strptime(DATE_POINT, TS_FORMAT).timestamp()
-    ts_input = datetime.strptime(data['timestamp'], TS_FORMAT).timestamp()
-    # round timestamp to (date_point+N*interval_sec) value
-    ts = (ts_input - ts_point) // INTERVAL_SEC * INTERVAL_SEC + ts_point
-    rows = [{'timestamp': datetime.fromtimestamp(ts).strftime(TS_FORMAT),
-             'value': data['value'],
-             'deviceId': event['attributes']['deviceId']}]
-    bq_client = bigquery.Client()
+    CLIENTS.setup_logging()
+    buckets = get_buckets()
+    events = event_rows(base64.b64decode(event['data']), event['attributes'])
+    rows = [{'timestamp': buckets.format(ts),
+             'value': value,
+             'deviceId': device_id}
+            for ts, value, device_id in events]
     PROJECT_ID = os.environ.get('project_id')
     DATASET = os.environ.get('dataset')
     TABLE = os.environ.get('table_id')
     table_id = f'{PROJECT_ID}.{DATASET}.{TABLE}'
-    errors = bq_client.insert_rows_json(table_id, rows)
+    errors = CLIENTS.bigquery.insert_rows_json(table_id, rows)
     if errors == []:
         logging.info('New rows have been added.')
     else:
         logging.warning(
             'Encountered errors while inserting rows: {}'.format(errors))
+    # a MERGE per message runs into the DML concurrency limits of the table, the windows table is meant
+    # for the batched ingest and is not set for this function by default
+    windows = get_device_windows()
+    if windows is not None:
+        update_device_windows(windows, events)
+
+
+def iot_events_to_bq_batch(request):
+    """Pulls messages from the `subscription` and appends their rows through the BigQuery Storage Write API.
+
+    Rows are flushed, and their messages acknowledged, every `max_rows` rows, `max_bytes` bytes of messages
+    or `max_age` seconds since the first buffered message, until the subscription is drained or there is
+    no time left for a pull of up to `max_age` seconds and a flush of up to `flush_time` seconds within
+    `max_runtime`. Messages with rows rejected by BigQuery are not acknowledged and are redelivered.
+    """
+    CLIENTS.setup_logging()
+    subscription = os.environ.get('subscription')
+    max_rows = int(os.environ.get('max_rows', 5000))
+    max_bytes = int(os.environ.get('max_bytes', 5 * 1024 * 1024))
+    max_age = float(os.environ.get('max_age', 5))
+    max_runtime = float(os.environ.get('max_runtime', 50))
+    flush_time = float(os.environ.get('flush_time', 10))
+    rows_writer = RowsWriter(os.environ.get('project_id'), os.environ.get('dataset'), os.environ.get('table_id'),
+                             stream_type=os.environ.get('write_stream', 'default'), client=CLIENTS.bigquery_write)
+    windows = get_device_windows()
+    started = time.monotonic()
+    written, redelivered = 0, 0
+    rows, row_messages, ack_ids, size, buffered_at = [], [], [], 0, None
+
+    def out_of_time() -> bool:
+        # the next pull and the flush after it must end within max_runtime, before the function times out
+        return time.monotonic() - started + max_age + flush_time >= max_runtime
+
+    with pubsub_v1.SubscriberClient() as subscriber:
+        while True:
+            messages = pull_messages(subscriber, subscription, min(max_rows, 1000), max_age)
+            message_rows, message_indexes = messages_rows((m.message.data, m.message.attributes) for m in messages)
+            rows.extend(message_rows)
+            row_messages.extend(len(ack_ids) + i for i in message_indexes)
+            for m in messages:
+                ack_ids.append(m.ack_id)
+                size += len(m.message.data)
+            if buffered_at is None and messages:
+                buffered_at = time.monotonic()
+            drained = len(messages) == 0
+            stop = drained or out_of_time()
+            if ack_ids and (stop or len(rows) >= max_rows or size >= max_bytes
+                            or time.monotonic() - buffered_at >= max_age):
+                rows, failed = append_messages_rows(rows_writer, rows, row_messages)
+                if windows is not None and rows:
+                    update_device_windows(windows, rows)
+                acked = [ack_id for i, ack_id in enumerate(ack_ids) if i not in failed]
+                if acked:
+                    subscriber.acknowledge(request={'subscription': subscription, 'ack_ids': acked})
+                if failed:
+                    subscriber.modify_ack_deadline(request={'subscription': subscription,
+                                                            'ack_ids': [ack_ids[i] for i in sorted(failed)],
+                                                            'ack_deadline_seconds': 0})
+                written += len(rows)
+                redelivered += len(failed)
+                rows, row_messages, ack_ids, size, buffered_at = [], [], [], 0, None
+                stop = stop or out_of_time()
+            if stop:
+                break
+    rows_writer.close()
+    if redelivered:
+        logging.warning(f'{redelivered} messages with rejected rows left for redelivery.')
+    logging.info(f'{written} rows have been appended.')
+    return f"Appended {written} rows", 200
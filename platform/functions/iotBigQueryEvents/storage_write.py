@@ -0,0 +1,94 @@
+import logging
+from typing import List, Optional, Sequence, Tuple
+
+from google.cloud import bigquery_storage_v1
+from google.cloud.bigquery_storage_v1 import types, writer
+from google.protobuf import descriptor_pb2, descriptor_pool, message_factory
+
+STREAM_TYPES = ('default', 'committed')
+
+
+def row_message_class():
+    """Protobuf message of an iot_events row: timestamp as epoch microseconds, value and deviceId"""
+    file_proto = descriptor_pb2.FileDescriptorProto(name='iot_event_row.proto', package='iot', syntax='proto2')
+    message_proto = file_proto.message_type.add(name='IotEventRow')
+    for number, (name, field_type) in enumerate([
+            ('timestamp', descriptor_pb2.FieldDescriptorProto.TYPE_INT64),
+            ('value', descriptor_pb2.FieldDescriptorProto.TYPE_DOUBLE),
+            ('deviceId', descriptor_pb2.FieldDescriptorProto.TYPE_STRING)], start=1):
+        message_proto.field.add(name=name, number=number, type=field_type,
+                                label=descriptor_pb2.FieldDescriptorProto.LABEL_OPTIONAL)
+    pool = descriptor_pool.DescriptorPool()
+    pool.Add(file_proto)
+    descriptor = pool.FindMessageTypeByName('iot.IotEventRow')
+    if hasattr(message_factory, 'GetMessageClass'):
+        return message_factory.GetMessageClass(descriptor)
+    return message_factory.MessageFactory(pool).GetPrototype(descriptor)
+
+
+class RowsWriter():
+    """Appends (epoch seconds, value, device id) rows to a BigQuery table through the Storage Write API.
+
+    The `default` stream commits rows as soon as they are appended. With `committed` every writer creates
+    its own stream and appends with offsets, so a retried append can not duplicate rows.
+    """
+
+    def __init__(self, project_id: str, dataset: str, table_id: str, stream_type: str = 'default',
+                 client: Optional[bigquery_storage_v1.BigQueryWriteClient] = None) -> None:
+        if stream_type not in STREAM_TYPES:
+            raise ValueError(f"Unknown stream type `{stream_type}`, expected one of {STREAM_TYPES}")
+        self.client = client or bigquery_storage_v1.BigQueryWriteClient()
+        self.table_path = self.client.table_path(project_id, dataset, table_id)
+        self.stream_type = stream_type
+        self.row_class = row_message_class()
+        self.stream = None
+        self.stream_name = None
+        self.offset = 0
+
+    def open(self) -> None:
+        if self.stream_type == 'committed':
+            write_stream = self.client.create_write_stream(
+                parent=self.table_path,
+                write_stream=types.WriteStream(type_=types.WriteStream.Type.COMMITTED))
+            self.stream_name = write_stream.name
+        else:
+            self.stream_name = f'{self.table_path}/streams/_default'
+        proto_schema = types.ProtoSchema()
+        proto_descriptor = descriptor_pb2.DescriptorProto()
+        self.row_class.DESCRIPTOR.CopyToProto(proto_descriptor)
+        proto_schema.proto_descriptor = proto_descriptor
+        request_template = types.AppendRowsRequest(
+            write_stream=self.stream_name,
+            proto_rows=types.AppendRowsRequest.ProtoData(writer_schema=proto_schema))
+        self.stream = writer.AppendRowsStream(self.client, request_template)
+        self.offset = 0
+
+    def append(self, rows: Sequence[Tuple[int, float, str]]) -> List[int]:
+        """Appends rows and waits for the result, returns the indexes of the rows rejected by BigQuery.
+        A request with row errors appends none of its rows."""
+        if len(rows) == 0:
+            return []
+        if self.stream is None:
+            self.open()
+        proto_rows = types.ProtoRows()
+        for epoch, value, device_id in rows:
+            proto_rows.serialized_rows.append(
+                self.row_class(timestamp=epoch * 1000000, value=value, deviceId=device_id).SerializeToString())
+        request = types.AppendRowsRequest(proto_rows=types.AppendRowsRequest.ProtoData(rows=proto_rows))
+        if self.stream_type == 'committed':
+            request.offset = self.offset
+        response = self.stream.send(request).result()
+        if response.row_errors:
+            logging.warning(f'Encountered errors while appending rows: {response.row_errors}')
+            # none of the rows were appended, the offset stays
+            return [error.index for error in response.row_errors]
+        self.offset += len(rows)
+        return []
+
+    def close(self) -> None:
+        if self.stream is None:
+            return
+        self.stream.close()
+        if self.stream_type == 'committed':
+            self.client.finalize_write_stream(name=self.stream_name)
+        self.stream = None
@@ -22,9 +22,11 @@ ENDPOINT_NAME = os.environ.get("endpoint_name")
 TRAINING_PACKAGE = os.environ.get("training_package")
 DATA_LOCATION = os.environ.get("data_location")
 PIPELINE_ROOT_FOLDER = os.environ.get("pipeline_root")
+# Serving image built once, it loads the model artifacts of AIP_STORAGE_URI at startup
 PREDICTOR_IMAGE = os.environ.get("predictor_image")
-REPOSITORY = os.environ.get("repository")
 REGION = os.environ.get("region")
+# sgd, or lstsq and huber to fit the linear detector in closed form
+TRAINER_SOLVER = os.environ.get("trainer_solver", "sgd")
 
 NOW = datetime.datetime.now()
 BUCKET_URI = f"gs://{BUCKET_NAME}"
@@ -41,40 +43,11 @@ TRAINER_POOL_SPEC = {
         "executorImageUri": "us-docker.pkg.dev/vertex-ai/training/pytorch-xla.1-11:latest",
         "packageUris": [f"{BUCKET_URI}/{TRAINING_PACKAGE}"],
         "pythonModule": "trainer.task",
-        "args": ['-d', f'{BUCKET_URI}/{DATA_LOCATION}', '-l', '0.0001'],
+        "args": ['-d', f'{BUCKET_URI}/{DATA_LOCATION}', '-l', '0.0001', '--solver', TRAINER_SOLVER],
     }
 }
 
 
-@dsl.component(base_image=PREDICTOR_IMAGE)
-def predictor_creation_op(model_dir: str, project: str, repository: str, image: dsl.OutputPath(str)):
-    import os
-    import yaml
-    from datetime import datetime
-    NOW = datetime.now()
-    project_set = os.system(f"gcloud config set project {project}")
-    assert project_set == 0, 'Error in setting google cloud project!'
-    files_downloaded = os.system(
-        f'gsutil cp {model_dir}/model/pytorch_model.bin {model_dir}/model/config.json /home/iot/')
-    assert files_downloaded == 0, 'Error in downloading model data!'
-    DOCKER_TAG = "torch-ts-anomaly-predictor:" + NOW.strftime('%Y-%m-%d')
-    FULL_TAG = repository + '/' + DOCKER_TAG
-
-    with open('/home/iot/cloudbuild.yaml') as f:
-        config = yaml.load(f, yaml.SafeLoader)
-    # Build substitution
-    config['steps'][0]['args'][2] = FULL_TAG
-    # Push substitution
-    config['steps'][1]['args'][1] = FULL_TAG
-    with open('/home/iot/cloudbuild.yaml', 'w') as f:
-        config = yaml.dump(config, f, yaml.SafeDumper)
-
-    image_build = os.system(f'gcloud builds submit --config /home/iot/cloudbuild.yaml /home/iot/')
-    assert image_build == 0, 'Error in building Predictor image!'
-    with open(image, 'w') as f:
-        f.write(FULL_TAG)
-
-
 @dsl.component(base_image='python:3.9',
                packages_to_install=['google-cloud-aiplatform==1.16.1'])
 def get_endpoint(project: str, bucket: str, endpoint_name: str, region: str, endpoint_out: dsl.Output[dsl.Artifact]):
@@ -93,7 +66,7 @@ def get_endpoint(project: str, bucket: str, endpoint_name: str, region: str, end
 
 
 @dsl.pipeline(name=DISPLAY_NAME)
-def pipeline(project: str, bucket: str, predictor_repository: str, endpoint_name: str, region: str):
+def pipeline(project: str, bucket: str, endpoint_name: str, region: str):
     working_dir = PIPELINE_ROOT + f"{dsl.PIPELINE_JOB_ID_PLACEHOLDER}-{NOW.strftime('%Y%m%d')}"
     # Training the model
     custom_job_task = CustomTrainingJobOp(
@@ -104,21 +77,19 @@ def pipeline(project: str, bucket: str, predictor_repository: str, endpoint_name
     )
     # Get the endpoint
     endpoint_get_task = get_endpoint(project, bucket, endpoint_name, region)
-    # Preparing Vertex AI Predictor compatible Docker image
-    predictor = predictor_creation_op(working_dir, project, predictor_repository).after(custom_job_task)
-    # Import the prepared image
+    # Import the trained artifacts with the serving image, Vertex AI passes them as AIP_STORAGE_URI
     model = importer_node.importer(
-        artifact_uri=working_dir,
+        artifact_uri=f"{working_dir}/model",
         artifact_class=artifact_types.UnmanagedContainerModel,
         metadata={
             "containerSpec": {
-                "imageUri": predictor.outputs['image'],
+                "imageUri": PREDICTOR_IMAGE,
                 "ports": ([{"containerPort": 7080}, ]),
                 "predictRoute": "/predictions/anomaly",
                 "healthRoute": "/ping"
             },
         },
-    )
+    ).after(custom_job_task)
     # Adding model to VertexAI Model Registry
     upload_model = ModelUploadOp(
         project=project,
@@ -155,7 +126,6 @@ def main(request):
         parameter_values={
             'project': PROJECT_ID,
             'bucket': BUCKET_NAME,
-            'predictor_repository': REPOSITORY,
             'endpoint_name': ENDPOINT_NAME,
             'region': REGION
         },
@@ -1,14 +1,35 @@
+import calendar
 import datetime
 import json
 import logging
 import random
 import ssl
+import threading
 import time
 from json.decoder import JSONDecodeError
-from typing import Dict, Sequence
+from typing import Iterable, Optional, Sequence, Tuple
 
 import jwt
 import paho.mqtt.client as mqtt
+from cryptography.hazmat.primitives import serialization
+
+from reading import BINARY_SUBFOLDER, encode_reading
+from replay import Checkpoint, Reading
+
+# Private keys loaded once per process, shared by the clients signing with the same key file
+SIGNING_KEYS = {}
+# A new token is signed and the connection renewed at a random point of this part of the token lifetime,
+# so that devices started together do not reconnect together
+TOKEN_REFRESH_RANGE = (0.7, 0.9)
+
+
+def load_signing_key(private_key_file: str):
+    key = SIGNING_KEYS.get(private_key_file)
+    if key is None:
+        with open(private_key_file, "rb") as f:
+            key = serialization.load_pem_private_key(f.read(), password=None)
+        SIGNING_KEYS[private_key_file] = key
+    return key
 
 
 class Client():
@@ -29,6 +50,11 @@ class Client():
                  use_input_timestamp: bool = False,
                  input_ts_format: str = '%Y-%m-%d %H:%M:%S',
                  output_ts_format: str = '%Y-%m-%dT%H:%M:%S',
+                 message_encoding: str = 'json',
+                 batch_size: int = 1,
+                 batch_interval: float = 300,
+                 send_interval: float = 60,
+                 use_tls: bool = True,
                  **kwargs
                  ) -> None:
         self.project_id = project_id
@@ -40,15 +66,29 @@ class Client():
         self.ca_certs = ca_certs
         self.mqtt_bridge_hostname = mqtt_bridge_hostname
         self.mqtt_bridge_port = mqtt_bridge_port
+        self.use_tls = use_tls
         self.should_backoff = False
         self.minimum_backoff_time = 1
         self.maximum_backoff_time = maximum_backoff_time
+        self.message_encoding = message_encoding
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.send_interval = send_interval
         self.events_topic = f'/devices/{device_id}/{events_sub_topic}'
+        if message_encoding == 'binary':
+            # the subfolder tells the consumers how the message is encoded
+            self.events_topic = f'{self.events_topic}/{BINARY_SUBFOLDER}'
         self.state_topic = f'/devices/{device_id}/state'
         self.jwt_expires_minutes = jwt_expires_minutes
         self.use_input_timestamp = use_input_timestamp
         self.input_ts_format = input_ts_format
         self.output_ts_format = output_ts_format
+        self.token = None
+        self.token_refresh_at = 0.
+        self.token_pending = False
+        self.token_timer = None
+        self.signed_tokens = 0
+        self.signing_cpu_seconds = 0.
         self.init_state()
 
     def init_state(self):
@@ -57,22 +97,63 @@ class Client():
     def update_state(self, config):
         self.state.update(config)
 
-    def create_jwt(self, project_id, private_key_file, algorithm):
+    def create_jwt(self, project_id, private_key_file, algorithm) -> Optional[str]:
         """Creates a JWT (https://jwt.io) to establish an MQTT connection."""
+        if not private_key_file:
+            # Brokers without authentication, e.g. a local one
+            return None
+        started = time.thread_time()
+        now = datetime.datetime.now(tz=datetime.timezone.utc)
         token = {
-            "iat": datetime.datetime.now(tz=datetime.timezone.utc),
-            "exp": datetime.datetime.now(
-                tz=datetime.timezone.utc) + datetime.timedelta(minutes=20),
+            "iat": now,
+            "exp": now + datetime.timedelta(minutes=self.jwt_expires_minutes),
             "aud": project_id,
         }
-        with open(private_key_file, "r") as f:
-            private_key = f.read()
+        encoded = jwt.encode(token, load_signing_key(private_key_file), algorithm=algorithm)
+        self.signed_tokens += 1
+        self.signing_cpu_seconds += time.thread_time() - started
+        return encoded
+
+    def get_jwt(self) -> Optional[str]:
+        """Current token, signed again once its refresh time has come"""
+        if self.token is None or time.monotonic() >= self.token_refresh_at:
+            self.refresh_token()
+        return self.token
+
+    def refresh_token(self) -> None:
+        self.token = self.create_jwt(self.project_id, self.private_key_file, self.algorithm)
+        if not self.private_key_file:
+            # tokens of brokers without authentication never expire
+            self.token_refresh_at = float('inf')
+            return
+        lifetime = 60 * self.jwt_expires_minutes
+        self.token_refresh_at = time.monotonic() + lifetime * random.uniform(*TOKEN_REFRESH_RANGE)
         logging.info(
-            "Creating JWT using {} from private key file {}".format(
-                algorithm, private_key_file
-            )
-        )
-        return jwt.encode(token, private_key, algorithm=algorithm)
+            "Created JWT using {}, {} tokens signed in {:.1f} ms of CPU".format(
+                self.algorithm, self.signed_tokens, 1000 * self.signing_cpu_seconds))
+
+    def start_token_timer(self) -> None:
+        """Signs the next token in the background ahead of expiry, the run loop then reconnects with it"""
+        if not self.private_key_file:
+            return
+
+        def on_timer():
+            self.refresh_token()
+            self.token_pending = True
+            self.start_token_timer()
+        self.token_timer = threading.Timer(max(0., self.token_refresh_at - time.monotonic()), on_timer)
+        self.token_timer.daemon = True
+        self.token_timer.start()
+
+    def stop_token_timer(self) -> None:
+        if self.token_timer is not None:
+            self.token_timer.cancel()
+            self.token_timer = None
+
+    def reconnect_with_token(self, client: mqtt.Client) -> None:
+        """Renews the connection with the current token, reusing the client and its TLS context"""
+        client.username_pw_set(username='unused', password=self.token)
+        client.reconnect()
 
     def error_str(self, rc):
         """Convert a Paho error to a human readable string."""
@@ -83,6 +164,10 @@ class Client():
         logging.info(f"on_connect {mqtt.connack_string(rc)}")
         self.should_backoff = False
         self.minimum_backoff_time = 1
+        if rc == mqtt.CONNACK_ACCEPTED:
+            # Subscribing on every connect, as subscriptions of a clean session do not survive reconnects
+            client.subscribe("/devices/{}/config".format(self.device_id), qos=1)
+            client.subscribe("/devices/{}/commands/#".format(self.device_id), qos=0)
 
     def on_disconnect(self, client, userdata, rc):
         """Paho callback for when a device disconnects."""
@@ -111,51 +196,78 @@ class Client():
         logging.info(f"Received message '{payload}'"
                      f" on topic '{message.topic}' with Qos {message.qos}")
 
-    def get_client(self):
-        """Create MQTT client."""
+    def create_client(self) -> mqtt.Client:
+        """Create MQTT client with callbacks, not connected yet."""
         client_id = (f'projects/{self.project_id}/locations/{self.location}/'
                      f'registries/{self.registry_id}/devices/{self.device_id}')
         logging.info("Device client_id is '{}'".format(client_id))
         client = mqtt.Client(client_id=client_id)
-        client.username_pw_set(
-            username='unused',
-            password=self.create_jwt(self.project_id, self.private_key_file,
-                                     self.algorithm))
-        client.tls_set(ca_certs=self.ca_certs,
-                       tls_version=ssl.PROTOCOL_TLSv1_2)
+        client.username_pw_set(username='unused', password=self.get_jwt())
+        if self.use_tls:
+            client.tls_set(ca_certs=self.ca_certs,
+                           tls_version=ssl.PROTOCOL_TLSv1_2)
         mqtt_config_topic = "/devices/{}/config".format(self.device_id)
-        mqtt_command_topic = "/devices/{}/commands/#".format(self.device_id)
         client.on_connect = self.on_connect
         client.on_publish = self.on_publish
         client.on_disconnect = self.on_disconnect
         client.on_message = self.on_message
         client.message_callback_add(mqtt_config_topic,
                                     self.on_config_message)
+        return client
+
+    def connect_client(self, client: mqtt.Client) -> None:
         client.connect(self.mqtt_bridge_hostname, self.mqtt_bridge_port)
-        client.subscribe(mqtt_config_topic, qos=1)
-        client.subscribe(mqtt_command_topic, qos=0)
+
+    def get_client(self):
+        """Create MQTT client and connect it."""
+        client = self.create_client()
+        self.connect_client(client)
         return client
 
-    def get_payload(self, value: Dict):
+    def get_reading(self, value: Reading) -> Tuple:
+        """Timestamp and value of the reading as they are published:
+        epoch seconds for binary messages and formatted time for JSON ones"""
+        if self.message_encoding == 'binary':
+            if self.use_input_timestamp:
+                epoch = calendar.timegm(time.strptime(value.timestamp, self.input_ts_format))
+            else:
+                epoch = int(time.time())
+            return epoch, float(value.value)
         if self.use_input_timestamp:
             timestamp = time.strftime(
                 self.output_ts_format,
-                time.strptime(value['timestamp'],
+                time.strptime(value.timestamp,
                               self.input_ts_format))
         else:
             timestamp = datetime.datetime.now(
                 tz=datetime.timezone.utc).strftime(self.output_ts_format)
-        payload = json.dumps({
-            'timestamp': timestamp,
-            'value': value['value']})
-        return payload
-
-    def mqtt_device_run(self, values: Sequence[Dict]):
-        """Connects a device, sends data loop, and receives data."""
-        jwt_iat = datetime.datetime.now(tz=datetime.timezone.utc)
+        return timestamp, value.value
+
+    def get_batch_payload(self, readings: Sequence[Tuple]):
+        """One message for the readings ordered by time"""
+        if self.message_encoding == 'binary':
+            return b''.join(encode_reading(epoch, value) for epoch, value in readings)
+        if len(readings) == 1:
+            timestamp, value = readings[0]
+            return json.dumps({
+                'timestamp': timestamp,
+                'value': value})
+        return json.dumps({'readings': [[timestamp, value] for timestamp, value in readings]})
+
+    def get_payload(self, value: Reading):
+        return self.get_batch_payload([self.get_reading(value)])
+
+    def mqtt_device_run(self, values: Iterable[Reading], checkpoint: Optional[Checkpoint] = None):
+        """Connects a device, sends data loop, and receives data.
+
+        `values` are iterated again while the device is enabled, the checkpoint is saved after every publish."""
         client = self.get_client()
         client.loop_start()
+        self.start_token_timer()
         time.sleep(10)
+        batch = []
+        batch_started = None
+        next_reading = time.monotonic()
         while self.state['enabled']:
             for value in values:
                 if not self.state['enabled']:
@@ -174,19 +286,38 @@ class Client():
                         "Waiting for {} before reconnecting.".format(delay))
                     time.sleep(delay)
                     self.minimum_backoff_time *= 2
-                    client.reconnect()
-                payload = self.get_payload(value)
-                logging.info("Publishing message: '{}'".format(payload))
-                seconds_since_issue = (datetime.datetime.now(
-                    tz=datetime.timezone.utc) - jwt_iat).seconds
-                if seconds_since_issue > 60 * self.jwt_expires_minutes:
-                    logging.info("Refreshing token after {}s".format(
-                        seconds_since_issue))
-                    jwt_iat = datetime.datetime.now(tz=datetime.timezone.utc)
+                    # the token may have expired while the device was offline
+                    self.get_jwt()
+                    self.reconnect_with_token(client)
+                if self.token_pending:
+                    # The token was signed by the timer ahead of expiry
+                    logging.info("Reconnecting with the refreshed token")
+                    self.token_pending = False
                     client.loop_stop()
-                    client.disconnect()
-                    client = self.get_client()
+                    self.reconnect_with_token(client)
                     client.loop_start()
-                client.publish(self.events_topic, payload, qos=1)
-                time.sleep(60)
+                batch.append(self.get_reading(value))
+                last_value = value
+                if batch_started is None:
+                    batch_started = time.monotonic()
+                if len(batch) >= self.batch_size or time.monotonic() - batch_started >= self.batch_interval:
+                    self.publish_batch(client, batch)
+                    if checkpoint is not None:
+                        checkpoint.save(last_value)
+                    batch = []
+                    batch_started = None
+                # Sleeping until the next reading is due, so publishing does not shift the schedule
+                next_reading += self.send_interval
+                time.sleep(max(0., next_reading - time.monotonic()))
+        if batch:
+            self.publish_batch(client, batch)
+            if checkpoint is not None:
+                checkpoint.save(last_value)
+        self.stop_token_timer()
         client.loop_stop()
+
+    def publish_batch(self, client, batch: Sequence[Tuple]):
+        payload = self.get_batch_payload(batch)
+        logging.info("Publishing {} readings: {!r}".format(len(batch), payload))
+        # publish only queues the message, it is sent by the network loop thread
+        client.publish(self.events_topic, payload, qos=1)
@@ -0,0 +1,341 @@
+"""Fleet simulator: drives many simulated devices from one process to load test the pipeline.
+
+Every device is a `Client` with its own MQTT connection and JWT, signed with the key loaded once.
+All connections are served by one selector based network loop which also schedules publishing,
+so thousands of devices need no threads.
+Devices replay the same readings file parsed once. Against a local broker without TLS and authentication,
+with the reading encoding shared with the functions on the path:
+
+    PYTHONPATH=../../functions/common python3 fleet_simulator.py --devices 2000 --rate 0.5 --jitter 0.3 --data_file device_new_data.csv \\
+        --mqtt_bridge_hostname localhost --mqtt_bridge_port 1883 --no_tls --private_key_file ''
+"""
+import argparse
+import heapq
+import logging
+import random
+import selectors
+import time
+from typing import List, Optional, Sequence
+
+import paho.mqtt.client as mqtt
+
+from client import Client
+from replay import Reading, iter_readings
+
+# Metrics of the fleet, device clients log only warnings
+logger = logging.getLogger('fleet_simulator')
+
+
+class LatencyHistogram():
+    """Publish-ack latencies counted in power of two millisecond buckets"""
+    BUCKETS = 18
+
+    def __init__(self) -> None:
+        self.counts = [0] * self.BUCKETS
+        self.total = 0.
+        self.count = 0
+
+    def add(self, seconds: float) -> None:
+        bucket = min(int(seconds * 1000).bit_length(), self.BUCKETS - 1)
+        self.counts[bucket] += 1
+        self.total += seconds
+        self.count += 1
+
+    def upper_bound_ms(self, bucket: int) -> int:
+        return 1 << bucket
+
+    def quantile(self, q: float) -> Optional[int]:
+        """Upper bound, in ms, of the bucket holding the quantile"""
+        if self.count == 0:
+            return None
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= q * self.count:
+                return self.upper_bound_ms(bucket)
+        return self.upper_bound_ms(self.BUCKETS - 1)
+
+    def __str__(self) -> str:
+        lines = []
+        for bucket, count in enumerate(self.counts):
+            if count > 0:
+                bar = '#' * max(1, 50 * count // self.count)
+                lines.append(f"  < {self.upper_bound_ms(bucket):>7} ms {count:>10} {bar}")
+        return '\n'.join(lines)
+
+
+class FleetMetrics():
+
+    def __init__(self) -> None:
+        self.started = time.monotonic()
+        self.published = 0
+        self.acked = 0
+        self.disconnects = 0
+        self.reconnects = 0
+        self.failed_reconnects = 0
+        self.failed_connects = 0
+        self.token_refreshes = 0
+        self.latency = LatencyHistogram()
+
+    def report(self, devices: Sequence[Client]) -> str:
+        elapsed = time.monotonic() - self.started
+        signed = sum(device.signed_tokens for device in devices)
+        signing_cpu = sum(device.signing_cpu_seconds for device in devices)
+        return (f"{elapsed:8.1f} s: published {self.published} ({self.published / elapsed:.1f} msgs/s), "
+                f"acked {self.acked} ({self.acked / elapsed:.1f} msgs/s), "
+                f"ack latency p50 < {self.latency.quantile(.5)} ms, p99 < {self.latency.quantile(.99)} ms, "
+                f"failed connects {self.failed_connects}, disconnects {self.disconnects}, reconnects {self.reconnects} "
+                f"({self.failed_reconnects} failed), token refreshes {self.token_refreshes}, "
+                f"{signed} tokens signed in {signing_cpu:.2f} s of CPU")
+
+
+class SimulatedDevice(Client):
+    """Client of one simulated device, its socket is served by the fleet network loop"""
+
+    def __init__(self, *, metrics: FleetMetrics, selector: selectors.BaseSelector, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.metrics = metrics
+        self.selector = selector
+        self.sent = {}
+        self.position = 0
+        self.reconnect_at = 0.
+        self.client = None
+
+    def on_disconnect(self, client, userdata, rc):
+        super().on_disconnect(client, userdata, rc)
+        self.metrics.disconnects += 1
+        self.reconnect_at = time.monotonic() + self.minimum_backoff_time + random.random()
+
+    def on_publish(self, unused_client, unused_userdata, mid):
+        sent = self.sent.pop(mid, None)
+        if sent is not None:
+            self.metrics.acked += 1
+            self.metrics.latency.add(time.monotonic() - sent)
+
+    def on_socket_open(self, client, userdata, sock):
+        self.selector.register(sock, selectors.EVENT_READ, self)
+
+    def on_socket_close(self, client, userdata, sock):
+        self.selector.unregister(sock)
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.selector.modify(sock, selectors.EVENT_READ | selectors.EVENT_WRITE, self)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.selector.modify(sock, selectors.EVENT_READ, self)
+
+    def connect(self) -> None:
+        """Connects the device, a refused or reset connection is retried by `reconnect` after a backoff"""
+        self.client = self.create_client()
+        self.client.on_socket_open = self.on_socket_open
+        self.client.on_socket_close = self.on_socket_close
+        self.client.on_socket_register_write = self.on_socket_register_write
+        self.client.on_socket_unregister_write = self.on_socket_unregister_write
+        try:
+            self.connect_client(self.client)
+        except OSError as e:
+            self.metrics.failed_connects += 1
+            self.back_off(e)
+
+    def reconnect(self) -> None:
+        self.metrics.reconnects += 1
+        self.renew_connection()
+
+    def renew_connection(self) -> None:
+        """Reconnects with the current token, a failure is retried by `reconnect` after a backoff"""
+        try:
+            self.get_jwt()
+            self.reconnect_with_token(self.client)
+            self.should_backoff = False
+        except OSError as e:
+            self.metrics.failed_reconnects += 1
+            self.back_off(e)
+
+    def back_off(self, error: OSError) -> None:
+        self.should_backoff = True
+        self.minimum_backoff_time = min(2 * self.minimum_backoff_time, self.maximum_backoff_time)
+        self.reconnect_at = time.monotonic() + self.minimum_backoff_time + random.random()
+        logging.debug(f"{self.device_id} connection failed: {error}")
+
+    def publish_next(self, values: Sequence[Reading]) -> None:
+        value = values[self.position % len(values)]
+        self.position += 1
+        info = self.client.publish(self.events_topic, self.get_payload(value), qos=1)
+        if info.rc == mqtt.MQTT_ERR_SUCCESS:
+            self.sent[info.mid] = time.monotonic()
+            self.metrics.published += 1
+
+
+class FleetSimulator():
+
+    def __init__(self, devices: List[SimulatedDevice], values: Sequence[Reading], selector: selectors.BaseSelector,
+                 metrics: FleetMetrics, rate: float, jitter: float = 0., burst_every: float = 0.,
+                 burst_duration: float = 0., burst_factor: float = 1., connect_rate: float = 100.) -> None:
+        self.devices = devices
+        self.values = values
+        self.selector = selector
+        self.metrics = metrics
+        self.rate = rate
+        self.jitter = jitter
+        self.burst_every = burst_every
+        self.burst_duration = burst_duration
+        self.burst_factor = burst_factor
+        self.connect_rate = connect_rate
+
+    def in_burst(self, now: float) -> bool:
+        return self.burst_every > 0 and (now - self.metrics.started) % self.burst_every < self.burst_duration
+
+    def next_interval(self, now: float) -> float:
+        """Time until the next publish of a device"""
+        rate = self.rate * self.burst_factor if self.in_burst(now) else self.rate
+        return max(0., 1. / rate * (1 + random.uniform(-self.jitter, self.jitter)))
+
+    def poll(self, timeout: float) -> None:
+        for key, mask in self.selector.select(timeout):
+            device = key.data
+            if mask & selectors.EVENT_READ:
+                device.client.loop_read()
+            if mask & selectors.EVENT_WRITE and device.client.socket() is not None:
+                device.client.loop_write()
+
+    def connect_all(self) -> None:
+        """Connects devices at `connect_rate` per second, serving already connected ones meanwhile"""
+        for i, device in enumerate(self.devices):
+            device.connect()
+            self.poll(0)
+            if self.connect_rate > 0:
+                time.sleep(max(0., self.metrics.started + (i + 1) / self.connect_rate - time.monotonic()))
+        failed = sum(device.should_backoff for device in self.devices)
+        logger.info(f"Connected {len(self.devices) - failed} devices, {failed} to retry after a backoff")
+
+    def maintain(self, now: float) -> None:
+        """Keep alive pings, retries and reconnects of disconnected devices, renewal of tokens close to expiry"""
+        for device in self.devices:
+            if device.should_backoff:
+                if now >= device.reconnect_at:
+                    device.reconnect()
+            elif now >= device.token_refresh_at:
+                # refresh times are spread over the token lifetime, so devices do not reconnect all at once
+                self.metrics.token_refreshes += 1
+                device.refresh_token()
+                device.renew_connection()
+            else:
+                device.client.loop_misc()
+
+    def run(self, duration: float, report_interval: float = 10.) -> None:
+        self.metrics.started = time.monotonic()
+        self.connect_all()
+        now = time.monotonic()
+        # spreading the first publishes over one interval
+        schedule = [(now + random.uniform(0, 1. / self.rate), i) for i in range(len(self.devices))]
+        heapq.heapify(schedule)
+        end = now + duration
+        last_maintained = last_reported = now
+        while now < end:
+            self.poll(min(max(0., schedule[0][0] - now), 1.))
+            now = time.monotonic()
+            while schedule[0][0] <= now:
+                due, i = heapq.heappop(schedule)
+                device = self.devices[i]
+                if not device.should_backoff and device.state['enabled']:
+                    device.publish_next(self.values)
+                heapq.heappush(schedule, (due + self.next_interval(due), i))
+            if now - last_maintained >= 1:
+                self.maintain(now)
+                last_maintained = now
+            if now - last_reported >= report_interval:
+                logger.info(self.metrics.report(self.devices))
+                last_reported = now
+        # waiting for the acks of in flight messages
+        drain_end = time.monotonic() + 5
+        while time.monotonic() < drain_end and any(device.sent for device in self.devices):
+            self.poll(.1)
+        for device in self.devices:
+            device.client.disconnect()
+        logger.info(self.metrics.report(self.devices))
+        logger.info(f"Publish-ack latency histogram:\n{self.metrics.latency}")
+
+
+def parse_command_line_args():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--devices", default=100, type=int, help="Number of simulated devices")
+    parser.add_argument(
+        "--device_prefix", default="sim-device-",
+        help="Prefix of device ids, followed by the device number")
+    parser.add_argument(
+        "--data_file", required=True, help="CSV file with timestamp and value columns replayed by all devices")
+    parser.add_argument(
+        "--rate", default=1., type=float, help="Messages per second of every device")
+    parser.add_argument(
+        "--jitter", default=0., type=float,
+        help="Random deviation of publish intervals, as a fraction of the interval")
+    parser.add_argument(
+        "--burst_every", default=0., type=float, help="Period, in seconds, of bursts, 0 disables bursts")
+    parser.add_argument(
+        "--burst_duration", default=0., type=float, help="Duration of a burst in seconds")
+    parser.add_argument(
+        "--burst_factor", default=1., type=float, help="Rate multiplier during bursts")
+    parser.add_argument(
+        "--duration", default=60., type=float, help="Duration of the simulation in seconds")
+    parser.add_argument(
+        "--connect_rate", default=100., type=float,
+        help="Devices connected per second, 0 connects all at once")
+    parser.add_argument(
+        "--report_interval", default=10., type=float, help="Metrics report interval in seconds")
+    parser.add_argument(
+        "--algorithm", choices=("RS256", "ES256"), default="RS256",
+        help="Which encryption algorithm to use to generate the JWT")
+    parser.add_argument(
+        "--private_key_file", default="private_key.pem",
+        help="Path to private key file, empty for brokers without authentication")
+    parser.add_argument(
+        "--jwt_expires_minutes", default=20, type=float,
+        help="Expiration time, in minutes, for JWT tokens")
+    parser.add_argument(
+        "--ca_certs", default="root.pem",
+        help="CA root from https://pki.google.com/roots.pem")
+    parser.add_argument(
+        "--no_tls", dest="use_tls", action="store_false", help="Plain TCP, e.g. for a local broker")
+    parser.add_argument(
+        "--project_id", default="local", help="GCP cloud project name")
+    parser.add_argument(
+        "--location", default="local", help="GCP IoT Core region")
+    parser.add_argument(
+        "--registry_id", default="local", help="Registry ID")
+    parser.add_argument(
+        "--mqtt_bridge_hostname", default="mqtt.googleapis.com",
+        help="MQTT bridge hostname.")
+    parser.add_argument(
+        "--mqtt_bridge_port", default=8883, type=int, help="MQTT bridge port")
+    parser.add_argument(
+        "--events_sub_topic", default="events", help="Events sub topic")
+    parser.add_argument(
+        "--message_encoding", choices=("json", "binary"), default="json",
+        help="Encoding of published readings")
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s %(message)s')
+    logger.setLevel(logging.INFO)
+    args = parse_command_line_args()
+    with open(args.data_file, 'rb') as f:
+        # parsed once and shared by all devices
+        values = list(iter_readings(f))
+    selector = selectors.DefaultSelector()
+    metrics = FleetMetrics()
+    options = {k: v for k, v in vars(args).items() if k not in (
+        'devices', 'device_prefix', 'data_file', 'rate', 'jitter', 'burst_every', 'burst_duration',
+        'burst_factor', 'duration', 'connect_rate', 'report_interval')}
+    devices = [SimulatedDevice(metrics=metrics, selector=selector,
+                               device_id=f'{args.device_prefix}{i}', **options)
+               for i in range(args.devices)]
+    simulator = FleetSimulator(devices, values, selector, metrics, args.rate, args.jitter, args.burst_every,
+                               args.burst_duration, args.burst_factor, args.connect_rate)
+    simulator.run(args.duration, args.report_interval)
+
+
+if __name__ == "__main__":
+    main()
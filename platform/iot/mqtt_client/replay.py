@@ -0,0 +1,106 @@
+import json
+import os
+from typing import BinaryIO, Iterator, NamedTuple, Optional
+
+# Bytes read from GCS per request
+CHUNK_SIZE = 1 << 20
+
+
+class Reading(NamedTuple):
+    timestamp: str
+    value: str
+    # number of the row in the file, starting from 0 after the header
+    row: int
+    # byte offset right after the row, replay resumes from it to continue with the next row
+    offset: int
+
+
+def open_events_data(bucket: Optional[str], blob: Optional[str], file: Optional[str] = None,
+                     chunk_size: int = CHUNK_SIZE) -> BinaryIO:
+    """Opens the events data as a byte stream: a local file if given, otherwise the GCS blob read in chunks"""
+    if file:
+        return open(file, 'rb')
+    from google.cloud import storage
+    return storage.Client().bucket(bucket).blob(blob).open('rb', chunk_size=chunk_size)
+
+
+def iter_readings(stream: BinaryIO, offset: int = 0, row: int = 0) -> Iterator[Reading]:
+    """Yields readings of a CSV stream with `timestamp` and `value` columns one by one.
+
+    Reading starts from the byte `offset` of a row start, where row `row` is, if given,
+    otherwise `row` rows are skipped.
+    """
+    header = stream.readline()
+    columns = header.decode('utf-8').strip().split(',')
+    timestamp_column, value_column = columns.index('timestamp'), columns.index('value')
+    width = max(timestamp_column, value_column) + 1
+    position = len(header)
+    skip = 0
+    if offset > position:
+        stream.seek(offset)
+        position = offset
+    else:
+        skip, row = row, 0
+    for line in stream:
+        position += len(line)
+        fields = line.rstrip(b'\r\n').split(b',')
+        if len(fields) < width:
+            # empty lines
+            continue
+        if skip > 0:
+            skip -= 1
+            row += 1
+            continue
+        yield Reading(fields[timestamp_column].decode('utf-8'), fields[value_column].decode('utf-8'), row, position)
+        row += 1
+
+
+class ReplaySource():
+    """Readings of the events data, streamed anew on every iteration.
+
+    The first iteration starts from the given position, the next ones replay the data from the start.
+    """
+
+    def __init__(self, bucket: Optional[str] = None, blob: Optional[str] = None, file: Optional[str] = None,
+                 offset: int = 0, row: int = 0, chunk_size: int = CHUNK_SIZE) -> None:
+        self.bucket = bucket
+        self.blob = blob
+        self.file = file
+        self.offset = offset
+        self.row = row
+        self.chunk_size = chunk_size
+
+    @property
+    def name(self) -> str:
+        return self.file or f'gs://{self.bucket}/{self.blob}'
+
+    def __iter__(self) -> Iterator[Reading]:
+        offset, row = self.offset, self.row
+        self.offset, self.row = 0, 0
+        with open_events_data(self.bucket, self.blob, self.file, self.chunk_size) as stream:
+            yield from iter_readings(stream, offset, row)
+
+
+class Checkpoint():
+    """Position after the last published reading, kept in a local file so that a restarted device
+    continues the replay instead of starting it over"""
+
+    def __init__(self, path: str, source: str) -> None:
+        self.path = path
+        self.source = source
+        self.offset = 0
+        self.row = 0
+        if os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+            # a checkpoint of another file is ignored
+            if saved.get('source') == source:
+                self.offset = saved['offset']
+                self.row = saved['row']
+
+    def save(self, reading: Reading) -> None:
+        self.offset = reading.offset
+        self.row = reading.row + 1
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump({'source': self.source, 'offset': self.offset, 'row': self.row}, f)
+        os.replace(self.path + '.tmp', self.path)
@@ -1,12 +1,11 @@
 import argparse
-import csv
 import logging
-from io import StringIO
 
 import google.cloud.logging
-from google.cloud import compute_v1, storage
+from google.cloud import compute_v1
 
 from client import Client
+from replay import Checkpoint, ReplaySource
 
 
 def parse_command_line_args():
@@ -51,6 +50,18 @@ def parse_command_line_args():
         "--events_data_bucket", help="Events data GCS bucket", default="${bucket}")
     parser.add_argument(
         "--events_data_blob", help="Events data GCS blob", default="data/device_new_data.csv")
+    parser.add_argument(
+        "--events_data_file", help="Local events data file, used instead of the GCS blob if set")
+    parser.add_argument(
+        "--start_offset", default=0, type=int,
+        help="Byte offset of the row to start the replay from")
+    parser.add_argument(
+        "--start_row", default=0, type=int,
+        help="Row to start the replay from, the row at --start_offset if it is set")
+    parser.add_argument(
+        "--checkpoint_file", default="replay_checkpoint.json",
+        help="Local file with the replay position, the replay resumes from it after a restart. "
+             "Empty to disable")
     parser.add_argument(
         "--use_input_timestamp", action='store_true',
         help="Use timestamp from file or device timestamp")
@@ -60,6 +71,18 @@ def parse_command_line_args():
     parser.add_argument(
         "--output_ts_format", default="%Y-%m-%dT%H:%M:%S",
         help="Output timestamp format")
+    parser.add_argument(
+        "--message_encoding", choices=("json", "binary"), default="json",
+        help="Encoding of published readings, binary is a 17 bytes struct of epoch seconds and value")
+    parser.add_argument(
+        "--batch_size", default=1, type=int,
+        help="Number of readings published in one message")
+    parser.add_argument(
+        "--batch_interval", default=300, type=float,
+        help="Maximum time, in seconds, a reading waits in a batch before publishing")
+    parser.add_argument(
+        "--send_interval", default=60, type=float,
+        help="Time, in seconds, between readings")
     return parser.parse_args()
 
 
@@ -68,13 +91,17 @@ def main():
     log_client.setup_logging()
     logging.getLogger().setLevel(logging.INFO)
     arg_parser = parse_command_line_args()
-    events_text_file: str = (storage.Client()
-                             .bucket(arg_parser.events_data_bucket)
-                             .blob(arg_parser.events_data_blob)
-                             .download_as_text())
-    values = list(csv.DictReader(StringIO(events_text_file)))
+    source = ReplaySource(bucket=arg_parser.events_data_bucket, blob=arg_parser.events_data_blob,
+                          file=arg_parser.events_data_file, offset=arg_parser.start_offset,
+                          row=arg_parser.start_row)
+    checkpoint = None
+    if arg_parser.checkpoint_file:
+        checkpoint = Checkpoint(arg_parser.checkpoint_file, source.name)
+        if checkpoint.offset > 0:
+            logging.info(f"Resuming replay of {source.name} from row {checkpoint.row}")
+            source.offset, source.row = checkpoint.offset, checkpoint.row
     mqtt_client = Client(**vars(arg_parser))
-    mqtt_client.mqtt_device_run(values=values)
+    mqtt_client.mqtt_device_run(values=source, checkpoint=checkpoint)
     logging.info("Finished.")
     compute_v1.InstancesClient().stop(project=arg_parser.project_id,
                                       zone=arg_parser.gce_zone,
@@ -64,15 +64,17 @@ module "bigquery" {
 }
 
 module "load_iot_events_to_bq" {
-  source          = "git@github.com:griddynamics/gcp-iot-platform.git//modules/iot_events_to_bq"
-  depends_on      = [module.bigquery]
-  resource_prefix = var.resource_prefix
-  project_id      = var.project_id
-  region          = var.region
-  table_id        = module.bigquery.id_table_iot_events
-  dataset_id      = module.bigquery.dataset_id
-  topic_metrics   = module.pub_sub_iot.pub_sub_topic_metrics_id
-  bucket          = google_storage_bucket.iot_bucket.name
+  source           = "git@github.com:griddynamics/gcp-iot-platform.git//modules/iot_events_to_bq"
+  depends_on       = [module.bigquery]
+  resource_prefix  = var.resource_prefix
+  project_id       = var.project_id
+  region           = var.region
+  table_id         = module.bigquery.id_table_iot_events
+  table_id_windows = module.bigquery.id_table_device_windows
+  dataset_id       = module.bigquery.dataset_id
+  topic_metrics    = module.pub_sub_iot.pub_sub_topic_metrics_id
+  bucket           = google_storage_bucket.iot_bucket.name
+  ingest_mode      = var.iot_events_ingest_mode
 }
 
 module "anomaly_detector" {
@@ -99,6 +101,8 @@ module "anomaly_detector_vertex" {
   topic_metrics     = module.pub_sub_iot.pub_sub_topic_metrics_id
   table_id_analyzed = module.bigquery.id_table_iot_events_analyzed
   table_id          = module.bigquery.id_table_iot_events
+  table_id_windows  = module.bigquery.id_table_device_windows
+  ingest_mode       = var.iot_events_ingest_mode
   registry_id       = module.iot_core.registry_id
 }
 
@@ -125,6 +129,7 @@ module "train_detect_anomaly_vertex" {
   endpoint_name   = "${var.resource_prefix}-anomaly-kfp"
   table_id        = module.bigquery.id_table_iot_events
   dataset_id      = module.bigquery.dataset_id
+  trainer_solver  = var.trainer_solver
   path_module     = "${path.module}/iot"
 }
 
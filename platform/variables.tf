@@ -29,3 +29,15 @@ variable "docker_registry" {
 variable "image_tag" {
   type = string
 }
+
+variable "iot_events_ingest_mode" {
+  description = "Loading of IoT events into BigQuery, event (a function per message) or batch (pulled every minute)"
+  type        = string
+  default     = "event"
+}
+
+variable "trainer_solver" {
+  description = "Solver of the anomaly detector training, sgd, lstsq or huber"
+  type        = string
+  default     = "sgd"
+}
@@ -11,7 +11,8 @@ REQUIRED_PACKAGES = [
     # 'numpy==1.21.5'
     'pandas==1.3.5',
     'fsspec==2022.8.2',
-    'gcsfs==2022.8.2']
+    'gcsfs==2022.8.2',
+    'pyarrow==7.0.0']
 
 
 setup(
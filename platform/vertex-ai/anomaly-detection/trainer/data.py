@@ -1,24 +1,42 @@
 import numpy as np
 import pandas as pd
 import datetime
+import torch
+from numpy.lib.stride_tricks import sliding_window_view
 from torch.utils.data import Dataset
-from typing import Tuple, Union, Optional
-from copy import deepcopy
+from typing import Iterator, Tuple, Union, Optional
+from copy import copy
+from trainer.store import SeriesStore
 
 
 class TimeSeriesDataset(Dataset):
-    def __init__(self, series: pd.Series, points_before: int, difference: bool = False, include_date_features:bool = False, part: Optional[str]=None, recurrent:bool = False):
+    def __init__(self, series: Union[pd.Series, SeriesStore], points_before: int, difference: bool = False, include_date_features:bool = False, part: Optional[str]=None, recurrent:bool = False):
         super().__init__()
         self.points_before = points_before # MA
         self.difference = difference  # Integrated
         self.recurrent = recurrent
         self.part = part
-        self.ts = series.copy()
-        self.ts.index = pd.to_datetime(self.ts.index)
-        self.preprocess_data()
+        # index of the first window in `values`, split parts start further in the same buffer
+        self.offset = 0
+        if isinstance(series, SeriesStore):
+            # Memory-mapped data, only the accessed windows are paged in
+            self.ts = None
+            self.preprocess_store(series)
+        else:
+            self.ts = series.copy()
+            self.ts.index = pd.to_datetime(self.ts.index)
+            self.preprocess_data()
+            self.timestamps = self.ts.index.values.astype('datetime64[s]').astype(np.int64)
+            self.values = np.ascontiguousarray(self.ts.values, dtype=np.float32)
         
-        self.rows = np.array([self.ts.iloc[i-points_before:i] for i in range(points_before, len(self.ts))])
-        self.labels = [self.ts.iloc[i] for i in range(points_before, len(self.ts))]
+        # Windows are read-only strided views over a single float32 buffer, no row is copied when they are
+        # built, `__getitem__` copies the one window it returns
+        # A series of `points_before` points or fewer has no window
+        if len(self.values) > points_before:
+            self.rows = sliding_window_view(self.values[:-1], points_before)
+        else:
+            self.rows = sliding_window_view(np.empty(points_before, dtype=np.float32), points_before)[:0]
+        self.labels = self.values[points_before:]
         
         self.include_date_features = include_date_features
         if include_date_features:
@@ -35,6 +53,14 @@ class TimeSeriesDataset(Dataset):
         self._mean = self.ts.mean()
         self._std = self.ts.std()
         self.ts = (self.ts - self._mean) / self._std
+
+    def preprocess_store(self, store: SeriesStore) -> None:
+        assert not self.difference, "Differencing is not supported for the data stored on disk"
+        self.timestamps = store.timestamps
+        self.period = int(self.timestamps[-1] - self.timestamps[-2])
+        # Normalizing
+        self._mean, self._std = store.statistics()
+        self.values = store.normalized(self._mean, self._std)
         
     def _add_date_features(self) -> None:
         # Calculate date features
@@ -46,11 +72,12 @@ class TimeSeriesDataset(Dataset):
         return len(self.rows)
 
     def __getitem__(self, idx: int) -> Tuple[np.ndarray, float]:
+        """A writable copy of the window at `idx` and its label, batches of `TensorLoader` are views instead"""
         if self.recurrent:
             #TODO Check how it works with recurrent layers
-            return [self.rows[idx]], self.labels[idx]
+            return [np.array(self.rows[idx])], self.labels[idx]
         else:
-            return self.rows[idx], self.labels[idx]
+            return np.array(self.rows[idx]), self.labels[idx]
     
     def split(self, train_part: Union[int, float, datetime.datetime] = .7, test_part: Union[None, int, float, datetime.datetime] = None):
         if type(train_part) is int:
@@ -58,24 +85,81 @@ class TimeSeriesDataset(Dataset):
         elif type(train_part) is float:
             points = int(self.__len__() * train_part)
         elif type(train_part) is datetime.datetime:
-            points = sum(self.ts.index < pd.to_datetime(train_part.astimezone(datetime.timezone.utc)))
+            points = int(np.searchsorted(self.timestamps, int(train_part.timestamp())))
 
-        train = deepcopy(self)
-        train.rows = train.rows[:points]
-        train.labels = train.labels[:points]
-        train.ts = train.ts[:points + self.points_before]
+        # Both parts share the underlying buffer with the parent dataset
+        train = copy(self)
+        train.rows = self.rows[:points]
+        train.labels = self.labels[:points]
+        train.timestamps = self.timestamps[:points + self.points_before]
+        train.ts = None if self.ts is None else self.ts[:points + self.points_before]
+        train.offset = self.offset
         train.part = 'train'
-        test = deepcopy(self)
-        test.rows = test.rows[points:]
-        test.labels = test.labels[points:]
-        test.ts = test.ts[points:]
+        test = copy(self)
+        test.rows = self.rows[points:]
+        test.labels = self.labels[points:]
+        test.timestamps = self.timestamps[points:]
+        test.ts = None if self.ts is None else self.ts[points:]
+        test.offset = self.offset + points
         test.part = 'test'
         return train, test
     
+    def window_values(self) -> np.ndarray:
+        """The part of `values` the windows and labels are cut from without a copy:
+        rows[i] is window_values()[i:i + points_before] and labels[i] is window_values()[i + points_before]"""
+        if len(self) == 0:
+            return self.values[:0]
+        return self.values[self.offset:self.offset + len(self) + self.points_before]
+
     def denormalize(self, x):
         return x * self._std + self._mean
     
     def __str__(self):
         return super().__str__() + f'\nPoints before: {self.points_before},{" Difference," if self.difference else ""}'+\
                                    f'{" with date features," if self.include_date_features else ""}'+\
-                                   f'\n Total rows: {self.__len__()} (from {min(self.ts.index)} to {max(self.ts.index)})'
+                                   f'\n Total rows: {self.__len__()} (from {self._to_datetime(self.timestamps[0])} to {self._to_datetime(self.timestamps[-1])})'
+
+    @staticmethod
+    def _to_datetime(timestamp: int) -> pd.Timestamp:
+        return pd.to_datetime(int(timestamp), unit='s', utc=True)
+
+
+class TensorLoader:
+    """Replacement of `DataLoader` for TimeSeriesDataset keeping the dataset values in a single float32 tensor.
+
+    Windows are an unfolded view of the values, so they take no memory of their own and a memory-mapped
+    SeriesStore is not loaded into RAM. Batches are slices of the view, gathered by a permutation of indices
+    when shuffled, so no sample is collated in Python. `tensors` gives the whole dataset as views.
+    """
+
+    def __init__(self, dataset: TimeSeriesDataset, batch_size: int = 1024, shuffle: bool = False,
+                 drop_last: bool = False):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        values = torch.from_numpy(np.asarray(dataset.window_values(), dtype=np.float32))
+        if len(values) == 0:
+            self.x = values.new_empty((0, dataset.points_before))
+        else:
+            self.x = values.unfold(0, dataset.points_before, 1)[:len(dataset)]
+        self.y = values[dataset.points_before:]
+
+    @property
+    def tensors(self) -> Tuple[torch.Tensor, torch.Tensor]:
+        return self.x, self.y
+
+    def __len__(self) -> int:
+        if self.drop_last:
+            return len(self.y) // self.batch_size
+        return (len(self.y) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self) -> Iterator[Tuple[torch.Tensor, torch.Tensor]]:
+        indices = torch.randperm(len(self.y)) if self.shuffle else None
+        for i in range(len(self)):
+            if indices is None:
+                yield self.x[i * self.batch_size:(i + 1) * self.batch_size], \
+                      self.y[i * self.batch_size:(i + 1) * self.batch_size]
+            else:
+                batch = indices[i * self.batch_size:(i + 1) * self.batch_size]
+                yield self.x[batch], self.y[batch]
@@ -0,0 +1,209 @@
+import logging
+import multiprocessing
+import os
+import numpy as np
+import pandas as pd
+import torch
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Optional, Tuple
+from torch import nn
+
+from trainer.data import TensorLoader, TimeSeriesDataset
+from trainer.models import LinearModel, StackedLinearModel
+from trainer.trainer import Trainer
+
+FLEET_MODEL_FILE = 'fleet.npz'
+
+
+def split_by_device(data: pd.DataFrame) -> Dict[str, pd.Series]:
+    """Value series indexed by timestamp of every device of `deviceId`, `timestamp` and `value` columns"""
+    series = {}
+    for device_id, rows in data.groupby('deviceId', sort=True):
+        series[str(device_id)] = rows.set_index('timestamp')['value']
+    return series
+
+
+def _init_worker() -> None:
+    # devices are trained in parallel by the processes, not by the threads of one
+    torch.set_num_threads(1)
+
+
+def train_device(folder: str, series: pd.Series, input_size: int, split: float, solver: str, epochs: int,
+                 batch_size: int, learning_rate: float, early_stopping: int) -> Dict:
+    """Trains the LinearModel of one device with `Trainer` in `folder`, returns its exported parameters"""
+    dataset = TimeSeriesDataset(series, input_size)
+    train, test = dataset.split(split)
+    model = LinearModel(input_size)
+    trainer = Trainer(experiment_name=folder, model=model,
+                      optimizer=torch.optim.SGD(model.parameters(), lr=learning_rate, momentum=0.9),
+                      loss=nn.HuberLoss(), parameters=dict(),
+                      train_loader=TensorLoader(train, batch_size=batch_size, shuffle=True, drop_last=True),
+                      val_loader=TensorLoader(test, batch_size=batch_size, shuffle=False, drop_last=True))
+    if solver == 'sgd':
+        trainer.train(epochs, early_stopping=early_stopping)
+    else:
+        trainer.fit_linear(solver)
+    with np.load(os.path.join(folder, 'model.npz')) as artifact:
+        result = {name: artifact[name] for name in artifact.files}
+    # the mean loss, the trainer history is divided by the batch size
+    result['val_loss'] = np.float64(trainer.history['val_loss'][trainer.best_epoch] * batch_size)
+    return result
+
+
+def train_devices(series_by_device: Dict[str, pd.Series], folder: str, input_size: int, split: float = .75,
+                  solver: str = 'huber', epochs: int = 100, batch_size: int = 8, learning_rate: float = 1e-4,
+                  early_stopping: int = 5, max_workers: Optional[int] = None,
+                  min_points: Optional[int] = None) -> Dict[str, Dict]:
+    """Trains a detector per device concurrently in a pool of at most `max_workers` processes.
+
+    Every device has its own experiment folder under `folder`, devices with less than `min_points` readings
+    or failed trainings are skipped.
+    """
+    min_points = min_points or 4 * input_size
+    os.makedirs(folder, exist_ok=True)
+    results = {}
+    # spawned, as forked processes may inherit locked torch threads
+    with ProcessPoolExecutor(max_workers=max_workers or os.cpu_count(), initializer=_init_worker,
+                             mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = {}
+        for i, (device_id, series) in enumerate(sorted(series_by_device.items())):
+            if len(series) < min_points:
+                logging.warning(f"Skipping device {device_id}: {len(series)} readings, {min_points} needed")
+                continue
+            futures[device_id] = executor.submit(train_device, os.path.join(folder, f'device{i:05}'), series,
+                                                 input_size, split, solver, epochs, batch_size, learning_rate,
+                                                 early_stopping)
+        for device_id, future in futures.items():
+            try:
+                results[device_id] = future.result()
+            except Exception as e:
+                logging.warning(f"Training of device {device_id} failed: {e}")
+    return results
+
+
+def _stacked_tensors(datasets) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """Windows, labels and device indices of the datasets concatenated"""
+    x = torch.from_numpy(np.concatenate([np.asarray(d.rows, dtype=np.float32) for d in datasets]))
+    y = torch.from_numpy(np.concatenate([np.asarray(d.labels, dtype=np.float32) for d in datasets]))
+    device = torch.repeat_interleave(torch.arange(len(datasets)), torch.tensor([len(d) for d in datasets]))
+    return x, y, device
+
+
+def _solve_stacked(x, y, device, devices: int, params: Optional[torch.Tensor] = None, delta: float = 1.,
+                   chunk_size: int = 1 << 16) -> torch.Tensor:
+    """Weights and bias of every device solving all the (Huber reweighted) normal equations in a batch.
+    The normal equations are accumulated per run of rows of the same device, devices are contiguous
+    in the stacked tensors, so a chunk adds a few (size, size) products"""
+    size = x.shape[1] + 1
+    xtx = torch.zeros(devices, size, size, dtype=torch.float64)
+    xty = torch.zeros(devices, size, dtype=torch.float64)
+    for start in range(0, len(y), chunk_size):
+        chunk = torch.cat([x[start:start + chunk_size].double(),
+                           torch.ones(len(y[start:start + chunk_size]), 1, dtype=torch.float64)], dim=1)
+        labels = y[start:start + chunk_size].double()
+        index = device[start:start + chunk_size]
+        weighted = chunk
+        if params is not None:
+            residuals = (chunk * params[index]).sum(-1) - labels
+            weighted = chunk * (delta / residuals.abs().clamp(min=delta))[:, None]
+        offset = 0
+        for i, count in zip(*(t.tolist() for t in torch.unique_consecutive(index, return_counts=True))):
+            xtx[i] += weighted[offset:offset + count].T @ chunk[offset:offset + count]
+            offset += count
+        xty.index_add_(0, index, weighted * labels[:, None])
+    return torch.linalg.lstsq(xtx, xty[..., None]).solution[..., 0]
+
+
+def train_stacked(series_by_device: Dict[str, pd.Series], input_size: int, split: float = .75,
+                  solver: str = 'huber', epochs: int = 100, batch_size: int = 1024, learning_rate: float = 1e-3,
+                  early_stopping: int = 5, confidence: float = 0.95, max_iterations: int = 20,
+                  min_points: Optional[int] = None) -> Dict[str, Dict]:
+    """Trains the detectors of all devices as a single StackedLinearModel.
+
+    Closed form solvers solve the normal equations of all devices in a batch, `sgd` runs epochs over
+    the permuted windows of all devices with the summed Huber loss.
+    """
+    min_points = min_points or 4 * input_size
+    device_ids, splits = [], []
+    for device_id, series in sorted(series_by_device.items()):
+        if len(series) < min_points:
+            logging.warning(f"Skipping device {device_id}: {len(series)} readings, {min_points} needed")
+            continue
+        device_ids.append(device_id)
+        splits.append(TimeSeriesDataset(series, input_size).split(split))
+    x, y, device = _stacked_tensors([train for train, _ in splits])
+    val_x, val_y, val_device = _stacked_tensors([test for _, test in splits])
+    model = StackedLinearModel(len(device_ids), input_size)
+    loss_function = nn.HuberLoss()
+    if solver == 'sgd':
+        optimizer = torch.optim.SGD(model.parameters(), lr=learning_rate, momentum=0.9)
+        best_loss, best_epoch, best_state = None, -1, None
+        for epoch in range(epochs):
+            model.train()
+            for batch in torch.randperm(len(y)).split(batch_size):
+                model.zero_grad()
+                loss = loss_function(y[batch], model(x[batch], device[batch]))
+                loss.backward()
+                optimizer.step()
+            with torch.no_grad():
+                val_loss = loss_function(val_y, model(val_x, val_device)).item()
+            if best_loss is None or val_loss < best_loss:
+                best_loss, best_epoch = val_loss, epoch
+                best_state = {name: value.clone() for name, value in model.state_dict().items()}
+            elif early_stopping and best_epoch + early_stopping <= epoch:
+                break
+        if best_state is not None:
+            model.load_state_dict(best_state)
+    else:
+        params = _solve_stacked(x, y, device, len(device_ids))
+        if solver == 'huber':
+            for _ in range(max_iterations):
+                previous = params
+                params = _solve_stacked(x, y, device, len(device_ids), params=params, delta=loss_function.delta)
+                if (params - previous).norm() <= 1e-6 * max(previous.norm().item(), 1.):
+                    break
+        with torch.no_grad():
+            model.weight.copy_(params[:, :-1])
+            model.bias.copy_(params[:, -1])
+    model.eval()
+    with torch.no_grad():
+        val_losses = nn.functional.huber_loss(model(val_x, val_device), val_y, reduction='none',
+                                              delta=loss_function.delta)
+        residuals = (model(val_x, val_device) - val_y).numpy()
+    lower_q = (1. - confidence) / 2
+    # devices are contiguous in the stacked tensors
+    ends = np.cumsum([len(test) for _, test in splits])
+    results = {}
+    for i, (device_id, (train, test)) in enumerate(zip(device_ids, splits)):
+        start = ends[i] - len(test)
+        results[device_id] = {
+            'weight': model.weight[i:i + 1].detach().numpy().copy(),
+            'bias': model.bias[i:i + 1].detach().numpy().copy(),
+            'mean': np.float64(train._mean),
+            'std': np.float64(train._std),
+            'bounds': np.quantile(residuals[start:ends[i]], [lower_q, 1. - lower_q]),
+            'input_size': np.int64(input_size),
+            'period': np.int64(train.period),
+            'val_loss': np.float64(val_losses[start:ends[i]].mean().item()),
+        }
+    return results
+
+
+def export_fleet(path: str, results: Dict[str, Dict]) -> str:
+    """Writes the detectors of all devices into one `fleet.npz` of arrays indexed by the sorted `device_ids`,
+    so a predictor loads it once and finds a device with a binary search"""
+    device_ids = sorted(results)
+    input_sizes = {int(results[device_id]['input_size']) for device_id in device_ids}
+    assert len(input_sizes) == 1, f"Devices must have the same input size, got {input_sizes}"
+    np.savez(path,
+             device_ids=np.array(device_ids, dtype=np.str_),
+             weight=np.stack([np.asarray(results[d]['weight'], dtype=np.float32).reshape(-1) for d in device_ids]),
+             bias=np.array([float(np.asarray(results[d]['bias']).reshape(-1)[0]) for d in device_ids],
+                           dtype=np.float32),
+             mean=np.array([results[d]['mean'] for d in device_ids], dtype=np.float64),
+             std=np.array([results[d]['std'] for d in device_ids], dtype=np.float64),
+             bounds=np.array([results[d]['bounds'] for d in device_ids], dtype=np.float64),
+             period=np.array([results[d]['period'] for d in device_ids], dtype=np.int64),
+             val_loss=np.array([results[d]['val_loss'] for d in device_ids], dtype=np.float64),
+             input_size=np.int64(input_sizes.pop()))
+    return path
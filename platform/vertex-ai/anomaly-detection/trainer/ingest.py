@@ -0,0 +1,145 @@
+import datetime
+import glob
+import os
+import re
+import pandas as pd
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator, List, Optional, Sequence, Tuple
+
+from trainer.store import SeriesStore
+
+COLUMNS = ('timestamp', 'value')
+DEVICE_COLUMNS = ('deviceId', 'timestamp', 'value')
+PARTITION_RE = re.compile(r'year=(\d+)/month=(\d+)/day=(\d+)')
+
+
+def partition_date(path: str) -> Optional[datetime.date]:
+    """Date of the hive partition (year=/month=/day=) the file belongs to, if any"""
+    found = PARTITION_RE.search(path)
+    if found is None:
+        return None
+    return datetime.date(*map(int, found.groups()))
+
+
+def in_date_range(path: str, start_date: Optional[datetime.date] = None,
+                  end_date: Optional[datetime.date] = None) -> bool:
+    date = partition_date(path)
+    if date is None:
+        return True
+    return (start_date is None or date >= start_date) and (end_date is None or date <= end_date)
+
+
+def list_cloud_files(pattern, gsclient, extension: str = '.csv', start_date: Optional[datetime.date] = None,
+                     end_date: Optional[datetime.date] = None) -> List[str]:
+    """Lists files by GCS prefix or local path, skipping the partitions outside of the date range"""
+    if pattern.endswith(extension) and '*' not in pattern:
+        return [pattern]
+
+    if pattern.startswith('gs://'):
+        splits = pattern[:pattern.find('*')].split('/')
+        prefix = '/'.join(splits[3:])
+        blobs = gsclient.list_blobs(splits[2], prefix=prefix)
+        files = [f"gs://{blob.bucket.name}/{blob.name}" for blob in blobs if blob.name.endswith(extension)]
+    elif '*' in pattern:
+        files = sorted(glob.glob(pattern, recursive=True))
+    else:
+        files = sorted(glob.glob(os.path.join(pattern, '**', f'*{extension}'), recursive=True))
+    return [file for file in files if file.endswith(extension) and in_date_range(file, start_date, end_date)]
+
+
+def read_csv_file(file: str, columns: Sequence[str] = COLUMNS) -> Optional[pd.DataFrame]:
+    try:
+        return pd.read_csv(file, usecols=lambda column: column in columns)
+    except pd.errors.EmptyDataError:
+        # Ignoring empty files
+        return None
+
+
+def read_parquet_file(file: str, columns: Sequence[str] = COLUMNS) -> Optional[pd.DataFrame]:
+    return pd.read_parquet(file, columns=list(columns))
+
+
+def iter_csv_files(files: Sequence[str], max_workers: int = 8, columns: Sequence[str] = COLUMNS,
+                   read_file: Callable = read_csv_file) -> Iterator[Tuple[str, Optional[pd.DataFrame]]]:
+    """Reads files concurrently, yielding them in order with at most 2 * `max_workers` files in flight"""
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for file in files:
+            pending.append((file, executor.submit(read_file, file, columns)))
+            if len(pending) >= 2 * max_workers:
+                file, future = pending.popleft()
+                yield file, future.result()
+        while pending:
+            file, future = pending.popleft()
+            yield file, future.result()
+
+
+def date_filter(start_date: Optional[datetime.date] = None, end_date: Optional[datetime.date] = None):
+    """pyarrow.dataset filter on hive year/month/day partition columns"""
+    import pyarrow.dataset as ds
+    year, month, day = ds.field('year'), ds.field('month'), ds.field('day')
+    expression = None
+    if start_date is not None:
+        expression = ((year > start_date.year)
+                      | ((year == start_date.year) & (month > start_date.month))
+                      | ((year == start_date.year) & (month == start_date.month) & (day >= start_date.day)))
+    if end_date is not None:
+        before = ((year < end_date.year)
+                  | ((year == end_date.year) & (month < end_date.month))
+                  | ((year == end_date.year) & (month == end_date.month) & (day <= end_date.day)))
+        expression = before if expression is None else expression & before
+    return expression
+
+
+def read_parquet_data(path: str, start_date: Optional[datetime.date] = None,
+                      end_date: Optional[datetime.date] = None, columns: Sequence[str] = COLUMNS) -> pd.DataFrame:
+    """Reads only the `columns` (timestamp and value by default) of the partitions within the date range"""
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    # Partitioning of WriteToGCS output, the types are given as departament and product ids may be all nulls
+    partitioning = ds.partitioning(pa.schema([
+        ('departament_id', pa.string()), ('product_id', pa.string()),
+        ('year', pa.int32()), ('month', pa.int32()), ('day', pa.int32())]), flavor='hive')
+    filesystem = None
+    if '*' in path:
+        path = path[:path.find('*')]
+    if path.startswith('gs://'):
+        from gcsfs import GCSFileSystem
+        filesystem = GCSFileSystem()
+        path = path[len('gs://'):]
+    dataset = ds.dataset(path, filesystem=filesystem, format='parquet', partitioning=partitioning)
+    table = dataset.to_table(columns=list(columns), filter=date_filter(start_date, end_date), use_threads=True)
+    return table.to_pandas()
+
+
+def read_cloud_data(pattern, gsclient, data_format: str = 'csv', start_date: Optional[datetime.date] = None,
+                    end_date: Optional[datetime.date] = None, max_workers: int = 8,
+                    columns: Sequence[str] = COLUMNS) -> pd.DataFrame:
+    if data_format == 'parquet':
+        res = read_parquet_data(pattern, start_date, end_date, columns)
+        assert len(res) > 0, "There must be at least 1 non-empty file to get data for training"
+        return res.drop_duplicates()
+
+    files = list_cloud_files(pattern, gsclient, start_date=start_date, end_date=end_date)
+    dfs = [df for _, df in iter_csv_files(files, max_workers, columns) if df is not None]
+    # concatenationg slices of data from different time ranges
+    assert len(dfs) > 0, "There must be at least 1 non-empty file to get data for training"
+    return pd.concat(dfs, ignore_index=True).drop_duplicates()
+
+
+def update_store(pattern, gsclient, store: SeriesStore, start_date: Optional[datetime.date] = None,
+                 end_date: Optional[datetime.date] = None, max_workers: int = 8,
+                 data_format: str = 'csv') -> SeriesStore:
+    """Converts only the files which are not in the store yet, so retraining reuses already converted data.
+    Parquet files are read one by one as well, only their `timestamp` and `value` columns"""
+    files = [file for file in list_cloud_files(pattern, gsclient, extension=f'.{data_format}',
+                                               start_date=start_date, end_date=end_date)
+             if file not in store.partitions]
+    read_file = read_parquet_file if data_format == 'parquet' else read_csv_file
+    for file, df in iter_csv_files(files, max_workers, read_file=read_file):
+        if df is None:
+            df = pd.DataFrame({column: [] for column in COLUMNS})
+        store.append(df, partitions=[file])
+    assert len(store) > 0, "There must be at least 1 non-empty file to get data for training"
+    return store
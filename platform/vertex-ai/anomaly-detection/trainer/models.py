@@ -1,3 +1,4 @@
+import torch
 from torch import nn
 
 class LinearModel(nn.Module):
@@ -8,3 +9,17 @@ class LinearModel(nn.Module):
     
     def forward(self, x):
         return self.lin1(x).squeeze()
+
+
+class StackedLinearModel(nn.Module):
+    """Linear models of many devices trained as one: the weights and bias of device `i` are row `i`"""
+
+    def __init__(self, devices, input_size):
+        super().__init__()
+        self.weight = nn.Parameter(torch.zeros(devices, input_size))
+        self.bias = nn.Parameter(torch.zeros(devices))
+        nn.init.uniform_(self.weight, -input_size ** -.5, input_size ** -.5)
+        nn.init.uniform_(self.bias, -input_size ** -.5, input_size ** -.5)
+
+    def forward(self, x, device):
+        return (x * self.weight[device]).sum(-1) + self.bias[device]
@@ -0,0 +1,170 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+from typing import Iterable, Optional, Set, Tuple
+
+TIMESTAMPS_FILE = 'timestamps.i8'
+VALUES_FILE = 'values.f4'
+NORMALIZED_FILE = 'normalized.f4'
+MANIFEST_FILE = 'manifest.json'
+CHUNK_SIZE = 1 << 22
+
+
+class SeriesStore:
+    """Sorted and deduplicated time series kept on disk as raw int64 epoch seconds and float32 values.
+
+    Arrays are opened with `np.memmap`, so readers only page in what they touch. The manifest keeps the names
+    of already ingested partitions, which lets retraining append only the new ones.
+
+    The manifest is the commit point: records appended past its length by an interrupted append are truncated
+    on open, and merges write a new generation of the files which the manifest switches to once complete.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        manifest_file = os.path.join(self.path, MANIFEST_FILE)
+        if os.path.exists(manifest_file):
+            with open(manifest_file) as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {'length': 0, 'partitions': []}
+        self._truncate()
+
+    def __len__(self) -> int:
+        return self.manifest['length']
+
+    @property
+    def partitions(self) -> Set[str]:
+        return set(self.manifest['partitions'])
+
+    @property
+    def timestamps(self) -> np.ndarray:
+        return self._open(TIMESTAMPS_FILE, np.int64)
+
+    @property
+    def values(self) -> np.ndarray:
+        return self._open(VALUES_FILE, np.float32)
+
+    def _file(self, name: str, generation: Optional[int] = None) -> str:
+        """Path of the data file of the generation, the current one by default"""
+        generation = self.manifest.get('generation', 0) if generation is None else generation
+        if generation == 0:
+            return os.path.join(self.path, name)
+        stem, extension = os.path.splitext(name)
+        return os.path.join(self.path, f'{stem}.{generation}{extension}')
+
+    def _open(self, name: str, dtype, mode: str = 'r') -> np.ndarray:
+        if len(self) == 0:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(self._file(name), dtype=dtype, mode=mode, shape=(len(self),))
+
+    def _truncate(self) -> None:
+        """Drops records past the manifest length, left by an append interrupted before the manifest was saved"""
+        for name, dtype in ((TIMESTAMPS_FILE, np.int64), (VALUES_FILE, np.float32)):
+            file = self._file(name)
+            size = len(self) * np.dtype(dtype).itemsize
+            if os.path.exists(file) and os.path.getsize(file) > size:
+                os.truncate(file, size)
+
+    def append(self, data: pd.DataFrame, partitions: Iterable[str] = ()) -> None:
+        """Adds `timestamp` and `value` columns of the data read from new partitions.
+        Readings with an already stored timestamp replace the stored ones"""
+        timestamps = pd.to_datetime(data['timestamp'], utc=True).values.astype('datetime64[s]').astype(np.int64)
+        values = data['value'].to_numpy(dtype=np.float32)
+        timestamps, values = self._sorted_unique(timestamps, values)
+        previous_generation = self.manifest.get('generation', 0)
+
+        if len(timestamps) == 0:
+            pass
+        elif len(self) == 0 or timestamps[0] > self.timestamps[-1]:
+            # Newer data, just appending to the end of files
+            for name, array in ((TIMESTAMPS_FILE, timestamps), (VALUES_FILE, values)):
+                with open(self._file(name), 'ab') as f:
+                    array.tofile(f)
+                    f.flush()
+                    os.fsync(f.fileno())
+            self.manifest['length'] += len(timestamps)
+        else:
+            # Overlapping data, merging with the stored series into the files of the next generation
+            self.manifest['length'] = self._merge(timestamps, values, previous_generation + 1)
+            self.manifest['generation'] = previous_generation + 1
+        self.manifest['partitions'] = sorted(self.partitions.union(partitions))
+        self._save_manifest()
+        if self.manifest.get('generation', 0) != previous_generation:
+            # the former files are no longer referenced once the manifest is saved
+            for name in (TIMESTAMPS_FILE, VALUES_FILE):
+                os.remove(self._file(name, previous_generation))
+
+    def _merge(self, timestamps: np.ndarray, values: np.ndarray, generation: int) -> int:
+        """Writes the stored series merged with the sorted unique readings into the files of `generation`
+        chunk by chunk, returns the merged length"""
+        stored_timestamps, stored_values = self.timestamps, self.values
+        # the stored readings before the first new one are copied as they are
+        start = int(np.searchsorted(stored_timestamps, timestamps[0]))
+        length, position = 0, 0
+        with open(self._file(TIMESTAMPS_FILE, generation), 'wb') as timestamps_file, \
+                open(self._file(VALUES_FILE, generation), 'wb') as values_file:
+            def write(chunk_timestamps, chunk_values):
+                chunk_timestamps.tofile(timestamps_file)
+                chunk_values.tofile(values_file)
+                return len(chunk_timestamps)
+
+            for chunk_start in range(0, start, CHUNK_SIZE):
+                chunk_end = min(chunk_start + CHUNK_SIZE, start)
+                length += write(stored_timestamps[chunk_start:chunk_end], stored_values[chunk_start:chunk_end])
+            for chunk_start in range(start, len(stored_timestamps), CHUNK_SIZE):
+                chunk_timestamps = stored_timestamps[chunk_start:chunk_start + CHUNK_SIZE]
+                chunk_values = stored_values[chunk_start:chunk_start + CHUNK_SIZE]
+                # new readings up to the last stored timestamp of the chunk, a duplicated timestamp
+                # always falls into the chunk holding the stored one
+                end = int(np.searchsorted(timestamps, chunk_timestamps[-1], side='right'))
+                length += write(*self._sorted_unique(np.concatenate([chunk_timestamps, timestamps[position:end]]),
+                                                     np.concatenate([chunk_values, values[position:end]])))
+                position = end
+            length += write(timestamps[position:], values[position:])
+            for f in (timestamps_file, values_file):
+                f.flush()
+                os.fsync(f.fileno())
+        return length
+
+    @staticmethod
+    def _sorted_unique(timestamps: np.ndarray, values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        order = np.argsort(timestamps, kind='stable')
+        timestamps, values = timestamps[order], values[order]
+        # keeping the last reading of every timestamp
+        last = np.r_[timestamps[1:] != timestamps[:-1], True] if len(timestamps) else np.empty(0, dtype=bool)
+        return timestamps[last], values[last]
+
+    def _save_manifest(self) -> None:
+        manifest_file = os.path.join(self.path, MANIFEST_FILE)
+        with open(manifest_file + '.tmp', 'w') as f:
+            json.dump(self.manifest, f)
+        os.replace(manifest_file + '.tmp', manifest_file)
+
+    def statistics(self) -> Tuple[float, float]:
+        """Mean and sample standard deviation of values, computed chunk by chunk"""
+        values = self.values
+        count, mean, m2 = 0, 0., 0.
+        for start in range(0, len(values), CHUNK_SIZE):
+            chunk = values[start:start + CHUNK_SIZE].astype(np.float64)
+            chunk_mean = chunk.mean()
+            chunk_m2 = ((chunk - chunk_mean) ** 2).sum()
+            delta = chunk_mean - mean
+            total = count + len(chunk)
+            mean += delta * len(chunk) / total
+            m2 += chunk_m2 + delta ** 2 * count * len(chunk) / total
+            count = total
+        return float(mean), float(np.sqrt(m2 / (count - 1)))
+
+    def normalized(self, mean: float, std: float) -> np.ndarray:
+        """Writes (value - mean) / std next to the store chunk by chunk and maps it into memory"""
+        values = self.values
+        normalized = np.memmap(os.path.join(self.path, NORMALIZED_FILE), dtype=np.float32, mode='w+',
+                               shape=(len(values),))
+        for start in range(0, len(values), CHUNK_SIZE):
+            normalized[start:start + CHUNK_SIZE] = (values[start:start + CHUNK_SIZE] - mean) / std
+        normalized.flush()
+        return normalized
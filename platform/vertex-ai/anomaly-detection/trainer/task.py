@@ -1,46 +1,23 @@
 import datetime
 import os
+import sys
 import torch
-import pandas as pd
 
 from argparse import ArgumentParser
-from datetime import datetime
+from datetime import date, datetime
 from re import match
 from google.cloud.storage import Client as GSClient, Blob
 from google.cloud.logging import Client as GLogClient
-from torch.utils.data import DataLoader
 from torch import nn
 
-from trainer.data import TimeSeriesDataset
+from trainer.data import TensorLoader, TimeSeriesDataset
+from trainer.fleet import FLEET_MODEL_FILE, export_fleet, split_by_device, train_devices, train_stacked
+from trainer.ingest import DEVICE_COLUMNS, read_cloud_data, update_store
 from trainer.models import LinearModel
+from trainer.store import SeriesStore
 from trainer.trainer import Trainer
 
 
-
-def read_cloud_data(pattern, gsclient):
-    if pattern.endswith('.csv') and '*' not in pattern:
-        res = pd.read_csv(pattern)
-        return res.drop_duplicates()
-
-    splits = pattern[:pattern.find('*')].split('/')
-    prefix = '/'.join(splits[3:])
-    dfs = []
-    blobs = gsclient.list_blobs(splits[2], prefix=prefix)
-    for blob in blobs:
-        if not blob.name.endswith('.csv'):
-            continue
-        try:
-            df = pd.read_csv(f"gs://{blob.bucket.name}/{blob.name}")
-            dfs.append(df)
-        except pd.errors.EmptyDataError:
-            # Ignoring empty files
-            continue
-    # concatenationg slices of data from different time ranges
-    assert len(dfs) > 0, "There must be at least 1 non-empty file to get data for training"
-    return pd.concat(dfs, ignore_index=True).drop_duplicates()
-
-
-
 if __name__ == '__main__':
 
     parser = ArgumentParser("Anomaly Detection Cloud Trainer")
@@ -50,11 +27,33 @@ if __name__ == '__main__':
                         help='path to GCS location of data file')
     parser.add_argument('-l','--learning-rate', type=float, dest='learning_rate', default=1E-5)
     parser.add_argument('-e','--epochs', dest='epochs', type=int, default=100)
-    parser.add_argument('-b','--batch-size', dest='batch_size', type=int, default=8)
+    parser.add_argument('-b','--batch-size', dest='batch_size', type=int, default=8,
+                        help='number of windows per SGD step, batches are slices of in-memory tensors')
     parser.add_argument('-s','--early-stopping', dest='early_stopping', type=int, default=5,
                         help='stop after this number of consequentive epochs witout improvements')
     parser.add_argument('-t','--training-part', dest='split', type=float, default=0.75,
                         help='part of data which will be used for training')
+    parser.add_argument('--store-path', dest='store_path', default=None,
+                        help='directory of the memory-mapped data store, e.g. on the /gcs/ mount to reuse it '
+                             'between trainings. Data is read into memory if not set')
+    parser.add_argument('--data-format', dest='data_format', choices=['csv', 'parquet'], default='csv',
+                        help='format of data files, converted into the data store file by file with --store-path')
+    parser.add_argument('--start-date', dest='start_date', type=date.fromisoformat, default=None,
+                        help='first day (YYYY-MM-DD) of year/month/day partitions to train on')
+    parser.add_argument('--end-date', dest='end_date', type=date.fromisoformat, default=None,
+                        help='last day (YYYY-MM-DD) of year/month/day partitions to train on')
+    parser.add_argument('--solver', dest='solver', choices=['sgd', 'lstsq', 'huber'], default='sgd',
+                        help='sgd trains epochs with the optimizer, lstsq and huber fit the linear model in closed form '
+                             'with least squares or Huber IRLS')
+    parser.add_argument('--solver-chunk-size', dest='solver_chunk_size', type=int, default=1 << 16,
+                        help='number of windows per chunk of the closed form solvers')
+    parser.add_argument('--fleet', dest='fleet', choices=['none', 'devices', 'stacked'], default='none',
+                        help='devices trains a detector per deviceId in a process pool, stacked trains them as '
+                             'a single stacked model, none trains one detector over all rows')
+    parser.add_argument('--train-workers', dest='train_workers', type=int, default=None,
+                        help='number of processes training devices concurrently, the number of CPUs by default')
+    parser.add_argument('--read-workers', dest='read_workers', type=int, default=8,
+                        help='number of files downloaded and parsed concurrently')
     
     args = parser.parse_args()
     args.experiment_name += datetime.now().strftime("_%Y%m%d")
@@ -62,14 +61,41 @@ if __name__ == '__main__':
     project_number = os.environ["CLOUD_ML_PROJECT_ID"]
     GLogClient(project=project_number).setup_logging()
     storage = GSClient(project=project_number)
-    data = read_cloud_data(args.data_path, storage)
-    data.columns = ['timestamp', 'value']
-    data.set_index('timestamp', inplace=True)
-    data = data['value']
+    output_destination = os.environ.get("AIP_MODEL_DIR")
+    output_bucket = output_destination.split('/')[2]
+    output_folder = '/'.join(output_destination.split('/')[3:])
+    bucket = storage.bucket(output_bucket)
+    if args.fleet != 'none':
+        assert args.store_path is None, "The data store keeps a single series, it can not be used for fleets"
+        data = read_cloud_data(args.data_path, storage, data_format=args.data_format, start_date=args.start_date,
+                               end_date=args.end_date, max_workers=args.read_workers, columns=DEVICE_COLUMNS)
+        series_by_device = split_by_device(data)
+        if args.fleet == 'devices':
+            results = train_devices(series_by_device, args.experiment_name, 24, split=args.split,
+                                    solver=args.solver, epochs=args.epochs, batch_size=args.batch_size,
+                                    learning_rate=args.learning_rate, early_stopping=args.early_stopping,
+                                    max_workers=args.train_workers)
+        else:
+            os.makedirs(args.experiment_name, exist_ok=True)
+            results = train_stacked(series_by_device, 24, split=args.split, solver=args.solver, epochs=args.epochs,
+                                    learning_rate=args.learning_rate, early_stopping=args.early_stopping)
+        assert len(results) > 0, "No device has enough data for training"
+        fleet_file = export_fleet(os.path.join(args.experiment_name, FLEET_MODEL_FILE), results)
+        Blob(output_folder + FLEET_MODEL_FILE, bucket).upload_from_filename(fleet_file)
+        sys.exit(0)
+    if args.store_path is not None:
+        data = update_store(args.data_path, storage, SeriesStore(args.store_path), start_date=args.start_date,
+                            end_date=args.end_date, max_workers=args.read_workers, data_format=args.data_format)
+    else:
+        data = read_cloud_data(args.data_path, storage, data_format=args.data_format, start_date=args.start_date,
+                               end_date=args.end_date, max_workers=args.read_workers)
+        data = data[['timestamp', 'value']]
+        data.set_index('timestamp', inplace=True)
+        data = data['value']
     dataset24 = TimeSeriesDataset(data, 24)
     train24, test24 = dataset24.split(args.split)
-    tr24_loader = DataLoader(train24, batch_size=args.batch_size, shuffle=True, drop_last=True, prefetch_factor=2)
-    ts24_loader = DataLoader(test24, batch_size=args.batch_size, shuffle=False, drop_last=True, prefetch_factor=2)
+    tr24_loader = TensorLoader(train24, batch_size=args.batch_size, shuffle=True, drop_last=True)
+    ts24_loader = TensorLoader(test24, batch_size=args.batch_size, shuffle=False, drop_last=True)
 
     model = LinearModel(24)
     optim = torch.optim.SGD(model.parameters(), lr=args.learning_rate, momentum=0.9)
@@ -78,14 +104,15 @@ if __name__ == '__main__':
     trainer = Trainer(experiment_name=args.experiment_name, model=model, optimizer=optim, loss=loss, parameters=dict(),
                     train_loader=tr24_loader, val_loader=ts24_loader)
 
-    trainer.train(args.epochs, early_stopping=args.early_stopping)
+    if args.solver == 'sgd':
+        trainer.train(args.epochs, early_stopping=args.early_stopping)
+    else:
+        trainer.fit_linear(args.solver, chunk_size=args.solver_chunk_size)
     model_file = sorted([os.path.join(args.experiment_name, file) 
                         for file in os.listdir(args.experiment_name) 
                         if match(r'checkpoint\d+\.pt', file)])[-1]
 
-    output_destination = os.environ.get("AIP_MODEL_DIR")
-    output_bucket = output_destination.split('/')[2]
-    output_folder = '/'.join(output_destination.split('/')[3:])
-    bucket = storage.bucket(output_bucket)
     Blob(output_folder + 'pytorch_model.bin', bucket).upload_from_filename(model_file)
     Blob(output_folder + 'config.json', bucket).upload_from_filename(args.experiment_name + '/config.json')
+    if os.path.exists(args.experiment_name + '/model.npz'):
+        Blob(output_folder + 'model.npz', bucket).upload_from_filename(args.experiment_name + '/model.npz')
@@ -4,14 +4,17 @@ import json
 import re
 import torch
 from torch.utils.data import DataLoader
-from typing import Dict, Optional #, Literal
+from typing import Dict, Optional, Tuple, Union #, Literal
 from torch import nn
 
+from trainer.data import TensorLoader
+
 
 class Trainer:
     
     def __init__(self, experiment_name: str, model: nn.Module, optimizer: nn.Module, loss: nn.Module, parameters: Dict,
-                 train_loader: torch.utils.data.DataLoader, val_loader: Optional[torch.utils.data.DataLoader] = None):
+                 train_loader: Union[DataLoader, TensorLoader],
+                 val_loader: Union[None, DataLoader, TensorLoader] = None):
         self.experiment_name = experiment_name  # works also as save_folder
         if not os.path.exists(self.experiment_name):
             os.mkdir(experiment_name)
@@ -31,7 +34,8 @@ class Trainer:
 
     def train_one_epoch(self):
         self.model.train()
-        running_loss = 0.
+        # accumulated on the tensor, synchronized once per epoch
+        running_loss = torch.zeros(())
         i = 0
         self.epoch += 1 
         for x, y in self.train_loader:
@@ -41,8 +45,8 @@ class Trainer:
             loss = self.loss_function(y.float(), yhat)
             loss.backward()
             self.optimizer.step()
-            running_loss += loss.detach().cpu().numpy().item()
-        self.history['train_loss'].append(running_loss / (i * self.train_loader.batch_size))
+            running_loss += loss.detach()
+        self.history['train_loss'].append(running_loss.item() / (i * self.train_loader.batch_size))
         print("Training loss is:", self.history['train_loss'][-1])
         return self.history['train_loss'][-1]
     
@@ -56,20 +60,30 @@ class Trainer:
             loader = test_loader
             print('Testing model on the unseen data')
         assert loader is not None, "val_loader is required to validate the model"
+        y, yhat = self.predict(loader)
         with torch.no_grad():
-            running_loss = 0.
-            i = 0
-            for x, y in loader:
-                i += 1
-                yhat = self.model(x.float())
-                loss = self.loss_function(y.float(), yhat)
-                running_loss += loss.cpu().numpy().item()
-        res_loss = running_loss / ((i-1) * loader.batch_size + len(x))
+            # the mean loss of one forward pass on the scale of the former sum of batch means per row
+            res_loss = self.loss_function(y, yhat).item() / loader.batch_size
         print("test/val loss is:", res_loss)
         if test_loader is None:
             self.history['val_loss'].append(res_loss)
         return res_loss
         
+    def predict(self, loader, chunk_size: int = 1 << 16) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Labels and predictions of the whole loader, in forward passes of `chunk_size` windows
+        for a TensorLoader, so only a chunk of its windows view is materialized at a time"""
+        self.model.eval()
+        with torch.no_grad():
+            if isinstance(loader, TensorLoader):
+                x, y = loader.tensors
+                yhat = [self.model(x[start:start + chunk_size]).reshape(-1) for start in range(0, len(y), chunk_size)]
+                return y, torch.cat(yhat) if yhat else y.new_empty(0)
+            ys, yhats = [], []
+            for x, y in loader:
+                ys.append(y.float().reshape(-1))
+                yhats.append(self.model(x.float()).reshape(-1))
+            return torch.cat(ys), torch.cat(yhats)
+
     def train(self, epochs, early_stopping=5):            
         for e in range(epochs):
             self.train_one_epoch()
@@ -85,6 +99,80 @@ class Trainer:
                     self.save_checkpoint(stage='intermediate')
         self.save_checkpoint(stage='after')
 
+    def fit_linear(self, solver: str = 'lstsq', chunk_size: int = 1 << 16, l2: float = 0.,
+                   max_iterations: int = 20, tolerance: float = 1e-6):
+        """Fits a single linear layer model in closed form instead of running SGD epochs.
+
+        `lstsq` solves the least squares normal equations, `huber` minimizes the Huber loss with iteratively
+        reweighted least squares using `delta` of the loss function. X^T X is accumulated over chunks
+        of `chunk_size` training windows, so memory-mapped data is never loaded as a whole.
+        The result is saved as the best epoch 0 with the same checkpoints and config as `train`.
+        """
+        assert solver in ['lstsq', 'huber'], 'Solver must be in [\'lstsq\', \'huber\']'
+        layers = [module for module in self.model.modules() if isinstance(module, nn.Linear)]
+        if len(layers) != 1:
+            raise ValueError(f"Closed form solvers support single linear layer models, "
+                             f"the model has {len(layers)} linear layers")
+        dataset = self.train_loader.dataset
+        params = self._solve_normal_equations(dataset.rows, dataset.labels, chunk_size, l2)
+        if solver == 'huber':
+            delta = float(getattr(self.loss_function, 'delta', 1.))
+            for _ in range(max_iterations):
+                previous = params
+                params = self._solve_normal_equations(dataset.rows, dataset.labels, chunk_size, l2,
+                                                      params=params, delta=delta)
+                if np.linalg.norm(params - previous) <= tolerance * max(np.linalg.norm(previous), 1.):
+                    break
+        with torch.no_grad():
+            layers[0].weight.copy_(torch.from_numpy(params[:-1]).reshape(layers[0].weight.shape))
+            layers[0].bias.copy_(torch.from_numpy(params[-1:]))
+        self.model.eval()
+        self.epoch += 1
+        # on the scale of `train_one_epoch`, which divides the sum of batch mean losses by the number of rows
+        self.history['train_loss'].append(self._dataset_loss(dataset, chunk_size) / self.train_loader.batch_size)
+        print("Training loss is:", self.history['train_loss'][-1])
+        if self.val_loader is not None:
+            self.validate()
+            self.best_epoch = self.epoch
+            self.save_checkpoint(stage='intermediate')
+        self.save_checkpoint(stage='after')
+
+    @staticmethod
+    def _solve_normal_equations(rows, labels, chunk_size: int, l2: float = 0.,
+                                params: Optional[np.ndarray] = None, delta: float = 1.) -> np.ndarray:
+        """Weights and bias of the least squares fit, weighted by the Huber IRLS weights of the residuals
+        of `params` if given"""
+        size = rows.shape[1]
+        xtx = np.zeros((size + 1, size + 1))
+        xty = np.zeros(size + 1)
+        x = np.ones((min(chunk_size, len(rows)), size + 1))
+        for start in range(0, len(rows), chunk_size):
+            end = min(start + chunk_size, len(rows))
+            chunk = x[:end - start]
+            chunk[:, :size] = rows[start:end]
+            y = np.asarray(labels[start:end], dtype=np.float64)
+            weighted = chunk
+            if params is not None:
+                # 1 inside of the quadratic zone of the Huber loss, delta / |residual| outside of it
+                weights = delta / np.maximum(np.abs(chunk @ params - y), delta)
+                weighted = chunk * weights[:, None]
+            xtx += weighted.T @ chunk
+            xty += weighted.T @ y
+        # the bias is not regularized
+        xtx[np.arange(size), np.arange(size)] += l2
+        return np.linalg.lstsq(xtx, xty, rcond=None)[0]
+
+    def _dataset_loss(self, dataset, chunk_size: int) -> float:
+        """Mean loss of the model over a dataset computed in chunks"""
+        self.model.eval()
+        total = 0.
+        with torch.no_grad():
+            for start in range(0, len(dataset.rows), chunk_size):
+                x = torch.from_numpy(np.array(dataset.rows[start:start + chunk_size], dtype=np.float32))
+                y = torch.from_numpy(np.asarray(dataset.labels[start:start + chunk_size], dtype=np.float32))
+                total += self.loss_function(y, self.model(x)).item() * len(y)
+        return total / len(dataset.rows)
+
     def clean_models(self, number_left=3):
         """Remove all but `number_left` best intermediate checkpoints"""
         checkpoints = [os.path.join(self.experiment_name, f) for f in os.listdir(self.experiment_name) if re.match(r'checkpoint\d+\.pt', f)]
@@ -124,6 +212,32 @@ class Trainer:
                     'bounds': bounds,
                     'period': self.train_loader.dataset.period
                 }, f)            
+            # Exporting the best checkpoint, which is the one deployed for serving
+            best_checkpoint = os.path.join(self.experiment_name, f'checkpoint{self.best_epoch:04}.pt')
+            if os.path.exists(best_checkpoint):
+                self.export_linear(bounds, torch.load(best_checkpoint)['model_state_dict'])
+            else:
+                self.export_linear(bounds)
+
+    def export_linear(self, bounds, state_dict: Optional[Dict] = None) -> Optional[str]:
+        """Writes weights, bias, normalization and bounds of a single linear layer model into `model.npz`,
+        which can be served with NumPy only"""
+        layers = [name for name, module in self.model.named_modules() if isinstance(module, nn.Linear)]
+        if len(layers) != 1:
+            return None
+        if state_dict is None:
+            state_dict = self.model.state_dict()
+        dataset = self.train_loader.dataset
+        path = os.path.join(self.experiment_name, 'model.npz')
+        np.savez(path,
+                 weight=state_dict[f'{layers[0]}.weight'].detach().cpu().numpy(),
+                 bias=state_dict[f'{layers[0]}.bias'].detach().cpu().numpy(),
+                 mean=np.float64(dataset._mean),
+                 std=np.float64(dataset._std),
+                 bounds=np.asarray(bounds, dtype=np.float64),
+                 input_size=np.int64(dataset.points_before),
+                 period=np.int64(dataset.period))
+        return path
 
     def load_checkpoint(self, folder=None, last: bool = True):
         if folder is None:
@@ -147,24 +261,19 @@ class Trainer:
             self.epoch = config['epoch']
             self.best_epoch = config['best_epoch']
 
-    def get_residuals_bounds(self, confidence: float = 0.95, test_loader: Optional[DataLoader] = None):
+    def get_residuals_bounds(self, confidence: float = 0.95, test_loader: Union[None, DataLoader, TensorLoader] = None):
         """Calculates expected confidence interval for model ouptut based on residuals and given confidence rate"""
         # TODO Room for improvement: bootstrapping aproach
         lower_q = (1. - confidence) / 2
         upper_q = 1. - lower_q
-        self.model.eval()
-        residuals = []
         if test_loader is None:
             loader = self.val_loader 
         else: 
             loader = test_loader
             print('getting residuals on the unseen data')
         assert loader is not None, "val_loader is required to validate the model"
-        with torch.no_grad():
-            for x, y in loader:
-                yhat = self.model(x.float())
-                residuals.append(yhat.cpu().numpy() - y.cpu().numpy())
-        residuals = np.concatenate(residuals, axis=0)
+        y, yhat = self.predict(loader)
+        residuals = (yhat - y).numpy()
         boundaries = np.quantile(residuals, [lower_q, upper_q])
         lower_bound_r, upper_bound_res = boundaries[0], boundaries[1]
         return lower_bound_r, upper_bound_res
@@ -174,3 +283,4 @@ class Trainer:
         import random
         random.seed(seed)
         np.random.seed(seed)
+        torch.manual_seed(seed)
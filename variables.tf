@@ -34,3 +34,15 @@ variable "image_tag" {
   default     = "0.10.0"
   type        = string
 }
+
+variable "iot_events_ingest_mode" {
+  description = "Loading of IoT events into BigQuery, event (a function per message) or batch (pulled every minute)"
+  default     = "event"
+  type        = string
+}
+
+variable "trainer_solver" {
+  description = "Solver of the anomaly detector training, sgd, lstsq or huber"
+  default     = "sgd"
+  type        = string
+}